@@ -0,0 +1,68 @@
+"""
+Compares ESCrudService.get_all, chunked mgets over the shared pool, with the
+previous approach of `terms` searches on `_id`, a swarm of up to 40 threads per
+call. Needs an elasticsearch node on localhost, and creates then deletes a
+`get_all_benchmark` index.
+
+    python -m benchmarks.get_all_benchmark
+"""
+import timeit
+
+from elasticsearch import Elasticsearch
+
+from pyes.crud import ESCrudService, MAX_GET_ALL
+from pyes.query_builder import Body, Query, Filter
+from pyes.response import get_hits, get_id, get_source
+from pyes.store import MegaStore
+from pyfunk.pyfunk import partition, swarm, count
+
+INDEX = 'get_all_benchmark'
+DOCUMENTS = 20000
+REPEAT = 5
+
+
+def terms_get_all(service, entity_ids, fields=[]):
+    all_results = {}
+
+    def helper(ids):
+        body = Body().query(Query().bool(Filter().terms('_id', ids))).size(len(ids)).source(fields)
+        results = service.query(body, raw_query=True, hits=False)
+        return {get_id(hit): get_source(hit) for hit in get_hits(results)}
+
+    def callback(_, results):
+        all_results.update(results)
+
+    groups = partition(MAX_GET_ALL, entity_ids)
+    swarm(helper, groups, callback=callback, workers=min(count(groups), 40))
+    return all_results
+
+
+def measure(f):
+    return min(timeit.repeat(f, number=1, repeat=REPEAT))
+
+
+def main():
+    es = Elasticsearch("localhost")
+    store = MegaStore(es)
+    service = ESCrudService(store, INDEX)
+
+    es.indices.create(index=INDEX)
+    try:
+        for i in range(0, DOCUMENTS):
+            store.index(str(i), INDEX, {'uid': str(i), 'thing_number': i, 'blob': 'x' * 200}, batch=True)
+        store.batch_write()
+        service.refresh()
+
+        print("{0:<24}{1:>14}{2:>14}".format("ids", "terms (ms)", "mget (ms)"))
+        for n in [10, 1000, 5000, DOCUMENTS]:
+            ids = [str(i) for i in range(0, n)]
+            assert terms_get_all(service, ids) == service.get_all(ids)
+            terms = measure(lambda: terms_get_all(service, ids)) * 1000
+            mget = measure(lambda: service.get_all(ids)) * 1000
+            print("{0:<24}{1:>14.1f}{2:>14.1f}".format(n, terms, mget))
+    finally:
+        es.indices.delete(index=INDEX)
+
+
+if __name__ == '__main__':
+    main()
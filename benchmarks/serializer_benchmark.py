@@ -0,0 +1,96 @@
+"""
+Compares the default elasticsearch-py JSONSerializer with the OrjsonSerializer
+on the work the store layer hands them: bulk NDJSON lines, search bodies and
+search responses.
+
+    python -m benchmarks.serializer_benchmark
+"""
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from elasticsearch.helpers import expand_action
+from elasticsearch.serializer import JSONSerializer
+
+from pyes.serializer import OrjsonSerializer
+
+DOCUMENTS = 5000
+REPEAT = 5
+
+
+def build_actions(n):
+    start = datetime(2020, 1, 1)
+    return [{
+        '_op_type': 'index',
+        '_index': 'thing',
+        '_id': str(i),
+        '_source': {
+            'uid': str(i),
+            'thing_type': 'common',
+            'created_time': start + timedelta(seconds=i),
+            'price': Decimal('19.99'),
+            'tags': ['alpha', 'beta', 'gamma'],
+            'location': {'lat': 51.5, 'lon': -0.12},
+            'description': 'a thing ' * 20
+        }
+    } for i in range(0, n)]
+
+
+def build_search_body():
+    return {
+        'query': {'bool': {'must': [{'term': {'thing_type': 'common'}},
+                                    {'range': {'price': {'gte': 10, 'lte': 100}}}]}},
+        'size': 1000,
+        'sort': [{'created_time': {'order': 'desc'}}],
+        '_source': ['uid', 'thing_type', 'price']
+    }
+
+
+def build_response(actions):
+    return {
+        'took': 12,
+        'hits': {
+            'total': {'value': len(actions), 'relation': 'eq'},
+            'hits': [{'_index': 'thing', '_id': a['_id'], '_score': 1.0,
+                      '_source': dict(a['_source'], created_time=a['_source']['created_time'].isoformat(),
+                                      price=19.99)}
+                     for a in actions]
+        }
+    }
+
+
+def bulk_lines(serializer, actions):
+    lines = []
+    for action in actions:
+        action_line, data = expand_action(action)
+        lines.append(serializer.dumps(action_line))
+        if data is not None:
+            lines.append(serializer.dumps(data))
+    return "\n".join(lines) + "\n"
+
+
+def measure(f):
+    return min(timeit.repeat(f, number=1, repeat=REPEAT))
+
+
+def main():
+    actions = build_actions(DOCUMENTS)
+    body = build_search_body()
+    raw_response = JSONSerializer().dumps(build_response(actions))
+
+    cases = [
+        ("bulk NDJSON ({0} docs)".format(DOCUMENTS), lambda s: lambda: bulk_lines(s, actions)),
+        ("search body x1000", lambda s: lambda: [s.dumps(body) for _ in range(0, 1000)]),
+        ("search response decode", lambda s: lambda: s.loads(raw_response)),
+    ]
+
+    serializers = [("json", JSONSerializer()), ("orjson", OrjsonSerializer())]
+
+    print("{0:<28}{1:>12}{2:>12}{3:>10}".format("case", "json (ms)", "orjson (ms)", "speedup"))
+    for name, case in cases:
+        timings = [measure(case(serializer)) * 1000 for _, serializer in serializers]
+        print("{0:<28}{1:>12.2f}{2:>12.2f}{3:>9.1f}x".format(name, timings[0], timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares the chained response transform, composed step by step with pyfunk
+`comp`, with the fused single pass `build_transform`, copying and in place,
+on search responses of 10k hits.
+
+    python -m benchmarks.transform_benchmark
+"""
+import copy
+import timeit
+
+from pyfunk.pyfunk import first, identity
+
+from pyes.response import include_ids, sources_from_response
+from pyes.store import TransformBuilder, build_transform
+
+HITS = 10000
+REPEAT = 5
+
+
+def build_response(n):
+    return {
+        'took': 12,
+        'hits': {
+            'total': {'value': n, 'relation': 'eq'},
+            'hits': [{'_index': 'thing', '_id': str(i), '_score': 1.0,
+                      '_source': {'thing_type': 'common', 'thing_number': i, 'tags': ['alpha', 'beta'],
+                                  'description': 'a thing ' * 10}}
+                     for i in range(0, n)]
+        }
+    }
+
+
+def chained_transform(transform=None, hits=True, just_one=False, include_id=False):
+    tb = TransformBuilder()
+    if include_id:
+        tb.add_transform(include_ids)
+    if hits:
+        tb.add_transform(sources_from_response)
+    if just_one:
+        tb.add_transform(first)
+    if transform:
+        tb.add_transform(transform)
+    return tb.transform or identity
+
+
+def measure(transform, response):
+    # Each run gets its own response, as the in place transform writes into it
+    responses = [copy.deepcopy(response) for _ in range(0, REPEAT)]
+    return min(timeit.timeit(lambda: transform(r), number=1) for r in responses)
+
+
+def main():
+    response = build_response(HITS)
+
+    cases = [
+        ("sources", {}),
+        ("sources + include_id", {'include_id': True}),
+        ("just_one + include_id", {'just_one': True, 'include_id': True}),
+    ]
+
+    print("{0:<24}{1:>14}{2:>12}{3:>16}{4:>10}".format("case", "chained (ms)", "fused (ms)", "in place (ms)",
+                                                         "speedup"))
+    for name, options in cases:
+        chained = measure(chained_transform(**options), response) * 1000
+        fused = measure(build_transform(**options), response) * 1000
+        in_place = measure(build_transform(in_place=True, **options), response) * 1000
+        print("{0:<24}{1:>14.2f}{2:>12.2f}{3:>16.2f}{4:>9.1f}x".format(name, chained, fused, in_place,
+                                                                      chained / in_place))
+
+
+if __name__ == '__main__':
+    main()
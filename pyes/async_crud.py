@@ -0,0 +1,294 @@
+from elasticsearch.helpers import BulkIndexError
+
+from pyes.crud import MATCH_ALL
+from pyes.query_builder import Body, Must, Query, SortDirection, Reindex
+from pyes.store import ConflictException
+from pyes.validators import NotExistsException
+from pyfunk.pyfunk import count, get
+from pyes.schema import checkargs, string, string_or_nil, boolean, number, nillable, s_or, type_of, function, \
+    dictionary
+from pyes.utils import uuid
+
+
+class AsyncESCrudService:
+    """
+    The asyncio mirror of the ESCrudService, to be used with an AsyncMegaStore.
+    Every call is a coroutine, apart from `scan` which is an async generator.
+    With an AsyncEntityLoader `get_entity` calls awaited together share mgets
+    """
+    def __init__(self, es, index, loader=None, validation=None):
+        self.es = es
+        self.index = index
+        self.loader = loader
+        self.validation = validation
+
+    @checkargs
+    async def create(self,
+                     entity: {},
+                     entity_id: string_or_nil = None,
+                     batch: boolean = False):
+        entity_id = entity_id or uuid()
+        entity['uid'] = entity_id
+        await self.es.create(entity_id, self.index, entity, batch=batch)
+        return entity_id
+
+    @checkargs
+    async def index_doc(self,
+                        entity: {},
+                        entity_id: string_or_nil = None,
+                        batch: boolean = False):
+        await self.es.index(entity_id, self.index, entity, batch=batch)
+
+    @checkargs
+    async def get_entity(self,
+                         entity_id: string,
+                         batch: boolean = False,
+                         source: nillable([string]) = None):
+        if self.loader is not None and not batch and source is None:
+            return await self.loader.load(self.index, entity_id)
+        params = {"_source": source} if source is not None else {}
+        return await self.es.get(entity_id, self.index, batch=batch, **params)
+
+    @checkargs
+    async def get_all(self, entity_ids: [string]):
+        async with self.es.batch():
+            for entity_id in entity_ids:
+                await self.get_entity(entity_id, batch=True)
+            return await self.batch_get()
+
+    @checkargs
+    async def get_entities(self,
+                           entity_ids: [string],
+                           limit: number = 1000,
+                           batch: boolean = False):
+        query = Query().bool(Must().terms("_id", entity_ids))
+        query = Body().query(query).size(limit)
+
+        return await self.es.query(self.index, query, batch=batch)
+
+    @checkargs
+    async def exists(self,
+                     entity_id: string,
+                     throw: boolean = True):
+        record_exists = await self.get_entity(entity_id) is not None
+        if not record_exists and throw:
+            raise NotExistsException("{0} does not exist for id {1}".format(self.index, entity_id))
+        else:
+            return record_exists
+
+    @checkargs
+    async def unique_after_update(self,
+                                  entity_id: string,
+                                  fields: {},
+                                  throw: boolean = True):
+        existing = await self.query(fields, just_one=True)
+        if existing:
+            existing_id = get(existing, 'uid')
+            if existing_id == entity_id:
+                return True
+            else:
+                if throw:
+                    raise ConflictException("Update of {0} causes a conflict".format(fields))
+                else:
+                    return False
+        return True
+
+    @checkargs
+    async def update(self,
+                     entity_id: string,
+                     update: {},
+                     batch: boolean = False,
+                     check_existence: boolean = True):
+        if not check_existence or await self.exists(entity_id, throw=not batch):
+            await self.es.update(entity_id, self.index, update, batch=batch)
+
+    @checkargs
+    async def upsert(self,
+                     entity_id: string,
+                     entity: {},
+                     batch: boolean = False):
+        await self.es.upsert(entity_id, self.index, entity, batch=batch)
+
+    @checkargs
+    async def script_update(self,
+                            entity_id: string,
+                            inline: string):
+        await self.es.script_update(entity_id, self.index, inline)
+
+    @checkargs
+    async def delete(self,
+                     entity_id: string,
+                     batch: boolean = False,
+                     check_existence: boolean = True):
+        if not check_existence or await self.exists(entity_id, throw=not batch):
+            await self.es.delete(entity_id, self.index, batch=batch)
+
+    @checkargs
+    async def delete_by_query(self, query: type_of(Query)):
+        await self.es.delete_by_query(self.index, query)
+
+    @checkargs
+    async def query(self,
+                    query: s_or({}, type_of(Body)),
+                    limit: number = 1000,
+                    sort: string_or_nil = None,
+                    sort_direction: string_or_nil = SortDirection.ASC,
+                    just_one: boolean = False,
+                    raw_query: boolean = False,
+                    key: string_or_nil = None,
+                    batch: boolean = False,
+                    hits: boolean = True,
+                    include_id: boolean = False,
+                    transform: nillable(function) = None,
+                    fields: nillable([string]) = None,
+                    in_place: boolean = False):
+        if not raw_query:
+            if isinstance(query, dict):
+                query = Query().bool(Must(query))
+                query = Body().query(query)
+
+            if limit is not None and query.limit is None:
+                query.size(limit)
+
+            if sort:
+                query.sort(sort, sort_direction)
+
+            if fields:
+                query.source(fields)
+
+        return await self.es.query(self.index, query, just_one=just_one, key=key,
+                                   batch=batch, hits=hits, transform=transform, include_id=include_id,
+                                   in_place=in_place)
+
+    @checkargs
+    async def count(self,
+                    query: s_or({}, type_of(Query)) = MATCH_ALL,
+                    batch: boolean = False,
+                    key: string_or_nil = None):
+        return await self.es.count(self.index, query, batch=batch, key=key)
+
+    @checkargs
+    async def unique_by_query(self,
+                              fields: {},
+                              throw: boolean = True,
+                              error_msg_fields: nillable({}) = {}):
+        c = count(await self.query(fields)) > 0
+        if c and throw:
+            error_msg = "Query for {0}, already exists. {1}".format(fields, error_msg_fields) if error_msg_fields else \
+                "Query for {0}, already exists.".format(fields)
+            raise ConflictException(error_msg)
+        else:
+            return not c
+
+    @checkargs
+    async def overwrite(self,
+                        entity_id: string,
+                        entity: {},
+                        batch: boolean = False):
+        await self.es.index(entity_id, self.index, entity, batch=batch)
+
+    @checkargs
+    async def suggest(self,
+                      prefix: string,
+                      key: string_or_nil = None,
+                      batch: boolean = False,
+                      contexts: nillable({}) = None):
+        return await self.es.suggest(self.index, "text_suggest", prefix, key=key, batch=batch, contexts=contexts)
+
+    @checkargs
+    async def match_all(self, size: number = 1000):
+        return await self.query(Body().query(Query().match_all()).size(size), raw_query=True)
+
+    async def refresh(self):
+        await self.es.refresh_index(self.index)
+
+    def scan(self, query=None, size=1000, scroll='5m'):
+        return self.es.scan(self.index, query=query, size=size, scroll=scroll)
+
+    async def batch_scan(self, query=None, size=1000, scroll='5m'):
+        batch = []
+        async for hit in self.scan(query=query, size=size, scroll=scroll):
+            batch.append(hit)
+            if count(batch) == size:
+                batch_to_yield = batch
+                batch = []
+                yield batch_to_yield
+        if batch:
+            yield batch
+
+    async def sliced_scan(self, handler, query=None, fields=None, slices=2, size=1000, scroll='5m'):
+        await self.es.sliced_scan(self.index, handler, query=query, fields=fields, slices=slices,
+                                  size=size, scroll=scroll)
+
+    async def profile(self, query):
+        return await self.es.profile(self.index, query)
+
+    @checkargs
+    async def find_first(self,
+                         queries: [s_or({}, type_of(Body))]):
+        for query in queries:
+            result = await self.query(query, just_one=True)
+            if result:
+                return result
+        return None
+
+    @checkargs
+    async def find_all(self,
+                       keyed_queries: {string: s_or({}, type_of(Body))},
+                       fields: nillable([string]) = None):
+        async with self.es.batch():
+            for key, query in keyed_queries.items():
+                await self.query(query, key=key, fields=fields, just_one=True, batch=True)
+            return await self.es.batch_query()
+
+    async def get_mappings(self):
+        return await self.es.get_mappings(self.index)
+
+    @checkargs
+    async def put_mappings(self, mappings: {}):
+        await self.es.put_mappings(self.index, mappings)
+
+    @checkargs
+    async def put_settings(self, settings: {}):
+        await self.es.put_settings(self.index, settings)
+
+    async def open(self):
+        await self.es.open(self.index)
+
+    async def close(self):
+        await self.es.close(self.index)
+
+    @checkargs
+    async def reindex(self, reindex_body: type_of(Reindex)):
+        await self.es.reindex(reindex_body)
+
+    @checkargs
+    async def explain(self, id: string, body: dictionary):
+        return await self.es.explain(self.index, id, body)
+
+    async def batch_get(self):
+        return await self.es.batch_get()
+
+    async def batch_write(self):
+        await self.es.batch_write()
+
+    async def batch_query(self):
+        return await self.es.batch_query()
+
+    def pending_writes(self):
+        return self.es.pending_writes()
+
+    async def flush_if_necessary(self, batch_size, on_write=None, on_error=None):
+        if self.pending_writes() >= batch_size:
+            try:
+                await self.batch_write()
+                if on_write:
+                    on_write()
+            except BulkIndexError as e:
+                if on_error:
+                    on_error(e)
+                else:
+                    raise e
+
+    async def clear_cache(self):
+        await self.es.clear_cache(self.index)
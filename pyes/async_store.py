@@ -0,0 +1,496 @@
+import asyncio
+import inspect
+from contextlib import asynccontextmanager
+
+from elasticsearch import AsyncElasticsearch, NotFoundError
+from elasticsearch.helpers import async_scan, BulkIndexError
+
+from pyes.bulk import DEFAULT_MAX_CHUNK_BYTES, DEFAULT_MSEARCH_CHUNK_SIZE, BulkStats, async_stream_bulk
+from pyes.query_builder import Body, Query, Slice
+from pyes.response import get_source, get_sources, get_id
+from pyes.store import Store, MultiWriteStore, MultiGetStore, MultiQueryStore, BatchScope, build_transform, \
+    batch_scopes, current_batch_store, response_filter_path, filtered_response
+from pyfunk.pyfunk import get, now, get_in, first, assoc, zipmap, identity, map_map
+from pyes.schema import checkargs, string
+from pyes.serializer import use_serializer
+
+
+class AsyncElasticsearchStore(Store):
+    """
+    The asyncio mirror of the ElasticsearchStore, built on an AsyncElasticsearch
+    client, every call is a coroutine
+    """
+
+    def __init__(self, es):
+        self.es = es
+        self.indices = es.indices
+
+    async def create(self, id, index, doc):
+        doc['created_time'] = now()
+        await self.es.create(id=id, index=index, body=doc)
+
+    async def upsert(self, id, index, doc):
+        doc['upsert_time'] = now()
+        body = {
+            'doc': doc,
+            'doc_as_upsert': True
+        }
+        await self.es.update(id=id, index=index, body=body)
+
+    async def update(self, id, index, doc):
+        doc['update_time'] = now()
+        body = {
+            'doc': doc
+        }
+        return await self.es.update(id=id, index=index, body=body)
+
+    async def index(self, id, index, doc):
+        return await self.es.index(id=id, index=index, body=doc)
+
+    async def script_update(self, id, index, script, params=None, initial=None):
+        script = {
+            'source': script
+        }
+        if params:
+            script['params'] = params
+        body = {
+            'script': script
+        }
+        if initial:
+            body['upsert'] = initial
+        return await self.es.update(id=id, index=index, body=body)
+
+    async def get(self, id, index, **params):
+        try:
+            result = await self.es.get(id=id, index=index, **params)
+            if get(result, 'found'):
+                return get_source(result)
+        except NotFoundError:
+            return None
+
+    async def multi_get(self, index, ids, **params):
+        response = await self.es.mget(body={'ids': ids}, index=index, **params)
+        return MultiGetStore.sources_by_key(map_map(get_id, identity, get(response, 'docs', [])))
+
+    async def delete(self, id, index):
+        return await self.es.delete(id=id, index=index)
+
+    async def delete_by_query(self, index, query):
+        await self.es.delete_by_query(index=index, body=Body().query(query).build())
+
+    async def query(self, index, query, key=None, transform=None, hits=True, just_one=False, include_id=False,
+                    in_place=False):
+        filter_path = response_filter_path(hits=hits)
+        if filter_path:
+            result = filtered_response(await self.es.search(index=index, body=query, filter_path=filter_path))
+        else:
+            result = await self.es.search(index=index, body=query)
+
+        store_transform = build_transform(transform, hits=hits, just_one=just_one, include_id=include_id,
+                                          in_place=in_place)
+
+        return store_transform(result)
+
+    async def count(self, index, query, key=None):
+        result = await self.es.count(index=index, body=query, filter_path='count')
+        return get(result, "count")
+
+    async def profile(self, index, query, no_source=True):
+        query = assoc(query, "profile", True)
+        if no_source:
+            query = assoc(query, "_source", "")
+        result = await self.es.search(index=index, body=query)
+        return get(result, "profile")
+
+    async def suggest(self, index, field, prefix, key=None, contexts=None):
+        suggest_key = "suggest-key"
+        results = await self.es.search(
+            index=index,
+            body=Body().suggest(suggest_key, field, prefix, contexts=contexts).build()
+        )
+        results = get_in(results, ['suggest', suggest_key])
+        options = get(first(results), 'options')
+        return get_sources(options)
+
+    async def refresh_index(self, index):
+        await self.indices.refresh(index=index)
+
+    async def reindex(self, reindex_body):
+        await self.es.reindex(body=reindex_body.build())
+
+    async def scan(self, index, query=None, size=1000, scroll='5m'):
+        if query is None:
+            query = Body().query(Query().match_all()).build()
+        async for hit in async_scan(self.es, query=query, index=index, size=size, scroll=scroll):
+            yield hit
+
+    async def sliced_scan(self, index, handler, query=None, fields=None,
+                          slices=2, size=1000, scroll='5m'):
+        """
+        Scans each slice concurrently on the event loop, `handler` may be a
+        plain function or a coroutine function
+        """
+        if query is None:
+            query = Query().match_all()
+
+        async def w_handler(slice_id):
+            sliced_query = Body()\
+                .query(query)\
+                .slice(Slice(slice_id, slices))\
+                .source(fields)\
+                .build()
+            async for hit in self.scan(index,
+                                       query=sliced_query,
+                                       size=size,
+                                       scroll=scroll):
+                result = handler(hit)
+                if inspect.isawaitable(result):
+                    await result
+
+        await asyncio.gather(*[w_handler(slice_id) for slice_id in range(0, slices)])
+
+    @checkargs
+    async def get_mappings(self, index: string):
+        return await self.indices.get_mapping(index=index)
+
+    @checkargs
+    async def put_mappings(self, index: string, mappings: {}):
+        body = {"properties": mappings}
+        await self.indices.put_mapping(index=index, body=body)
+
+    @checkargs
+    async def put_settings(self, index: string, settings: {}):
+        await self.indices.put_settings(index=index, body=settings)
+
+    @checkargs
+    async def open(self, index: string):
+        await self.indices.open(index=index)
+
+    @checkargs
+    async def close(self, index: string):
+        await self.indices.close(index=index)
+
+    async def explain(self, index, id, body):
+        return await self.es.explain(index=index, id=id, body=body)
+
+    async def clear_cache(self, index):
+        await self.indices.clear_cache(index=index)
+
+
+class AsyncMultiWriteStore(MultiWriteStore):
+    """
+    A MultiWriteStore whose `write` commits the pending actions over the
+    async client, applying the retry policy as the synchronous store does
+    """
+    async def write(self, es, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        stats = BulkStats()
+        to_commit = self.bulk_builder.drain()
+        if to_commit:
+            stats.failures = await async_stream_bulk(es, to_commit, chunk_size=chunk_size,
+                                                     max_chunk_bytes=max_chunk_bytes, stats=stats,
+                                                     retry_policy=self.retry_policy)
+        if stats.failures:
+            raise BulkIndexError("%i document(s) failed to index." % len(stats.failures), stats.failures)
+        return stats
+
+
+class AsyncMultiGetStore(MultiGetStore):
+    """
+    A MultiGetStore whose `get_all` awaits the mget
+    """
+    async def get_all(self, es):
+        ks, values = self.multiget.drain()
+        if values:
+            response = await es.mget(body={'docs': values})
+            return self.sources_by_key(zipmap(ks, get(response, 'docs')))
+        return {}
+
+
+class AsyncMultiQueryStore(MultiQueryStore):
+    """
+    A MultiQueryStore whose `query_all` awaits the msearch chunks, with at most
+    the query builder's `thread_count` in flight
+    """
+    async def query_all(self, es):
+        query_builder = self.query_builder
+        ks, search_array, transforms = query_builder.drain()
+        if not search_array:
+            return {}
+
+        params = query_builder.msearch_params()
+        semaphore = asyncio.Semaphore(query_builder.thread_count)
+
+        async def search_chunk(chunk_ks, chunk_array):
+            async with semaphore:
+                response = await es.msearch(body=chunk_array, **params)
+            return query_builder.transform_responses(chunk_ks, get(response, 'responses'), transforms)
+
+        returned_responses = {}
+        chunks = query_builder.chunks(ks, search_array)
+        for responses in await asyncio.gather(*[search_chunk(*chunk) for chunk in chunks]):
+            returned_responses.update(responses)
+        return returned_responses
+
+
+class AsyncBatchStore(Store):
+    """
+    The asyncio mirror of the BatchStore, registering an intent is immediate,
+    but the methods are coroutines so the AsyncMegaStore can await either store
+    """
+    def __init__(self, es, retry_policy=None, coalesce=False, msearch_chunk_size=DEFAULT_MSEARCH_CHUNK_SIZE,
+                 max_concurrent_searches=None):
+        self.multi_write_store = AsyncMultiWriteStore(retry_policy=retry_policy, coalesce=coalesce)
+        self.multi_get_store = AsyncMultiGetStore()
+        self.multi_query_store = AsyncMultiQueryStore(chunk_size=msearch_chunk_size,
+                                                      max_concurrent_searches=max_concurrent_searches)
+        self.es = es
+
+    async def create(self, id, index, doc):
+        self.multi_write_store.create(id, index, doc)
+
+    async def upsert(self, id, index, doc):
+        self.multi_write_store.upsert(id, index, doc)
+
+    async def update(self, id, index, doc):
+        self.multi_write_store.update(id, index, doc)
+
+    async def index(self, id, index, doc):
+        self.multi_write_store.index(id, index, doc)
+
+    async def script_update(self, id, index, script, params=None, initial=None):
+        self.multi_write_store.script_update(id, index, script, params=params, initial=initial)
+
+    async def get(self, id, index, **params):
+        self.multi_get_store.get(id, index, **params)
+
+    async def delete(self, id, index):
+        self.multi_write_store.delete(id, index)
+
+    async def query(self, index, query, key=None, transform=None, hits=True, just_one=False, include_id=False,
+                    in_place=False):
+        self.multi_query_store.query(index, query, key=key, transform=transform, hits=hits, just_one=just_one,
+                                     include_id=include_id, in_place=in_place)
+
+    async def count(self, index, query, key=None):
+        query['size'] = 0
+        query['track_total_hits'] = True
+        await self.query(index, query, key=key, hits=False,
+                         transform=lambda result: get_in(result, ['hits', 'total', 'value']))
+
+    async def suggest(self, index, field, prefix, key=None, contexts=None):
+        self.multi_query_store.suggest(index, field, prefix, key=key, contexts=contexts)
+
+    async def write(self, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        await self.multi_write_store.write(self.es, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes)
+
+    async def do_get(self):
+        return await self.multi_get_store.get_all(self.es)
+
+    async def do_query(self):
+        return await self.multi_query_store.query_all(self.es)
+
+    def pending_writes(self):
+        return self.multi_write_store.pending()
+
+    def eliminated_writes(self):
+        return self.multi_write_store.eliminated()
+
+    def pending_gets(self):
+        return self.multi_get_store.pending()
+
+    def pending_queries(self):
+        return self.multi_query_store.pending()
+
+
+class AsyncBatchScope(BatchScope):
+    """
+    The buffers of a single `async with store.batch()` block, private to the
+    task that opened it (and any tasks it spawns within the block)
+    """
+    async def write(self, size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        await self.batch_store.write(chunk_size=size, max_chunk_bytes=max_chunk_bytes)
+
+    async def get_all(self):
+        results = await self.batch_store.do_get()
+        self.gets.update(results)
+        return results
+
+    async def query_all(self):
+        results = await self.batch_store.do_query()
+        self.queries.update(results)
+        return results
+
+    async def flush(self):
+        if self.batch_store.pending_writes():
+            await self.write()
+        if self.batch_store.pending_gets():
+            await self.get_all()
+        if self.batch_store.pending_queries():
+            await self.query_all()
+
+
+class AsyncMegaStore(Store):
+    """
+    The asyncio mirror of the MegaStore, wrapping the AsyncElasticsearchStore
+    and the AsyncBatchStore with the same `batch` semantics. Every call is a
+    coroutine, batched calls simply register the intent, to be realized with
+    the `batch_write`, `batch_get` and `batch_query` coroutines
+    """
+    def __init__(self, es, serializer=None, retry_policy=None, coalesce_writes=False,
+                 msearch_chunk_size=DEFAULT_MSEARCH_CHUNK_SIZE, max_concurrent_searches=None):
+        if serializer is not None:
+            use_serializer(es, serializer)
+        self.es = es
+        self.retry_policy = retry_policy
+        self.coalesce_writes = coalesce_writes
+        self.msearch_chunk_size = msearch_chunk_size
+        self.max_concurrent_searches = max_concurrent_searches
+        self.elasticsearch_store = AsyncElasticsearchStore(es)
+        self.batch_store = self.new_batch_store()
+
+    def new_batch_store(self):
+        return AsyncBatchStore(self.es, retry_policy=self.retry_policy, coalesce=self.coalesce_writes,
+                               msearch_chunk_size=self.msearch_chunk_size,
+                               max_concurrent_searches=self.max_concurrent_searches)
+
+    def get_batch_store(self):
+        return current_batch_store(self, self.batch_store)
+
+    def get_store(self, batch):
+        if batch:
+            return self.get_batch_store()
+        else:
+            return self.elasticsearch_store
+
+    @asynccontextmanager
+    async def batch(self, flush=True):
+        """
+        Opens a batch scope with its own buffers for the current task, scopes
+        nest, and anything still pending is flushed when the block exits cleanly
+        """
+        scope = AsyncBatchScope(self, self.new_batch_store())
+        token = batch_scopes.set(batch_scopes.get() + (scope,))
+        try:
+            yield scope
+            if flush:
+                await scope.flush()
+        finally:
+            batch_scopes.reset(token)
+
+    async def create(self, id, index, doc, batch=False):
+        await self.get_store(batch).create(id, index, doc)
+
+    async def upsert(self, id, index, doc, batch=False):
+        await self.get_store(batch).upsert(id, index, doc)
+
+    async def update(self, id, index, doc, batch=False):
+        await self.get_store(batch).update(id, index, doc)
+
+    async def index(self, id, index, doc, batch=False):
+        await self.get_store(batch).index(id, index, doc)
+
+    async def script_update(self, id, index, script, params=None, initial=None, batch=False):
+        await self.get_store(batch).script_update(id, index, script, params=params, initial=initial)
+
+    async def get(self, id, index, batch=False, **params):
+        return await self.get_store(batch).get(id, index, **params)
+
+    async def multi_get(self, index, ids, **params):
+        return await self.elasticsearch_store.multi_get(index, ids, **params)
+
+    async def delete(self, id, index, batch=False):
+        await self.get_store(batch).delete(id, index)
+
+    async def delete_by_query(self, index, query):
+        await self.get_store(False).delete_by_query(index, query)
+
+    async def query(self, index, query, key=None, batch=False, transform=None, hits=True,
+                    just_one=False, include_id=False, in_place=False):
+        if isinstance(query, Body):
+            query = query.build()
+        return await self.get_store(batch).query(index, query, key=key, transform=transform, hits=hits,
+                                                 just_one=just_one, include_id=include_id, in_place=in_place)
+
+    async def count(self, index, query, key=None, batch=False):
+        if isinstance(query, Query):
+            query = query.build()
+
+        query = {'query': query}
+
+        return await self.get_store(batch).count(index, query, key=key)
+
+    async def profile(self, index, query, no_source=True):
+        return await self.get_store(False).profile(index, query, no_source=no_source)
+
+    async def suggest(self, index, field, prefix, key=None, batch=False, contexts=None):
+        return await self.get_store(batch).suggest(index, field, prefix, key=key, contexts=contexts)
+
+    async def batch_write(self, size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        await self.get_batch_store().write(chunk_size=size, max_chunk_bytes=max_chunk_bytes)
+
+    async def batch_get(self):
+        return await self.get_batch_store().do_get()
+
+    async def batch_query(self):
+        return await self.get_batch_store().do_query()
+
+    async def refresh_index(self, index):
+        await self.get_store(False).refresh_index(index)
+
+    async def reindex(self, reindex_body):
+        await self.get_store(False).reindex(reindex_body)
+
+    def scan(self, index, query=None, size=1000, scroll='5m'):
+        return self.elasticsearch_store.scan(index, query=query, size=size, scroll=scroll)
+
+    async def sliced_scan(self, index, handler, query=None, fields=None,
+                          slices=2, size=1000, scroll='5m'):
+        await self.elasticsearch_store.sliced_scan(index, handler,
+                                                   query=query,
+                                                   fields=fields,
+                                                   slices=slices,
+                                                   size=size,
+                                                   scroll=scroll)
+
+    async def get_mappings(self, index):
+        return await self.elasticsearch_store.get_mappings(index)
+
+    async def put_mappings(self, index, mappings):
+        await self.elasticsearch_store.put_mappings(index, mappings)
+
+    async def put_settings(self, index, settings):
+        await self.elasticsearch_store.put_settings(index, settings)
+
+    async def open(self, index):
+        await self.elasticsearch_store.open(index)
+
+    async def close(self, index):
+        await self.elasticsearch_store.close(index)
+
+    async def explain(self, index, id, body):
+        return await self.elasticsearch_store.explain(index, id, body)
+
+    def pending_writes(self):
+        return self.get_batch_store().pending_writes()
+
+    def eliminated_writes(self):
+        return self.get_batch_store().eliminated_writes()
+
+    def pending_gets(self):
+        return self.get_batch_store().pending_gets()
+
+    def pending_queries(self):
+        return self.get_batch_store().pending_queries()
+
+    async def clear_cache(self, index):
+        return await self.elasticsearch_store.clear_cache(index)
+
+    async def shutdown(self):
+        await self.es.close()
+
+
+def new_async_mega_store(hostname="localhost", serializer=None, retry_policy=None, coalesce_writes=False,
+                         msearch_chunk_size=DEFAULT_MSEARCH_CHUNK_SIZE, max_concurrent_searches=None):
+    es = AsyncElasticsearch(hostname)
+    return AsyncMegaStore(es, serializer=serializer, retry_policy=retry_policy, coalesce_writes=coalesce_writes,
+                          msearch_chunk_size=msearch_chunk_size, max_concurrent_searches=max_concurrent_searches)
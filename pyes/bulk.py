@@ -1,14 +1,369 @@
+import asyncio
+import json
+import logging
+import random
 import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from elasticsearch.helpers import parallel_bulk
+from elasticsearch import TransportError
+from elasticsearch.helpers import expand_action, BulkIndexError
 from pyes.response import get_hits
-from pyfunk.pyfunk import get, zipmap, count
+from pyfunk.pyfunk import get, zipmap, count, first
 
+logger = logging.getLogger(__name__)
 
-class BulkBuilder(object):
+# Bulk requests are also capped by serialized size, ~10MB sits comfortably
+# within the 5-15MB range clusters handle best, well under http.max_content_length
+DEFAULT_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+
+# The number of queries sent in a single msearch, larger batches are split
+# into chunks dispatched concurrently
+DEFAULT_MSEARCH_CHUNK_SIZE = 100
+
+
+def estimate_size(action):
+    return len(json.dumps(action, default=str))
+
+
+class BulkStats(object):
+    """
+    Aggregate counts for a streamed bulk commit, `took` is the sum of the
+    server side time of each bulk request in milliseconds, and `retried` the
+    number of item resubmissions. A `commit` keeps the items that failed
+    permanently on `failures`, and the actions they came from on
+    `failed_actions`
+    """
     def __init__(self):
+        self.failures = []
+        self.failed_actions = []
+        self.ok = 0
+        self.failed = 0
+        self.retried = 0
+        self.bytes = 0
+        self.took = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def record_request(self, size, took):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.took += took
+
+    def record_items(self, ok=0, failed=0, retried=0, failed_actions=()):
+        with self.lock:
+            self.ok += ok
+            self.failed += failed
+            self.retried += retried
+            self.failed_actions.extend(failed_actions)
+
+    def as_dict(self):
+        return {
+            'ok': self.ok,
+            'failed': self.failed,
+            'retried': self.retried,
+            'bytes': self.bytes,
+            'took': self.took,
+            'requests': self.requests
+        }
+
+    def __repr__(self):
+        return "BulkStats({0})".format(self.as_dict())
+
+
+class RetryPolicy(object):
+    """
+    Resubmits bulk items rejected with a retryable status, 429 (a saturated
+    write thread pool) and 503 by default, backing off exponentially from
+    `initial_backoff` up to `max_backoff` seconds, with full jitter
+    """
+    def __init__(self, max_retries=5, initial_backoff=0.5, max_backoff=30, retry_statuses=(429, 503), jitter=True):
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        self.jitter = jitter
+
+    def should_retry(self, status, attempt):
+        return status in self.retry_statuses and attempt < self.max_retries
+
+    def backoff(self, attempt):
+        delay = min(self.max_backoff, self.initial_backoff * (2 ** attempt))
+        if self.jitter:
+            return random.uniform(0, delay)
+        return delay
+
+    def wait(self, attempt):
+        time.sleep(self.backoff(attempt))
+
+
+def serialize_action(action, serializer):
+    action_line, data = expand_action(action)
+    lines = [serializer.dumps(action_line)]
+    if data is not None:
+        lines.append(serializer.dumps(data))
+    return lines
+
+
+def lines_size(lines):
+    return sum(len(line.encode("utf-8")) + 1 for line in lines)
+
+
+def chunk_actions(actions, serializer, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+    """
+    Serializes each action once, yielding chunks as `(actions, lines, size)`
+    that hold at most `chunk_size` actions and, unless a single action is
+    bigger on its own, at most `max_chunk_bytes` of payload. Only one chunk
+    is held at a time
+    """
+    chunk = []
+    lines = []
+    size = 0
+    for action in actions:
+        action_lines = serialize_action(action, serializer)
+        action_size = lines_size(action_lines)
+        if chunk and max_chunk_bytes and size + action_size > max_chunk_bytes:
+            yield chunk, lines, size
+            chunk = []
+            lines = []
+            size = 0
+        chunk.append(action)
+        lines.extend(action_lines)
+        size += action_size
+        if count(chunk) >= chunk_size:
+            yield chunk, lines, size
+            chunk = []
+            lines = []
+            size = 0
+    if chunk:
+        yield chunk, lines, size
+
+
+def serialize_chunk(chunk, serializer):
+    lines = [line for action in chunk for line in serialize_action(action, serializer)]
+    return lines, lines_size(lines)
+
+
+def split_items(chunk, response, stats, failures, retry_policy=None, attempt=0):
+    """
+    Records the outcome of each item of a bulk response, adding the permanent
+    failures to `failures` and returning the actions to resubmit
+    """
+    ok = 0
+    failed = []
+    retry = []
+    for action, item in zip(chunk, get(response, 'items', [])):
+        op_type, result = first(item.items())
+        status = get(result, 'status', 500)
+        if 200 <= status < 300:
+            ok += 1
+        elif retry_policy is not None and retry_policy.should_retry(status, attempt):
+            retry.append(action)
+        else:
+            failed.append(action)
+            failures.append({op_type: result})
+    stats.record_items(ok=ok, failed=count(failed), retried=count(retry), failed_actions=failed)
+    return retry
+
+
+def commit_chunk(es, chunk, lines, size, stats, retry_policy=None):
+    """
+    Sends one chunk, returning the items that failed permanently. With a
+    retry policy, only the items rejected with a retryable status are
+    resubmitted, after backing off
+    """
+    failures = []
+    attempt = 0
+    while chunk:
+        try:
+            response = es.bulk(body="\n".join(lines) + "\n")
+        except TransportError as e:
+            if retry_policy is not None and retry_policy.should_retry(e.status_code, attempt):
+                stats.record_items(retried=count(chunk))
+                retry_policy.wait(attempt)
+                attempt += 1
+                continue
+            raise
+
+        stats.record_request(size, get(response, 'took', 0))
+        chunk = split_items(chunk, response, stats, failures, retry_policy=retry_policy, attempt=attempt)
+        if chunk:
+            lines, size = serialize_chunk(chunk, es.transport.serializer)
+            retry_policy.wait(attempt)
+            attempt += 1
+    return failures
+
+
+async def async_commit_chunk(es, chunk, lines, size, stats, retry_policy=None):
+    """
+    The asyncio mirror of `commit_chunk`, for an AsyncElasticsearch client
+    """
+    failures = []
+    attempt = 0
+    while chunk:
+        try:
+            response = await es.bulk(body="\n".join(lines) + "\n")
+        except TransportError as e:
+            if retry_policy is not None and retry_policy.should_retry(e.status_code, attempt):
+                stats.record_items(retried=count(chunk))
+                await asyncio.sleep(retry_policy.backoff(attempt))
+                attempt += 1
+                continue
+            raise
+
+        stats.record_request(size, get(response, 'took', 0))
+        chunk = split_items(chunk, response, stats, failures, retry_policy=retry_policy, attempt=attempt)
+        if chunk:
+            lines, size = serialize_chunk(chunk, es.transport.serializer)
+            await asyncio.sleep(retry_policy.backoff(attempt))
+            attempt += 1
+    return failures
+
+
+async def async_stream_bulk(es, actions, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, stats=None,
+                            retry_policy=None):
+    """
+    Commits actions chunk by chunk over an AsyncElasticsearch client, with the
+    same retry policy handling as `stream_bulk`, returning the permanent
+    failures
+    """
+    if stats is None:
+        stats = BulkStats()
+    failures = []
+    for chunk, lines, size in chunk_actions(actions, es.transport.serializer, chunk_size=chunk_size,
+                                            max_chunk_bytes=max_chunk_bytes):
+        failures.extend(await async_commit_chunk(es, chunk, lines, size, stats, retry_policy=retry_policy))
+    return failures
+
+
+def stream_bulk(es, actions, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, stats=None,
+                retry_policy=None, thread_count=1):
+    """
+    Commits any iterable of actions chunk by chunk, yielding only the items
+    that failed permanently, with the totals kept on `stats`. With a
+    `thread_count` above one, chunks are sent concurrently with at most
+    twice that many chunks held at once
+    """
+    if stats is None:
+        stats = BulkStats()
+    chunks = chunk_actions(actions, es.transport.serializer, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes)
+
+    if thread_count <= 1:
+        for chunk, lines, size in chunks:
+            for failure in commit_chunk(es, chunk, lines, size, stats, retry_policy=retry_policy):
+                yield failure
+        return
+
+    with ThreadPoolExecutor(max_workers=thread_count) as pool:
+        in_flight = deque()
+        for chunk, lines, size in chunks:
+            in_flight.append(pool.submit(commit_chunk, es, chunk, lines, size, stats, retry_policy))
+            if count(in_flight) >= thread_count * 2:
+                for failure in in_flight.popleft().result():
+                    yield failure
+        while in_flight:
+            for failure in in_flight.popleft().result():
+                yield failure
+
+
+def deep_merge(a, b):
+    """
+    Merges partial document `b` over `a` the way elasticsearch applies a
+    partial update, objects merge recursively, anything else is replaced
+    """
+    merged = dict(a)
+    for k, v in b.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = deep_merge(merged[k], v)
+        else:
+            merged[k] = v
+    return merged
+
+
+def is_partial_update(action):
+    return action['_op_type'] == 'update' and 'doc' in action
+
+
+def merge_actions(previous, action):
+    """
+    Folds `action` into the `previous` action on the same document where the
+    result is equivalent, returning None when they can't be merged
+    """
+    if get(previous, '_parent') != get(action, '_parent') or not is_partial_update(action):
+        return None
+
+    if previous['_op_type'] == 'index':
+        return dict(previous, _source=deep_merge(previous['_source'], action['doc']))
+
+    if is_partial_update(previous):
+        # An update followed by an upsert differs from a single upsert when the
+        # document doesn't exist yet, so only merge into a matching or upserting action
+        if get(action, 'doc_as_upsert') and not get(previous, 'doc_as_upsert'):
+            return None
+        return dict(previous, doc=deep_merge(previous['doc'], action['doc']))
+
+    return None
+
+
+class BulkBuilder(object):
+    """
+    Collects bulk actions to be committed together. With `coalesce`, repeated
+    operations on the same document are folded together as they are added,
+    consecutive partial updates merge into one action, and a later `delete`
+    or `index` drops everything before it, with `eliminated` counting the
+    actions saved. A `delete` keeps a `create` from the same batch before it,
+    as the delete of a document that was never committed would fail
+    """
+    def __init__(self, coalesce=False):
         self.bulks = []
         self.lock = threading.Lock()
+        self.coalesce = coalesce
+        self.positions = {}
+        self.live = 0
+        self.eliminated = 0
+
+    def add(self, action):
+        with self.lock:
+            self.append(action)
+
+    def append(self, action):
+        if not self.coalesce or get(action, '_id') is None:
+            self.bulks.append(action)
+            self.live += 1
+            return
+
+        key = (action['_index'], action['_id'])
+        positions = self.positions.get(key, [])
+        if positions:
+            if action['_op_type'] in ('delete', 'index'):
+                kept = []
+                if action['_op_type'] == 'delete' and self.bulks[positions[0]]['_op_type'] == 'create':
+                    kept, positions = positions[:1], positions[1:]
+                for position in positions:
+                    self.bulks[position] = None
+                self.live -= count(positions)
+                self.eliminated += count(positions)
+                positions = kept
+            else:
+                merged = merge_actions(self.bulks[positions[-1]], action)
+                if merged is not None:
+                    self.bulks[positions[-1]] = merged
+                    self.eliminated += 1
+                    return
+
+        self.bulks.append(action)
+        self.live += 1
+        positions.append(count(self.bulks) - 1)
+        self.positions[key] = positions
+
+    def take(self):
+        to_commit = self.bulks
+        if self.coalesce:
+            to_commit = [action for action in to_commit if action is not None]
+        self.reset()
+        return to_commit
 
     def index(self, id, index, doc, parent=None):
         action = {
@@ -19,7 +374,7 @@ class BulkBuilder(object):
         }
         if parent is not None:
             action['_parent'] = parent
-        self.bulks.append(action)
+        self.add(action)
 
     def create(self, id, index, doc, parent=None):
         action = {
@@ -30,7 +385,7 @@ class BulkBuilder(object):
         }
         if parent is not None:
             action['_parent'] = parent
-        self.bulks.append(action)
+        self.add(action)
 
     def script_update(self, id, index, script, initial=None, parent=None):
         doc = {
@@ -46,7 +401,7 @@ class BulkBuilder(object):
         }
         if parent is not None:
             action['_parent'] = parent
-        self.bulks.append(action)
+        self.add(action)
 
     def update(self, id, index, doc, parent=None):
         action = {
@@ -57,7 +412,7 @@ class BulkBuilder(object):
         }
         if parent is not None:
             action['_parent'] = parent
-        self.bulks.append(action)
+        self.add(action)
 
     def upsert(self, id, index, doc, parent=None):
         action = {
@@ -69,7 +424,7 @@ class BulkBuilder(object):
         }
         if parent is not None:
             action['_parent'] = parent
-        self.bulks.append(action)
+        self.add(action)
 
     def delete(self, id, index):
         action = {
@@ -77,64 +432,307 @@ class BulkBuilder(object):
             '_index': index,
             '_id': id,
         }
-        self.bulks.append(action)
+        self.add(action)
 
-    def commit(self, es, thread_count=4, chunk_size=500):
+    def drain(self):
         with self.lock:
-            to_commit = self.bulks
-            self.reset()
+            return self.take()
+
+    def commit(self, es, thread_count=4, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+               retry_policy=None, raise_on_error=True):
+        """
+        Commits the pending actions over `thread_count` threads, returning the
+        BulkStats, with the permanently failed items on `failures`. With a
+        retry policy, rejected items are retried with backoff first. Unless
+        `raise_on_error` is off, a BulkIndexError lists the permanent failures
+        """
+        return self.commit_actions(es, self.drain(), thread_count=thread_count, chunk_size=chunk_size,
+                                   max_chunk_bytes=max_chunk_bytes, retry_policy=retry_policy,
+                                   raise_on_error=raise_on_error)
+
+    @staticmethod
+    def commit_actions(es, to_commit, thread_count=4, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                       retry_policy=None, raise_on_error=True):
+        stats = BulkStats()
         if to_commit:
-            g = parallel_bulk(es, to_commit, thread_count=thread_count, chunk_size=chunk_size)
-            return [x for x in g]
-        return []
+            stats.failures = list(stream_bulk(es, to_commit, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                              stats=stats, retry_policy=retry_policy, thread_count=thread_count))
+        if stats.failures and raise_on_error:
+            raise BulkIndexError("%i document(s) failed to index." % count(stats.failures), stats.failures)
+        return stats
+
+    def stream_commit(self, es, actions=None, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                      on_failure=None, retry_policy=None):
+        """
+        Streams `actions`, or the pending actions when none are given, to
+        elasticsearch without materializing the per item results. Permanently
+        failed items are handed to `on_failure`, and the aggregate BulkStats
+        returned
+        """
+        if actions is None:
+            actions = self.drain_iter()
+        stats = BulkStats()
+        for failure in stream_bulk(es, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                   stats=stats, retry_policy=retry_policy):
+            if on_failure:
+                on_failure(failure)
+        return stats
+
+    def drain_iter(self):
+        to_commit = self.drain()
+        to_commit.reverse()
+        while to_commit:
+            yield to_commit.pop()
 
     def reset(self):
         self.bulks = []
+        self.positions = {}
+        self.live = 0
 
     def count(self):
-        return count(self.bulks)
+        return self.live
+
+    def eliminated_count(self):
+        return self.eliminated
+
+
+class AutoFlushingBulkBuilder(BulkBuilder):
+    """
+    A BulkBuilder that commits itself on a background flusher thread as soon
+    as the pending actions reach `max_actions`, their estimated payload
+    reaches `max_bytes`, or the oldest pending action is `max_age` seconds old.
+    If `max_pending` is set, adding blocks while that many actions are waiting,
+    bounding memory when the cluster can't keep up, reaching it also triggers
+    a flush. A failed flush hands the error and the actions that failed to
+    `on_error(error, actions)`, so they can be retried or recorded: the items
+    a BulkIndexError reports when only some failed, every action of the flush
+    when the request itself failed
+    """
+    def __init__(self, es, max_actions=500, max_bytes=None, max_age=1.0, max_pending=None,
+                 thread_count=4, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                 retry_policy=None, coalesce=False, on_flush=None, on_error=None):
+        for name, value in [('max_actions', max_actions), ('max_bytes', max_bytes), ('max_age', max_age),
+                            ('max_pending', max_pending)]:
+            if value is not None and value <= 0:
+                raise ValueError("{0} must be positive, got {1}".format(name, value))
+        super().__init__(coalesce=coalesce)
+        self.es = es
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.thread_count = thread_count
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.retry_policy = retry_policy
+        self.on_flush = on_flush
+        self.on_error = on_error
+        self.pending_bytes = 0
+        self.oldest = None
+        self.condition = threading.Condition(self.lock)
+        self.running = False
+        self.flusher = None
+
+    def add(self, action):
+        size = estimate_size(action) if self.max_bytes else 0
+        with self.condition:
+            while self.running and self.at_capacity():
+                # Being at capacity makes a flush due, so the flusher frees room
+                self.condition.notify_all()
+                self.condition.wait()
+            self.append(action)
+            self.pending_bytes += size
+            if self.oldest is None:
+                # The flusher idles without a timeout while empty, so wake it
+                # to start timing the new oldest action
+                self.oldest = time.monotonic()
+                self.condition.notify_all()
+            elif self.is_full():
+                self.condition.notify_all()
+
+    def drain(self):
+        with self.condition:
+            to_commit = self.take()
+            self.condition.notify_all()
+        return to_commit
+
+    def reset(self):
+        super().reset()
+        self.pending_bytes = 0
+        self.oldest = None
+
+    def at_capacity(self):
+        return self.max_pending is not None and self.count() >= self.max_pending
+
+    def is_full(self):
+        return (self.max_actions is not None and self.count() >= self.max_actions) or \
+               (self.max_bytes is not None and self.pending_bytes >= self.max_bytes) or \
+               self.at_capacity()
+
+    def age(self):
+        if self.oldest is None:
+            return 0
+        return time.monotonic() - self.oldest
+
+    def is_due(self):
+        return self.is_full() or (self.max_age is not None and self.oldest is not None and self.age() >= self.max_age)
+
+    def time_to_due(self):
+        if self.max_age is None or self.oldest is None:
+            return None
+        return max(self.max_age - self.age(), 0)
+
+    def flush(self):
+        to_commit = self.drain()
+        try:
+            results = self.commit_actions(self.es, to_commit, thread_count=self.thread_count,
+                                          chunk_size=self.chunk_size, max_chunk_bytes=self.max_chunk_bytes,
+                                          retry_policy=self.retry_policy, raise_on_error=False)
+        except Exception as e:
+            self.failed(e, to_commit)
+            return None
+        if results.failures:
+            # only the failed items, the others are committed and must not be applied again
+            self.failed(BulkIndexError("%i document(s) failed to index." % count(results.failures),
+                                       results.failures),
+                        results.failed_actions)
+            return None
+        if self.on_flush:
+            self.on_flush(results)
+        return results
+
+    def failed(self, e, actions):
+        if self.on_error:
+            self.on_error(e, actions)
+        else:
+            logger.error("Auto flush of %i bulk actions failed: %s", count(actions), e)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.is_due():
+                    self.condition.wait(timeout=self.time_to_due())
+                if not self.running:
+                    return
+            self.flush()
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return self
+            self.running = True
+        self.flusher = threading.Thread(target=self.run, name="bulk-flusher", daemon=True)
+        self.flusher.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the flusher thread, committing anything still pending
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        return self.flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
 
 
 class QueryBuilder(object):
-    def __init__(self):
+    """
+    Collects keyed queries to be run with msearch, `search` sends them in
+    chunks of `chunk_size`, with up to `thread_count` msearch requests in
+    flight, each passing `max_concurrent_searches` on to elasticsearch
+    """
+    def __init__(self, chunk_size=DEFAULT_MSEARCH_CHUNK_SIZE, max_concurrent_searches=None, thread_count=4):
         self.queries = {}
         self.transforms = {}
+        self.chunk_size = chunk_size
+        self.max_concurrent_searches = max_concurrent_searches
+        self.thread_count = thread_count
+        self.lock = threading.Lock()
 
     def query(self, query_key, index, query, transform=get_hits):
         command = {
             'index': index,
         }
 
-        self.transforms[query_key] = transform
-
-        self.queries[query_key] = [command, query]
+        with self.lock:
+            self.transforms[query_key] = transform
+            self.queries[query_key] = [command, query]
 
-    def search(self, es):
-        ks = self.queries.keys()
-        values = [self.queries[k] for k in ks]
+    def drain(self):
+        with self.lock:
+            queries = self.queries
+            transforms = self.transforms
+            self.reset()
 
+        ks = list(queries.keys())
         search_array = []
-        for value in values:
-            search_array.extend(value)
+        for k in ks:
+            search_array.extend(queries[k])
+
+        return ks, search_array, transforms
+
+    def chunks(self, ks, search_array):
+        """
+        Splits drained queries into `(ks, search_array)` pairs of at most
+        `chunk_size` queries each
+        """
+        size = self.chunk_size or max(count(ks), 1)
+        return [(ks[i:i + size], search_array[i * 2:(i + size) * 2]) for i in range(0, count(ks), size)]
+
+    def msearch_params(self):
+        if self.max_concurrent_searches:
+            return {'max_concurrent_searches': self.max_concurrent_searches}
+        return {}
 
+    @staticmethod
+    def transform_responses(ks, responses, transforms):
         returned_responses = {}
+        responses_by_key = zipmap(ks, responses)
+
+        if responses_by_key:
+            for k, response in responses_by_key.items():
+                transform = get(transforms, k)
+                if transform:
+                    returned_responses[k] = transform(response)
+                else:
+                    returned_responses[k] = response
+        return returned_responses
 
-        if search_array:
-            responses = get(es.msearch(body=search_array), 'responses')
-            responses_by_key = zipmap(ks, responses)
-
-            if responses_by_key:
-                for k, response in responses_by_key.items():
-                    transform = get(self.transforms, k)
-                    if transform:
-                        returned_responses[k] = transform(response)
-                    else:
-                        returned_responses[k] = response
-        self.reset()
+    def search(self, es):
+        ks, search_array, transforms = self.drain()
+
+        if not search_array:
+            return {}
+
+        params = self.msearch_params()
+
+        def search_chunk(chunk):
+            chunk_ks, chunk_array = chunk
+            responses = get(es.msearch(body=chunk_array, **params), 'responses')
+            return self.transform_responses(chunk_ks, responses, transforms)
+
+        chunks = self.chunks(ks, search_array)
+        if count(chunks) == 1:
+            return search_chunk(first(chunks))
+
+        returned_responses = {}
+        with ThreadPoolExecutor(max_workers=min(self.thread_count, count(chunks))) as pool:
+            for responses in pool.map(search_chunk, chunks):
+                returned_responses.update(responses)
         return returned_responses
 
     def reset(self):
         self.queries = {}
+        self.transforms = {}
 
     def count(self):
         return count(self.queries)
@@ -143,6 +741,7 @@ class QueryBuilder(object):
 class MultiGet(object):
     def __init__(self):
         self.gets = {}
+        self.lock = threading.Lock()
 
     def get(self, key, index, id, parent=None, **params):
         get = {
@@ -154,19 +753,24 @@ class MultiGet(object):
         if parent:
             get["_parent"] = parent
 
-        self.gets[key] = get
+        with self.lock:
+            self.gets[key] = get
 
     def reset(self):
         self.gets = {}
 
+    def drain(self):
+        with self.lock:
+            gets = self.gets
+            self.reset()
+        ks = list(gets.keys())
+        return ks, [gets[k] for k in ks]
+
     def multiget(self, es):
-        ks = self.gets.keys()
-        values = [self.gets[k] for k in ks]
+        ks, values = self.drain()
         if values:
             response = es.mget(body={'docs': values})
-            self.reset()
             return zipmap(ks, get(response, 'docs'))
-        self.reset()
         return {}
 
     def count(self):
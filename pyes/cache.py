@@ -0,0 +1,203 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from pyes.bulk import estimate_size
+
+
+def fingerprint(body):
+    """
+    A stable digest of a request body, independent of key order
+    """
+    canonical = json.dumps(body, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    A bounded LRU, entries expire `ttl` seconds after they were stored. The
+    cache is capped at `max_entries`, and at `max_bytes` of serialized values
+    if set, evicting the least recently used first. Values are copied in and
+    out, so callers can't mutate cached values. None values aren't stored,
+    unless `caches_none`
+    """
+    caches_none = False
+
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        The cached value for `key`, or `default` on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entity, size, expires = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(entity)
+                self.remove(key)
+            self.misses += 1
+            return default
+
+    def get_many(self, keys):
+        """
+        The cached values for `keys`, with the keys that missed
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            entity = self.get(key)
+            if entity is None:
+                missing.append(key)
+            else:
+                found[key] = entity
+        return found, missing
+
+    def put(self, key, value, admit=None):
+        """
+        Stores `value`, unless `admit`, checked under the cache's lock, refuses it
+        """
+        if value is None and not self.caches_none:
+            return
+        size = estimate_size(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self.lock:
+            if admit is not None and not admit():
+                return
+            self.remove(key)
+            self.entries[key] = (copy.deepcopy(value), size, time.monotonic() + self.ttl)
+            self.bytes += size
+            self.stored(key)
+            while self.entries and (len(self.entries) > self.max_entries or
+                                    (self.max_bytes and self.bytes > self.max_bytes)):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+            self.removed(key)
+
+    def stored(self, key):
+        pass
+
+    def removed(self, key):
+        pass
+
+    def invalidate(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.bytes = 0
+
+    def count(self):
+        return len(self.entries)
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.bytes
+        }
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, self.as_dict())
+
+
+class EntityCache(LRUCache):
+    """
+    An LRU of entities by id, for the ESCrudService
+    """
+    pass
+
+
+class QueryCache(LRUCache):
+    """
+    An LRU of query results for the MegaStore, keyed by index, a fingerprint
+    of the request body and the transform options, so it can be invalidated
+    by index as the store writes to or refreshes it. Invalidation goes by the
+    index name as given, so only queries of a concrete index should be cached.
+    Each invalidation moves the index on a generation, and a result fetched
+    across one is not stored, being possibly older than the write. None
+    results, such as a `just_one` query matching nothing, are cached too
+    """
+    caches_none = True
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=30):
+        super().__init__(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        self.keys_by_index = {}
+        self.generations = {}
+        self.clears = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(index, body, *options):
+        return (index, fingerprint(body)) + options
+
+    def stored(self, key):
+        self.keys_by_index.setdefault(key[0], set()).add(key)
+
+    def removed(self, key):
+        keys = self.keys_by_index.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_index[key[0]]
+
+    def generation(self, index):
+        """
+        The index's generation, to be given back to `put_if_current` along
+        with the result of a query started now
+        """
+        with self.lock:
+            return self.current_generation(index)
+
+    def current_generation(self, index):
+        return self.clears, self.generations.get(index, 0)
+
+    def put_if_current(self, key, value, generation):
+        self.put(key, value, admit=lambda: self.current_generation(key[0]) == generation)
+
+    def invalidate_index(self, index):
+        with self.lock:
+            self.invalidations += 1
+            self.generations[index] = self.generations.get(index, 0) + 1
+            for key in list(self.keys_by_index.get(index, ())):
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.keys_by_index = {}
+            self.clears += 1
+            self.bytes = 0
+
+    def as_dict(self):
+        return {
+            **super().as_dict(),
+            'invalidations': self.invalidations
+        }
@@ -0,0 +1,110 @@
+from pyes.response import get_hits
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MISSING = object()
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("Columnar extraction requires numpy to be installed")
+
+
+def source_value(source, path):
+    if path in source:
+        return source[path]
+    value = source
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+
+def field_value(hit, path):
+    """
+    The value at a dotted path of a hit's `_source`, falling back on its
+    `fields`, where `docvalue_fields` and stored fields are returned as
+    single valued lists
+    """
+    value = source_value(hit.get('_source') or {}, path)
+    if value is MISSING:
+        values = (hit.get('fields') or {}).get(path)
+        if not values:
+            return MISSING
+        value = values[0] if len(values) == 1 else values
+    return value
+
+
+def infer_dtype(values):
+    kinds = {type(value) for value in values if value is not MISSING and value is not None}
+    if not kinds:
+        return np.float64
+    if kinds == {bool}:
+        return np.bool_
+    if kinds == {int}:
+        return np.int64
+    if kinds <= {int, float}:
+        return np.float64
+    return object
+
+
+def to_column(values, dtype=None):
+    """
+    A masked array of `values`. Object columns hold each value as is, lists
+    of a multi valued field included, typed columns only take single values
+    """
+    mask = np.fromiter((value is MISSING or value is None for value in values), dtype=np.bool_, count=len(values))
+    dtype = np.dtype(dtype or infer_dtype(values))
+    if dtype == object:
+        data = np.empty(len(values), dtype=object)
+        for i, (value, missing) in enumerate(zip(values, mask)):
+            data[i] = None if missing else value
+    else:
+        # a zero of the dtype, as datetimes have no integer zero without a unit
+        fill = np.zeros(1, dtype)[0]
+        data = np.array([fill if missing else value for value, missing in zip(values, mask)], dtype=dtype)
+        if data.ndim != 1:
+            raise ValueError("A {0} column needs single valued fields, use an object column for multi "
+                             "valued ones".format(dtype))
+    return np.ma.MaskedArray(data, mask=mask)
+
+
+def extract_columns(hits, fields, dtypes=None):
+    """
+    Pulls `fields` out of a page of hits into a masked NumPy array per field,
+    masked where a hit has no value. Dtypes are inferred (bool, int64, float64
+    or object) unless given in `dtypes` by field
+    """
+    require_numpy()
+    dtypes = dtypes or {}
+    return {field: to_column([field_value(hit, field) for hit in hits], dtypes.get(field))
+            for field in fields}
+
+
+def columns_from_response(response, fields, dtypes=None):
+    return extract_columns(get_hits(response), fields, dtypes=dtypes)
+
+
+def iterate_columns(pages, fields, dtypes=None):
+    """
+    Yields the columns of each page of hits, as yielded by `batch_scan` or
+    `scan_pages`
+    """
+    for hits in pages:
+        yield extract_columns(hits, fields, dtypes=dtypes)
+
+
+def concat_columns(column_pages):
+    """
+    Joins the columns of several pages into one array per field
+    """
+    require_numpy()
+    joined = {}
+    for columns in column_pages:
+        for field, column in columns.items():
+            joined.setdefault(field, []).append(column)
+    return {field: np.ma.concatenate(columns) for field, columns in joined.items()}
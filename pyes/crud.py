@@ -1,38 +1,129 @@
+import copy
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from elasticsearch.helpers import BulkIndexError
 
-from pyes.query_builder import Body, Must, Query, SortDirection, Filter, Should, MustNot, Reindex
+from pyes.query_builder import Body, Must, Query, SortDirection, Should, MustNot, Reindex
 from pyes.store import ConflictException
 from pyes.validators import NotExistsException
-from pyes.response import get_source
-from pyfunk.pyfunk import count, get, partition, swarm, partial, now
+from pyes.schema import checkargs, string, string_or_nil, boolean, number, nillable, s_or, type_of, function, \
+    dictionary
+from pyes.response import get_sources, collect_sources, include_id as include_id_in_hit
+from pyes.columnar import iterate_columns
+from pyfunk.pyfunk import count, get, partition, now, mapl, assoc
 from pyes.timing import log_time
 from pyes.utils import uuid
 
 MAX_GET_ALL = 1000
 
+GET_ALL_WORKERS = 8
+
+get_all_executor = None
+get_all_lock = threading.Lock()
+
+
+def get_all_pool():
+    """
+    The pool shared by every service's `get_all`, bounding the number of
+    concurrent mgets however many calls are in flight
+    """
+    global get_all_executor
+    with get_all_lock:
+        if get_all_executor is None:
+            get_all_executor = ThreadPoolExecutor(max_workers=GET_ALL_WORKERS, thread_name_prefix="get-all")
+        return get_all_executor
+
+
+def bounded_map(pool, f, items, window):
+    """
+    Maps `f` over `items` on `pool`, yielding results in order, with at most
+    `window` calls submitted at a time
+    """
+    in_flight = deque()
+    for item in items:
+        in_flight.append(pool.submit(f, item))
+        if count(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
 MATCH_ALL = Query().match_all()
 
 
 class ESCrudService:
-    def __init__(self, es, index):
+    """
+    CRUD over a single index, an optional EntityCache makes `get_entity` and
+    `get_all` read through it, with entries dropped by every write the service
+    makes to them, and batched writes dropping them again once the store
+    commits them, so a read in between can't leave the old entity cached. With
+    an EntityLoader concurrent
+    `get_entity` calls are gathered into mgets. `source_includes` and
+    `source_excludes` are the default `_source` projection of the service's
+    gets, queries and scans, for those that don't ask for their own fields.
+    `validation` (ValidationSettings) overrides the global argument validation
+    mode for the service's methods
+    """
+    def __init__(self, es, index, cache=None, loader=None, source_includes=None, source_excludes=None,
+                 validation=None):
         self.es = es
         self.index = index
-
-    @checkargs
-    def _get_all_helper(self, fields: [string] = [], entity_ids: [string] = []):
-        query = Query()
-
-        filter = Filter()
-        filter.terms('_id', entity_ids)
-
-        body = Body().query(query.bool(filter)).size(len(entity_ids)).source(fields)
-        results = self.query(body, raw_query=True, hits=False)
-        result_dict = {}
-
-        for result in get(get(results, 'hits'), 'hits'):
-            result_dict[get(result, '_id')] = get_source(result)
-
-        return result_dict
+        self.validation = validation
+        self.dirty_ids = set()
+        self.dirty_lock = threading.Lock()
+        if cache is not None:
+            es.on_flushed(self.flushed)
+        self.cache = cache
+        self.loader = loader
+        self.source_includes = source_includes
+        self.source_excludes = source_excludes
+
+    def source_params(self):
+        params = {}
+        if self.source_includes:
+            params['_source_includes'] = self.source_includes
+        if self.source_excludes:
+            params['_source_excludes'] = self.source_excludes
+        return params
+
+    def project(self, query):
+        """
+        Applies the service's default projection to a query without a
+        `_source` of its own
+        """
+        if not (self.source_includes or self.source_excludes):
+            return query
+        if isinstance(query, Body):
+            if not query.source_fields:
+                query.source(self.source_includes, excludes=self.source_excludes)
+            return query
+        if '_source' in query:
+            return query
+        return assoc(query, '_source', Body().source(self.source_includes, excludes=self.source_excludes).source_fields)
+
+    def invalidate(self, entity_id, batch=False):
+        """
+        Drops a written entity from the cache, once the write has returned, so
+        a read racing the write can't put the old entity back after it. Batched
+        writes are dropped again by the flush that commits them
+        """
+        if self.cache is not None:
+            self.cache.invalidate(entity_id)
+            if batch:
+                with self.dirty_lock:
+                    self.dirty_ids.add(entity_id)
+
+    def flushed(self, pending=False):
+        with self.dirty_lock:
+            dirty_ids = set(self.dirty_ids)
+            if not pending:
+                self.dirty_ids = set()
+        for entity_id in dirty_ids:
+            self.cache.invalidate(entity_id)
+
+    def cache_stats(self):
+        return self.cache.as_dict() if self.cache is not None else {}
 
     @checkargs
     def create(self,
@@ -42,6 +133,7 @@ class ESCrudService:
         entity_id = entity_id or uuid()
         entity['uid'] = entity_id
         self.es.create(entity_id, self.index, entity, batch=batch)
+        self.invalidate(entity_id, batch=batch)
         return entity_id
 
     @checkargs
@@ -50,20 +142,29 @@ class ESCrudService:
                   entity_id: string_or_nil = None,
                   batch: boolean = False):
         self.es.index(entity_id, self.index, entity, batch=batch)
+        if entity_id is not None:
+            self.invalidate(entity_id, batch=batch)
 
     @checkargs
     def get_entity(self,
                    entity_id: string,
                    batch: boolean = False,
                    source: nillable([string])=None):
-        params = {"_source": source} if source is not None else {}
-        return self.es.get(entity_id, self.index, batch=batch, **params)
+        cacheable = self.cache is not None and not batch and source is None
+        if cacheable:
+            entity = self.cache.get(entity_id)
+            if entity is not None:
+                return entity
+
+        params = {"_source": source} if source is not None else self.source_params()
+        if self.loader is not None and not batch and not params:
+            entity = self.loader.get(self.index, entity_id)
+        else:
+            entity = self.es.get(entity_id, self.index, batch=batch, **params)
 
-    @checkargs
-    def get_all(self, entity_ids: [string]):
-        for entity_id in entity_ids:
-            self.get_entity(entity_id, batch=True)
-        return self.batch_get()
+        if cacheable:
+            self.cache.put(entity_id, entity)
+        return entity
 
     @checkargs
     def get_entities(self,
@@ -73,7 +174,7 @@ class ESCrudService:
         query = Query().bool(Must().terms("_id", entity_ids))
         query = Body().query(query).size(limit)
 
-        return self.es.query(self.index, query, batch=batch)
+        return self.es.query(self.index, self.project(query), batch=batch)
 
     @checkargs
     def exists(self,
@@ -110,6 +211,7 @@ class ESCrudService:
                check_existence: boolean = True):
         if not check_existence or self.exists(entity_id, throw=not batch):
             self.es.update(entity_id, self.index, update, batch=batch)
+            self.invalidate(entity_id, batch=batch)
 
     @checkargs
     def upsert(self,
@@ -117,12 +219,14 @@ class ESCrudService:
                entity: {},
                batch: boolean = False):
         self.es.upsert(entity_id, self.index, entity, batch=batch)
+        self.invalidate(entity_id, batch=batch)
 
     @checkargs
     def script_update(self,
                       entity_id: string,
                       inline: string):
         self.es.script_update(entity_id, self.index, inline)
+        self.invalidate(entity_id)
 
     @checkargs
     def delete(self,
@@ -131,10 +235,13 @@ class ESCrudService:
                check_existence: boolean = True):
         if not check_existence or self.exists(entity_id, throw=not batch):
             self.es.delete(entity_id, self.index, batch=batch)
+            self.invalidate(entity_id, batch=batch)
 
     @checkargs
     def delete_by_query(self, query: type_of(Query)):
         self.es.delete_by_query(self.index, query)
+        if self.cache is not None:
+            self.cache.clear()
 
     @log_time(threshold=10000)
     @checkargs
@@ -150,14 +257,22 @@ class ESCrudService:
               hits: boolean = True,
               include_id: boolean = False,
               transform: nillable(function) = None,
-              fields: nillable([string]) = None):
+              fields: nillable([string]) = None,
+              stream: boolean = False,
+              in_place: boolean = False):
+        """
+        Searches the index, returning the sources of the hits, or the first
+        with `just_one`. A `just_one` query that isn't raw asks for a single
+        hit rather than its `limit`, the first of the top `limit` hits being
+        the top hit, so nothing is fetched and decoded only to be discarded
+        """
         if not raw_query:
             if isinstance(query, dict):
                 query = Query().bool(Must(query))
                 query = Body().query(query)
 
             if limit is not None and query.limit is None:
-                query.size(limit)
+                query.size(1 if just_one else limit)
 
             if sort:
                 query.sort(sort, sort_direction)
@@ -165,8 +280,51 @@ class ESCrudService:
             if fields:
                 query.source(fields)
 
-        return self.es.query(self.index, query, just_one=just_one, key=key,
-                             batch=batch, hits=hits, transform=transform, include_id=include_id)
+        return self.es.query(self.index, self.project(query), just_one=just_one, key=key,
+                             batch=batch, hits=hits, transform=transform, include_id=include_id, stream=stream,
+                             in_place=in_place)
+
+    @checkargs
+    def iterate_query(self,
+                      query: nillable(s_or({}, type_of(Body))) = None,
+                      size: number = 1000,
+                      sort: string_or_nil = None,
+                      sort_direction: string_or_nil = SortDirection.ASC,
+                      fields: nillable([string]) = None,
+                      pages: boolean = False,
+                      hits: boolean = True,
+                      include_id: boolean = False,
+                      keep_alive: string = '1m',
+                      track_total_hits: boolean = False):
+        """
+        Lazily iterates every match of a query, unlike `query` which stops at
+        its limit, paging with a point in time and `search_after` rather than
+        from/size. Yields sources, or the raw hits with `hits=False`, one at a
+        time or a page at a time with `pages=True`
+        """
+        if query is None:
+            query = Body().query(Query().match_all())
+        elif isinstance(query, dict):
+            query = Body().query(Query().bool(Must(query)))
+        else:
+            query = copy.deepcopy(query)
+
+        if sort:
+            query.sort(sort, sort_direction)
+
+        if fields:
+            query.source(fields)
+
+        for page in self.es.iterate_pages(self.index, self.project(query), size=size, keep_alive=keep_alive,
+                                          track_total_hits=track_total_hits):
+            if hits:
+                page = collect_sources(page, include_id=include_id, in_place=True)
+            elif include_id:
+                page = mapl(include_id_in_hit, page)
+            if pages:
+                yield page
+            else:
+                yield from page
 
     @checkargs
     def count(self,
@@ -194,6 +352,7 @@ class ESCrudService:
                   entity: {},
                   batch: boolean = False):
         self.es.index(entity_id, self.index, entity, batch=batch)
+        self.invalidate(entity_id, batch=batch)
 
     @checkargs
     def suggest(self,
@@ -203,23 +362,47 @@ class ESCrudService:
                 contexts: nillable({}) = None):
         return self.es.suggest(self.index, "text_suggest", prefix, key=key, batch=batch, contexts=contexts)
 
-
     @checkargs
-    def get_all(self, entity_ids: [string] = [], fields: [string] = []):
-        # TODO IBP-4075 After ES is upgraded use Multi GET.
-        # for entity_id in entity_ids:
-        #     self.es.get(entity_id, self.index, self.type, batch=True)
-        # return self.es.batch_get()
-        all_results = {}
-        entity_id_groups = partition(MAX_GET_ALL, entity_ids)
-
-        def callback(_, results):
-            all_results.update(results)
-
-        swarm(partial(self._get_all_helper, fields), entity_id_groups, callback=callback,
-              workers=min(count(entity_id_groups), 40))
-
-        return all_results
+    def iter_all(self,
+                 entity_ids: [string] = [],
+                 fields: [string] = [],
+                 excludes: [string] = [],
+                 realtime: boolean = True,
+                 chunk_size: number = MAX_GET_ALL):
+        """
+        Streams `(entity_id, entity)` pairs for the entities that exist, fetched
+        with one mget per `chunk_size` ids, over the shared get all pool
+        """
+        params = {'realtime': realtime}
+        if fields:
+            params['_source_includes'] = fields
+        if excludes:
+            params['_source_excludes'] = excludes
+        if not (fields or excludes):
+            params.update(self.source_params())
+
+        def fetch(ids):
+            return self.es.multi_get(self.index, ids, **params)
+
+        for results in bounded_map(get_all_pool(), fetch, partition(chunk_size, entity_ids), GET_ALL_WORKERS * 2):
+            for entity_id, entity in results.items():
+                if entity is not None:
+                    yield entity_id, entity
+
+    @checkargs
+    def get_all(self,
+                entity_ids: [string] = [],
+                fields: [string] = [],
+                excludes: [string] = [],
+                realtime: boolean = True):
+        if self.cache is None or fields or excludes:
+            return dict(self.iter_all(entity_ids, fields=fields, excludes=excludes, realtime=realtime))
+
+        entities, missing = self.cache.get_many(entity_ids)
+        for entity_id, entity in self.iter_all(missing, realtime=realtime):
+            self.cache.put(entity_id, entity)
+            entities[entity_id] = entity
+        return entities
 
     @checkargs
     def match_all(self, size: number = 1000):
@@ -228,22 +411,53 @@ class ESCrudService:
     def refresh(self):
         self.es.refresh_index(self.index)
 
-    def scan(self, query=None, size=1000, scroll='5m'):
-        return self.es.scan(self.index, query=query, size=size, scroll=scroll)
-
-    def batch_scan(self, query=None, size=1000, scroll='5m'):
-        batch = []
-        for hit in self.scan(query=query, size=size, scroll=scroll):
-            batch.append(hit)
-            if count(batch) == size:
-                batch_to_yield = batch
-                batch = []
-                yield batch_to_yield
-        yield batch
-
-    def sliced_scan(self, handler, query=None, fields=None, slices=2, size=1000, scroll='5m', workers=None):
-        self.es.sliced_scan(self.index, handler, query=query, fields=fields, slices=slices,
-                            size=size, scroll=scroll, workers=workers)
+    def scan(self, query=None, size=1000, scroll='5m', pit=False, keep_alive='1m', search_after=None, prefetch=0,
+             stream=False, pit_id=None, on_pit_id=None):
+        return self.es.scan(self.index, query=query, size=size, scroll=scroll, pit=pit, keep_alive=keep_alive,
+                            search_after=search_after, prefetch=prefetch, stream=stream, pit_id=pit_id,
+                            on_pit_id=on_pit_id)
+
+    def open_point_in_time(self, keep_alive='1m'):
+        return self.es.open_point_in_time(self.index, keep_alive)
+
+    def close_point_in_time(self, pit_id):
+        self.es.close_point_in_time(pit_id)
+
+    def batch_scan(self, query=None, size=1000, scroll='5m', pit=False, keep_alive='1m', search_after=None,
+                   prefetch=0, sources=False, fields=None, pit_id=None, on_pit_id=None):
+        """
+        Yields each page of hits as the server returns it, of at most `size`
+        hits, or just their sources with `sources`, optionally restricted to
+        `fields`
+        """
+        if query is None:
+            query = Body().query(Query().match_all())
+        if fields:
+            query = query.source(fields) if isinstance(query, Body) else assoc(query, '_source', fields)
+        query = self.project(query)
+        if isinstance(query, Body):
+            query = query.build()
+
+        for page in self.es.scan_pages(self.index, query=query, size=size, scroll=scroll, pit=pit,
+                                       keep_alive=keep_alive, search_after=search_after, prefetch=prefetch,
+                                       pit_id=pit_id, on_pit_id=on_pit_id):
+            yield get_sources(page) if sources else page
+
+    def scan_columns(self, fields, query=None, size=1000, dtypes=None, scroll='5m', pit=False, prefetch=0):
+        """
+        Yields a masked NumPy array per field for each page of a scan, see
+        `pyes.columnar.extract_columns`
+        """
+        pages = self.batch_scan(query=query, size=size, scroll=scroll, pit=pit, prefetch=prefetch, fields=fields)
+        return iterate_columns(pages, fields, dtypes=dtypes)
+
+    def sliced_scan(self, handler, query=None, fields=None, slices=2, size=1000, scroll='5m', workers=None,
+                    pit=False, keep_alive='1m', search_after=None, processes=None, queue_depth=None, pit_id=None,
+                    on_pit_id=None):
+        return self.es.sliced_scan(self.index, handler, query=query, fields=fields, slices=slices,
+                                   size=size, scroll=scroll, workers=workers, pit=pit, keep_alive=keep_alive,
+                                   search_after=search_after, processes=processes, queue_depth=queue_depth,
+                                   pit_id=pit_id, on_pit_id=on_pit_id)
 
     def profile(self, query):
         return self.es.profile(self.index, query)
@@ -261,9 +475,10 @@ class ESCrudService:
     def find_all(self,
                  keyed_queries: {string: s_or({}, type_of(Body))},
                  fields: nillable([string]) = None):
-        for key, query in keyed_queries.items():
-            self.query(query, key=key, fields=fields, just_one=True, batch=True)
-        return self.es.batch_query()
+        with self.es.batch():
+            for key, query in keyed_queries.items():
+                self.query(query, key=key, fields=fields, just_one=True, batch=True)
+            return self.es.batch_query()
 
     def get_mappings(self):
         return self.es.get_mappings(self.index)
@@ -338,6 +553,41 @@ class ESSoftCrudService(ESCrudService):
             deleted_time = now()
         return Should().bool(MustNot().exists('deleted_time')).range('deleted_time', gt=deleted_time)
 
+    @checkargs
+    def iter_all(self,
+                 entity_ids: [string] = [],
+                 fields: [string] = [],
+                 excludes: [string] = [],
+                 realtime: boolean = True,
+                 chunk_size: number = MAX_GET_ALL):
+        """
+        Leaves out soft deleted entities, as the query based `get_all` did,
+        fetching `deleted_time` to check even when `fields` leave it out
+        """
+        strip = (fields and 'deleted_time' not in fields) or 'deleted_time' in excludes
+        if fields and 'deleted_time' not in fields:
+            fields = fields + ['deleted_time']
+        excludes = [field for field in excludes if field != 'deleted_time']
+
+        deleted_time = now()
+        for entity_id, entity in super().iter_all(entity_ids, fields=fields, excludes=excludes, realtime=realtime,
+                                                  chunk_size=chunk_size):
+            if not self.is_soft_deleted(entity, deleted_time):
+                if strip:
+                    entity.pop('deleted_time', None)
+                yield entity_id, entity
+
+    @checkargs
+    def get_all(self,
+                entity_ids: [string] = [],
+                fields: [string] = [],
+                excludes: [string] = [],
+                realtime: boolean = True):
+        entities = super().get_all(entity_ids, fields=fields, excludes=excludes, realtime=realtime)
+        deleted_time = now()
+        return {entity_id: entity for entity_id, entity in entities.items()
+                if not self.is_soft_deleted(entity, deleted_time)}
+
     @checkargs
     def get_including_deleted(self,
                               entity_id: string,
@@ -376,6 +626,7 @@ class ESSoftCrudService(ESCrudService):
                     batch: boolean = False):
         if self.exists_including_deleted(entity_id, throw=not batch):
             self.es.delete(entity_id, self.index, batch=batch)
+            self.invalidate(entity_id, batch=batch)
 
     @checkargs
     def get_entities(self,
@@ -385,7 +636,7 @@ class ESSoftCrudService(ESCrudService):
         query = Query().bool(Must().terms("_id", entity_ids), self.not_deleted_query())
         query = Body().query(query).size(limit)
 
-        return self.es.query(self.index, query, batch=batch)
+        return self.es.query(self.index, self.project(query), batch=batch)
 
     @checkargs
     def query(self,
@@ -400,7 +651,9 @@ class ESSoftCrudService(ESCrudService):
               hits: boolean = True,
               include_id: boolean = False,
               transform: nillable(function) = None,
-              fields: nillable([string]) = None):
+              fields: nillable([string]) = None,
+              stream: boolean = False,
+              in_place: boolean = False):
         if not raw_query:
             if isinstance(query, dict):
                 query = Query().bool(Must(query))
@@ -423,4 +676,42 @@ class ESSoftCrudService(ESCrudService):
                              hits=hits,
                              include_id=include_id,
                              transform=transform,
-                             fields=fields)
+                             fields=fields,
+                             stream=stream,
+                             in_place=in_place)
+
+    @checkargs
+    def iterate_query(self,
+                      query: nillable(s_or({}, type_of(Body))) = None,
+                      size: number = 1000,
+                      sort: string_or_nil = None,
+                      sort_direction: string_or_nil = SortDirection.ASC,
+                      fields: nillable([string]) = None,
+                      pages: boolean = False,
+                      hits: boolean = True,
+                      include_id: boolean = False,
+                      keep_alive: string = '1m',
+                      track_total_hits: boolean = False):
+        if query is None:
+            query = Body().query(Query().match_all())
+        elif isinstance(query, dict):
+            query = Body().query(Query().bool(Must(query)))
+
+        else:
+            # the caller's Body is left as it was
+            query = copy.deepcopy(query)
+
+        new_must = Must().derive(query.query_term)
+        new_must.bool(self.not_deleted_query())
+        query.query(Query().bool(new_must))
+
+        return super().iterate_query(query,
+                                     size=size,
+                                     sort=sort,
+                                     sort_direction=sort_direction,
+                                     fields=fields,
+                                     pages=pages,
+                                     hits=hits,
+                                     include_id=include_id,
+                                     keep_alive=keep_alive,
+                                     track_total_hits=track_total_hits)
@@ -0,0 +1,163 @@
+import asyncio
+import copy
+import threading
+from concurrent.futures import Future
+
+MAX_LOAD_BATCH = 1000
+
+
+def group_by_index(pending):
+    by_index = {}
+    for (index, id), futures in pending.items():
+        by_index.setdefault(index, {})[id] = futures
+    return by_index
+
+
+def resolve_futures(futures, entity):
+    """
+    Resolves the futures still waiting on an entity, skipping any whose
+    caller has given up on (cancelled) it, the first gets the entity itself
+    and the rest copies of it
+    """
+    shared = False
+    for future in futures:
+        if future.done():
+            continue
+        future.set_result(copy.deepcopy(entity) if shared else entity)
+        shared = True
+
+
+def fail_futures(futures_by_id, e):
+    for futures in futures_by_id.values():
+        for future in futures:
+            if not future.done():
+                future.set_exception(e)
+
+
+class EntityLoader(object):
+    """
+    Collects the gets made within `window` seconds of each other, across
+    threads, and realizes them with one mget per index, resolving each
+    caller's future with its entity (None when it doesn't exist). A batch
+    is sent early once it holds `max_batch` distinct ids
+    """
+    def __init__(self, es, window=0.002, max_batch=MAX_LOAD_BATCH):
+        self.es = es
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}
+        self.timer = None
+        self.loads = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def load(self, index, id):
+        future = Future()
+        with self.lock:
+            self.loads += 1
+            self.pending.setdefault((index, id), []).append(future)
+            if len(self.pending) >= self.max_batch:
+                pending = self.take()
+            else:
+                pending = None
+                if self.timer is None:
+                    self.timer = threading.Timer(self.window, self.dispatch)
+                    self.timer.daemon = True
+                    self.timer.start()
+        if pending:
+            self.resolve(pending)
+        return future
+
+    def get(self, index, id):
+        return self.load(index, id).result()
+
+    def take(self):
+        pending = self.pending
+        self.pending = {}
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return pending
+
+    def dispatch(self):
+        with self.lock:
+            pending = self.take()
+        if pending:
+            self.resolve(pending)
+
+    def resolve(self, pending):
+        for index, futures_by_id in group_by_index(pending).items():
+            with self.lock:
+                self.batches += 1
+            try:
+                entities = self.es.multi_get(index, list(futures_by_id.keys()))
+            except Exception as e:
+                fail_futures(futures_by_id, e)
+                continue
+            for id, futures in futures_by_id.items():
+                resolve_futures(futures, entities.get(id))
+
+    def as_dict(self):
+        return {
+            'loads': self.loads,
+            'batches': self.batches
+        }
+
+
+class AsyncEntityLoader(object):
+    """
+    The asyncio mirror of the EntityLoader, gets awaited in the same event
+    loop tick, or within `window` seconds when given, share one mget per index
+    """
+    def __init__(self, es, window=0, max_batch=MAX_LOAD_BATCH):
+        self.es = es
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}
+        self.handle = None
+        # the event loop only keeps weak references to tasks, so they are held
+        # here until they complete
+        self.tasks = set()
+        self.loads = 0
+        self.batches = 0
+
+    async def load(self, index, id):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.loads += 1
+        self.pending.setdefault((index, id), []).append(future)
+        if len(self.pending) >= self.max_batch:
+            self.dispatch()
+        elif self.handle is None:
+            if self.window:
+                self.handle = loop.call_later(self.window, self.dispatch)
+            else:
+                self.handle = loop.call_soon(self.dispatch)
+        return await future
+
+    def dispatch(self):
+        pending = self.pending
+        self.pending = {}
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        for index, futures_by_id in group_by_index(pending).items():
+            task = asyncio.ensure_future(self.resolve(index, futures_by_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def resolve(self, index, futures_by_id):
+        self.batches += 1
+        try:
+            entities = await self.es.multi_get(index, list(futures_by_id.keys()))
+        except Exception as e:
+            fail_futures(futures_by_id, e)
+            return
+        for id, futures in futures_by_id.items():
+            resolve_futures(futures, entities.get(id))
+
+    def as_dict(self):
+        return {
+            'loads': self.loads,
+            'batches': self.batches
+        }
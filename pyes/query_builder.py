@@ -245,6 +245,23 @@ class QueryNode:
         })
         return self
 
+    def has_parent(self, parent_type, clause):
+        self.children.append({
+            "has_parent": {
+                "parent_type": parent_type,
+                "query": clause
+            }
+        })
+        return self
+
+    def ids(self, values):
+        self.children.append({
+            "ids": {
+                "values": values
+            }
+        })
+        return self
+
     def match_phrase_prefix(self, field, value):
         self.children.append({
             "match_phrase_prefix": {
@@ -775,8 +792,11 @@ class Body:
         })
         return self
 
-    def source(self, fields):
-        self.source_fields = fields
+    def source(self, fields=None, excludes=None):
+        if excludes:
+            self.source_fields = {'includes': fields, 'excludes': excludes} if fields else {'excludes': excludes}
+        else:
+            self.source_fields = fields
         return self
 
     def track_total_hits(self, value):
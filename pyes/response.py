@@ -48,6 +48,36 @@ def include_ids(response):
     return update_in(response, ['hits', 'hits'], partial(mapl, include_id))
 
 
+def source_with_id(hit, in_place=False):
+    """
+    A hit's source with the hit's id as `uid`, written into the decoded source
+    itself with `in_place` rather than into a copy
+    """
+    source = hit.get('_source')
+    if source is None or not in_place:
+        source = dict(source or {})
+    source['uid'] = hit.get('_id')
+    return source
+
+
+def include_ids_in_place(response):
+    for hit in get_hits(response):
+        hit['_source'] = source_with_id(hit, in_place=True)
+    return response
+
+
+def collect_sources(hits, include_id=False, limit=None, in_place=False):
+    """
+    The sources of a list of hits, with their ids when `include_id`, taken in
+    one pass that stops after `limit` hits
+    """
+    if limit is not None:
+        hits = hits[:limit]
+    if include_id:
+        return [source_with_id(hit, in_place=in_place) for hit in hits]
+    return [hit.get('_source') for hit in hits]
+
+
 def get_ids(hits):
     return mapl(get_id, hits)
 
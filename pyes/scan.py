@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+PAGE = 'page'
+DONE = 'done'
+ERROR = 'error'
+
+
+def prefetch(pages, depth=2):
+    """
+    Iterates `pages` on a background thread, buffering up to `depth` pages
+    ahead of the caller, so fetching the next pages overlaps processing the
+    current one. Errors are raised to the caller, and abandoning the
+    iteration stops the fetching and closes `pages`
+    """
+    buffer = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((PAGE, page)):
+                    return
+            put((DONE, None))
+        except Exception as e:
+            put((ERROR, e))
+        finally:
+            close = getattr(pages, 'close', None)
+            if close is not None:
+                close()
+
+    producer = threading.Thread(target=produce, name="scan-prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, value = buffer.get()
+            if kind == DONE:
+                return
+            if kind == ERROR:
+                raise value
+            yield value
+    finally:
+        stopped.set()
+
+
+def handle_batch(handler, hits):
+    """
+    Runs in a pool process, calling the handler on each hit of a page
+    """
+    start = time.monotonic()
+    for hit in hits:
+        handler(hit)
+    return os.getpid(), len(hits), time.monotonic() - start
+
+
+class ScanStats(object):
+    """
+    Per worker counts for a scan handled by a process pool, `seconds` is the
+    time each worker spent in the handler
+    """
+    def __init__(self):
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def record(self, worker, hits, seconds):
+        with self.lock:
+            stats = self.workers.setdefault(worker, {'batches': 0, 'hits': 0, 'seconds': 0.0})
+            stats['batches'] += 1
+            stats['hits'] += hits
+            stats['seconds'] += seconds
+
+    def hits(self):
+        return sum(stats['hits'] for stats in self.workers.values())
+
+    def as_dict(self):
+        with self.lock:
+            workers = {worker: {**stats, 'hits_per_second': stats['hits'] / stats['seconds'] if stats['seconds'] else 0}
+                       for worker, stats in self.workers.items()}
+        return {
+            'hits': sum(stats['hits'] for stats in workers.values()),
+            'batches': sum(stats['batches'] for stats in workers.values()),
+            'workers': workers
+        }
+
+    def __repr__(self):
+        return "ScanStats({0})".format(self.as_dict())
+
+
+class ProcessPoolHandler(object):
+    """
+    Fans pages of hits out to a pool of `processes`, calling `handler`, which
+    must be picklable (a module level function), on every hit. At most
+    `queue_depth` pages are queued or in flight, so fetching blocks rather than
+    outrunning the handlers. The first handler error stops the scan, and is
+    raised from `submit` or `close`
+    """
+    def __init__(self, handler, processes=None, queue_depth=None):
+        self.handler = handler
+        self.processes = processes or os.cpu_count()
+        self.slots = threading.BoundedSemaphore(queue_depth or self.processes * 2)
+        self.pool = ProcessPoolExecutor(max_workers=self.processes)
+        self.stats = ScanStats()
+        self.error = None
+
+    def submit(self, hits):
+        if not hits:
+            return
+        self.slots.acquire()
+        if self.error is not None:
+            self.slots.release()
+            raise self.error
+        future = self.pool.submit(handle_batch, self.handler, hits)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        try:
+            self.stats.record(*future.result())
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+        return self.stats
+
+    def abort(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
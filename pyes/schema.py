@@ -1,5 +1,6 @@
 import inspect
 import numbers
+import random
 import re
 import types
 from datetime import datetime
@@ -12,6 +13,11 @@ class SchemaError(Exception):
     pass
 
 
+class Validator:
+    def validate(self, v):
+        return v
+
+
 def trim_value(value):
     if value and len(str(value)) > 256:
         return str(value)[:256]
@@ -65,19 +71,87 @@ def validate(schema, v):
     return True
 
 
+def compile_dictionary(schema):
+    entries = [(string(k), k if string(k) else compile_schema(k), compile_schema(s)) for k, s in schema.items()]
+    schema_keys = schema.keys()
+
+    def check(d):
+        if not dictionary(d):
+            raise SchemaError("Value '{0}' does not match schema".format(trim_value(d)))
+        for named, k, s in entries:
+            if named:
+                s(d.get(k))
+            else:
+                for dk, dv in d.items():
+                    if dk not in schema_keys:
+                        try:
+                            k(dk)
+                            key_match = True
+                        except SchemaError:
+                            key_match = False
+                        if key_match:
+                            s(dv)
+        return True
+    return check
+
+
+def compile_list(schema):
+    if count(schema) != 1:
+        return lambda l: validate(schema, l)
+    item = compile_schema(first(schema))
+
+    def check(l):
+        if not sequence(l):
+            raise SchemaError("Value '{0}' does not match schema".format(trim_value(l)))
+        for x in l:
+            item(x)
+        return True
+    return check
+
+
+def compile_predicate(schema):
+    def check(v):
+        if not schema(v):
+            raise SchemaError("Value '{0}' does not match schema".format(trim_value(v)))
+        return True
+    return check
+
+
+def compile_schema(schema):
+    """
+    Walks a schema once, returning a closure that validates a value against
+    it as `validate` does, without dispatching on the schema for every value
+    """
+    if isinstance(schema, Validator):
+        def check(v):
+            schema.validate(v)
+            return True
+        return check
+    elif dictionary(schema):
+        return compile_dictionary(schema)
+    elif sequence(schema):
+        return compile_list(schema)
+    else:
+        return compile_predicate(schema)
+
+
 def s_and(*args):
+    checks = [compile_schema(arg) for arg in args]
+
     def pred(x):
-        for arg in args:
-            validate(arg, x)
+        for check in checks:
+            check(x)
         return True
     return pred
 
 
 def s_or(*args):
+    checks = [compile_schema(arg) for arg in args]
+
     def pred(x):
-        for arg in args:
+        for check in checks:
             try:
-                validate(arg, x)
+                check(x)
                 return True
             except SchemaError:
                 pass
@@ -205,8 +279,10 @@ def class_enum(class_name):
 
 
 def nillable(pred):
+    check = compile_schema(pred)
+
     def nillable_pred(x):
-        return x is None or validate(pred, x)
+        return x is None or check(x)
     return nillable_pred
 
 
@@ -231,11 +307,6 @@ def matches_regex(regex):
 s_email = matches_regex(EMAIL_REGEX)
 
 
-class Validator:
-    def validate(self, v):
-        return v
-
-
 class Keys(Validator):
     def __init__(self, required=None, optional=None, forbidden=None):
         self.required = required
@@ -302,24 +373,75 @@ class ForbiddenKeys(Validator):
         return d
 
 
+class Validation:
+    ON = 'on'
+    SAMPLED = 'sampled'
+    OFF = 'off'
+
+
+class ValidationSettings(object):
+    """
+    Whether `checkargs` validates every call, a `sample_rate` fraction of
+    calls, or none
+    """
+    def __init__(self, mode=Validation.ON, sample_rate=0.01):
+        self.mode = mode
+        self.sample_rate = sample_rate
+
+    def should_validate(self):
+        if self.mode == Validation.ON:
+            return True
+        if self.mode == Validation.SAMPLED:
+            return random.random() < self.sample_rate
+        return False
+
+
+validation_settings = ValidationSettings()
+
+
+def set_validation(mode, sample_rate=None):
+    """
+    Sets the validation mode of every `checkargs` function, bar the methods of
+    objects with their own `validation` settings, such as the CRUD services
+    """
+    validation_settings.mode = mode
+    if sample_rate is not None:
+        validation_settings.sample_rate = sample_rate
+
+
 def checkargs(function):
+    """
+    Validates a function's arguments against the schemas they are annotated
+    with. The signature is bound and the schemas compiled once, here, rather
+    than on every call
+    """
+    parameters = inspect.signature(function).parameters
+    checks = []
+    for index, (argument, parameter) in enumerate(parameters.items()):
+        schema = function.__annotations__.get(argument)
+        if schema is not None:
+            default = None if parameter.default is parameter.empty else parameter.default
+            checks.append((index, argument, default, compile_schema(schema)))
+    is_method = first(list(parameters.keys())) == 'self'
+
     def _f(*arguments, **kwargs):
-        sig = inspect.signature(function)
-        args = sig.parameters.keys()
-        defaults_keymap = {k: v.default for k,v in sig.parameters.items() if not v.default is v.empty}
-        for index, argument in enumerate(args):
-            if index < len(arguments):
-                value = arguments[index]
-            elif argument in kwargs:
-                value = kwargs[argument]
-            else:
-                value = get(defaults_keymap, argument)
-            schema = get(function.__annotations__, argument)
-            if schema is not None:
-                validate(schema, value)
+        settings = validation_settings
+        if is_method and arguments:
+            # an unrelated attribute named validation is not a service's settings
+            own = getattr(arguments[0], 'validation', None)
+            if isinstance(own, ValidationSettings):
+                settings = own
+        if settings.should_validate():
+            for index, argument, default, check in checks:
+                if index < len(arguments):
+                    value = arguments[index]
+                elif argument in kwargs:
+                    value = kwargs[argument]
+                else:
+                    value = default
+                check(value)
         return function(*arguments, **kwargs)
     _f.__doc__ = function.__doc__
     _f.__name__ = function.__name__
     _f.__module__ = function.__module__
     return _f
-
@@ -0,0 +1,80 @@
+from decimal import Decimal
+
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer, Deserializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    A drop in replacement for the elasticsearch-py JSONSerializer backed by
+    orjson, which natively handles datetimes, dates and UUIDs. Decimals and
+    numpy values go through the default serializer's conversions, as orjson's
+    own numpy support writes float32 and datetime64 values differently
+    """
+    mimetype = "application/json"
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("The OrjsonSerializer requires orjson to be installed")
+        self.options = orjson.OPT_NON_STR_KEYS
+
+    def default(self, data):
+        if isinstance(data, Decimal):
+            return float(data)
+        return super().default(data)
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+
+        try:
+            return orjson.dumps(data, default=self.default, option=self.options).decode("utf-8")
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+
+SERIALIZERS = {
+    'json': JSONSerializer,
+    'orjson': OrjsonSerializer
+}
+
+
+def get_serializer(serializer):
+    """
+    Resolves a serializer strategy, either an instance or one of the names
+    in SERIALIZERS
+    """
+    if isinstance(serializer, str):
+        if serializer not in SERIALIZERS:
+            raise ValueError("Unknown serializer '{0}', expected one of {1}".format(serializer,
+                                                                                   list(SERIALIZERS.keys())))
+        return SERIALIZERS[serializer]()
+    return serializer
+
+
+def use_serializer(es, serializer):
+    """
+    Installs the serializer on the client's transport, so that every request
+    body (search, msearch, mget and the bulk NDJSON lines) is written, and
+    every response read, with it. The client itself is changed, so the
+    serializer applies to every other user of the client too
+    """
+    serializer = get_serializer(serializer)
+    transport = es.transport
+    transport.serializer = serializer
+    serializers = dict(transport.deserializer.serializers)
+    serializers[serializer.mimetype] = serializer
+    transport.deserializer = Deserializer(serializers)
+    return serializer
@@ -0,0 +1,81 @@
+import copy
+import threading
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls with the same key into one, the first caller
+    runs it while the others wait and receive a copy of its result, or its
+    exception. `collapsed` counts the calls that were spared. Calls that are
+    `forget`-ten keep running for those already waiting on them, later
+    callers start a fresh one
+    """
+    def __init__(self):
+        self.calls = {}
+        self.requests = 0
+        self.executed = 0
+        self.collapsed = 0
+        self.lock = threading.Lock()
+
+    def do(self, key, f):
+        with self.lock:
+            self.requests += 1
+            call = self.calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.collapsed += 1
+                leader = False
+            else:
+                call = Call()
+                self.calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if leader:
+            try:
+                call.result = f()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    if self.calls.get(key) is call:
+                        del self.calls[key]
+                call.done.set()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return copy.deepcopy(call.result)
+
+    def forget(self, predicate):
+        """
+        Stops later callers from joining the in flight calls whose key matches
+        `predicate`, as when a write has made their results stale
+        """
+        with self.lock:
+            for key in [key for key in self.calls if predicate(key)]:
+                del self.calls[key]
+
+    def in_flight(self):
+        return len(self.calls)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'executed': self.executed,
+            'collapsed': self.collapsed
+        }
+
+    def __repr__(self):
+        return "SingleFlight({0})".format(self.as_dict())
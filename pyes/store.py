@@ -1,12 +1,27 @@
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 from elasticsearch import Elasticsearch, NotFoundError
 from elasticsearch.client.indices import IndicesClient
-from elasticsearch.helpers import scan
+from elasticsearch.client.utils import _make_path
+from elasticsearch.helpers import ScanError, scan
 
 from pyes.query_builder import Body, Query, Slice
-from pyes.response import get_source, sources_from_response, get_sources, include_ids
-from pyes.bulk import BulkBuilder, MultiGet, QueryBuilder
-from pyfunk.pyfunk import get, now, comp, get_in, first, identity, swarm, assoc
+from pyes.response import get_source, get_sources, include_ids, include_ids_in_place, collect_sources, get_id, \
+    get_hits, include_id as include_id_in_hit
+from pyes.streaming import stream_request
+from pyes.bulk import BulkBuilder, AutoFlushingBulkBuilder, MultiGet, QueryBuilder, DEFAULT_MAX_CHUNK_BYTES, \
+    DEFAULT_MSEARCH_CHUNK_SIZE
+from pyfunk.pyfunk import get, now, comp, get_in, first, identity, swarm, assoc, map_map
 from pyes.schema import checkargs, string
+from pyes.serializer import use_serializer
+from pyes.cache import QueryCache, MISSING
+from pyes.single_flight import SingleFlight
+from pyes.scan import ProcessPoolHandler, prefetch as prefetch_pages
+
+logger = logging.getLogger(__name__)
 
 
 class TransformBuilder:
@@ -20,17 +35,55 @@ class TransformBuilder:
             self.transform = transform
 
 
-def build_transform(transform=None, hits=True, just_one=False, include_id=False):
-    tb = TransformBuilder()
-    if include_id:
-        tb.add_transform(include_ids)
-    if hits:
-        tb.add_transform(sources_from_response)
-    if just_one:
-        tb.add_transform(first)
-    if transform:
-        tb.add_transform(transform)
-    return tb.transform or identity
+def build_transform(transform=None, hits=True, just_one=False, include_id=False, in_place=False):
+    """
+    Compiles a query's transform into a single pass over its hits, taking
+    their sources, with their ids as `uid` when `include_id`, only the first
+    with `just_one`, and then calling `transform`. Ids are added to copies of
+    the sources, unless `in_place`, which writes them into the decoded
+    response instead
+    """
+    if not hits:
+        tb = TransformBuilder()
+        if include_id:
+            tb.add_transform(include_ids_in_place if in_place else include_ids)
+        if just_one:
+            tb.add_transform(first)
+        if transform:
+            tb.add_transform(transform)
+        return tb.transform or identity
+
+    limit = 1 if just_one else None
+
+    def store_transform(response):
+        sources = collect_sources(get_hits(response), include_id=include_id, limit=limit, in_place=in_place)
+        if just_one:
+            sources = sources[0] if sources else None
+        return transform(sources) if transform else sources
+
+    return store_transform
+
+
+def response_filter_path(hits=True):
+    """
+    The `filter_path` trimming a search response to what `build_transform`
+    reads from it, the sources and ids of its hits. The id is always kept, as
+    a filter drops any hit left with no fields at all, such as a hit without a
+    `_source`, which would otherwise silently vanish rather than come back as
+    a None source. None when the whole response is wanted, with `hits=False`
+    """
+    if not hits:
+        return None
+    return 'hits.hits._id,hits.hits._source'
+
+
+def filtered_response(response):
+    """
+    A response with no hits left after its `filter_path` comes back empty
+    """
+    if 'hits' not in response:
+        return {'hits': {'hits': []}}
+    return response
 
 
 class Store:
@@ -118,21 +171,68 @@ class ElasticsearchStore(Store):
         except NotFoundError:
             return None
 
+    def multi_get(self, index, ids, **params):
+        """
+        Fetches `ids` with a single mget, returning their sources by id,
+        None for those not found
+        """
+        response = self.es.mget(body={'ids': ids}, index=index, **params)
+        return MultiGetStore.sources_by_key(map_map(get_id, identity, get(response, 'docs', [])))
+
     def delete(self, id, index):
         return self.es.delete(id=id, index=index)
 
     def delete_by_query(self, index, query):
         self.es.delete_by_query(index, Body().query(query).build())
 
-    def query(self, index, query, key=None, transform=None, hits=True, just_one=False, include_id=False):
-        result = self.es.search(index=index, body=query)
+    def query(self, index, query, key=None, transform=None, hits=True, just_one=False, include_id=False,
+              stream=False, in_place=False):
+        if stream:
+            return self.stream_query(index, query, transform=transform, hits=hits, just_one=just_one,
+                                     include_id=include_id)
+
+        filter_path = response_filter_path(hits=hits)
+        if filter_path:
+            result = filtered_response(self.es.search(index=index, body=query, filter_path=filter_path))
+        else:
+            result = self.es.search(index=index, body=query)
 
-        store_transform = build_transform(transform, hits=hits, just_one=just_one, include_id=include_id)
+        store_transform = build_transform(transform, hits=hits, just_one=just_one, include_id=include_id,
+                                          in_place=in_place)
 
         return store_transform(result)
 
+    def stream_query(self, index, query, transform=None, hits=True, just_one=False, include_id=False):
+        """
+        Runs a search decoding its hits from the response body as they are
+        iterated, rather than all at once. Yields sources, or hits with
+        `hits=False`, with `transform` applied to each, or returns the first
+        with `just_one`
+        """
+        filter_path = response_filter_path(hits=hits)
+        params = {'filter_path': filter_path} if filter_path else None
+        items = self.stream_items(stream_request(self.es, 'POST', _make_path(index, '_search'), body=query,
+                                                 params=params),
+                                  transform=transform, hits=hits, include_id=include_id)
+        if just_one:
+            item = next(items, None)
+            items.close()
+            return item
+        return items
+
+    @staticmethod
+    def stream_items(hit_stream, transform=None, hits=True, include_id=False):
+        try:
+            for hit in hit_stream:
+                if include_id:
+                    hit = include_id_in_hit(hit)
+                item = get_source(hit) if hits else hit
+                yield transform(item) if transform else item
+        finally:
+            hit_stream.close()
+
     def count(self, index, query, key=None):
-        result = self.es.count(index=index, body=query)
+        result = self.es.count(index=index, body=query, filter_path='count')
         return get(result, "count")
 
     def profile(self, index, query, no_source=True):
@@ -158,30 +258,299 @@ class ElasticsearchStore(Store):
     def reindex(self, reindex_body):
         self.es.reindex(reindex_body.build())
 
-    def scan(self, index, query=None, size=1000, scroll='5m'):
+    def scan(self, index, query=None, size=1000, scroll='5m', pit=False, keep_alive='1m', search_after=None,
+             prefetch=0, stream=False, pit_id=None, on_pit_id=None):
+        """
+        Yields every hit of a query, through a scroll, or with `pit` through a
+        point in time and `search_after`, which holds no scroll context and can
+        resume after the `sort` of the last hit seen. The `_shard_doc`
+        tiebreaker of a sort only holds within its point in time, so a resume
+        needs the `pit_id` the scan ran in, the latest of which `on_pit_id` is
+        told of, and which is left open for the caller. With `prefetch` up to
+        that many pages are fetched ahead on a background thread, with `stream`
+        hits are decoded one at a time from each response instead
+        """
+        if query is None:
+            query = Body().query(Query().match_all()).build()
+        if stream:
+            yield from self.stream_scan(index, query=query, size=size, scroll=scroll, pit=pit,
+                                        keep_alive=keep_alive, search_after=search_after, pit_id=pit_id,
+                                        on_pit_id=on_pit_id)
+        elif pit or prefetch:
+            for hits in self.scan_pages(index, query=query, size=size, scroll=scroll, pit=pit,
+                                        keep_alive=keep_alive, search_after=search_after, prefetch=prefetch,
+                                        pit_id=pit_id, on_pit_id=on_pit_id):
+                yield from hits
+        else:
+            for hit in scan(self.es, query=query, index=index, size=size, scroll=scroll):
+                yield hit
+
+    def scan_pages(self, index, query=None, size=1000, scroll='5m', pit=False, keep_alive='1m',
+                   search_after=None, prefetch=0, pit_id=None, on_pit_id=None):
+        """
+        Yields each page of hits of a scan as the server returns it
+        """
         if query is None:
             query = Body().query(Query().match_all()).build()
-        for hit in scan(self.es, query=query, index=index, size=size, scroll=scroll):
+        if pit:
+            self.check_resume(search_after, pit_id)
+            pages = self.iterate_pages(index, query=query, size=size, keep_alive=keep_alive,
+                                       search_after=search_after, pit_id=pit_id, on_pit_id=on_pit_id)
+        else:
+            pages = self.scroll_pages(index, query=query, size=size, scroll=scroll)
+        if prefetch:
+            pages = prefetch_pages(pages, depth=prefetch)
+        return pages
+
+    def scroll_pages(self, index, query=None, size=1000, scroll='5m'):
+        """
+        Pages through a query with a scroll, cleared once the pages run out,
+        or the iteration is abandoned or fails
+        """
+        response = self.es.search(index=index, body=query, scroll=scroll, size=size)
+        scroll_id = get(response, '_scroll_id')
+        try:
+            self.check_shards(response, scroll_id)
+            hits = get_hits(response)
+            while hits:
+                yield hits
+                response = self.es.scroll(body={'scroll_id': scroll_id}, scroll=scroll)
+                scroll_id = get(response, '_scroll_id', scroll_id)
+                self.check_shards(response, scroll_id)
+                hits = get_hits(response)
+        finally:
+            if scroll_id:
+                self.es.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404,))
+
+    @staticmethod
+    def check_shards(response, context_id=None):
+        """
+        Raises a ScanError, as the elasticsearch scan helper does, when some
+        shards failed to answer a page, rather than passing off a partial page
+        as complete
+        """
+        shards = get(response, '_shards') or {}
+        total = get(shards, 'total', 0)
+        answered = get(shards, 'successful', 0) + get(shards, 'skipped', 0)
+        if answered < total:
+            raise ScanError(context_id, "Scan request has only succeeded on {0} ({1} skipped) shards out of {2}"
+                            .format(get(shards, 'successful', 0), get(shards, 'skipped', 0), total))
+
+    def checked_items(self, hit_stream, context_id=None):
+        """
+        The hits of a streamed page, once its shards are checked. The shards
+        precede the hits in the response, so they are checked before any hit
+        is handed out
+        """
+        checked = False
+        for hit in self.stream_items(hit_stream, hits=False):
+            if not checked:
+                self.check_shards(hit_stream.captured, hit_stream.captured.get('_scroll_id', context_id))
+                checked = True
             yield hit
+        if not checked:
+            self.check_shards(hit_stream.captured, hit_stream.captured.get('_scroll_id', context_id))
+
+    def iterate_pages(self, index, query=None, size=1000, keep_alive='1m', track_total_hits=False,
+                      search_after=None, slice=None, pit_id=None, on_pit_id=None):
+        """
+        Pages through every hit of a query with a point in time and
+        `search_after`, so each page costs the same however deep it is. The
+        query's sort gets `_shard_doc` as a tiebreaker, and each search renews
+        the point in time for `keep_alive`. A point in time opened here is
+        closed once the pages run out, the iteration is abandoned or fails,
+        one passed in as `pit_id` is left to the caller, who is told of each
+        id the searches return through `on_pit_id`. Resuming after
+        `search_after` needs the `pit_id` it came from. A page missing failed
+        shards raises a ScanError
+        """
+        self.check_resume(search_after, pit_id)
+        body = self.pit_body(query, size, track_total_hits=track_total_hits, search_after=search_after, slice=slice)
+
+        owned = pit_id is None
+        if owned:
+            pit_id = self.open_point_in_time(index, keep_alive)
+        try:
+            while True:
+                body['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+                response = self.es.search(body=body)
+                pit_id = get(response, 'pit_id', pit_id)
+                if on_pit_id is not None:
+                    on_pit_id(pit_id)
+                self.check_shards(response, pit_id)
+                hits = get_hits(response)
+                if hits:
+                    yield hits
+                if len(hits) < size:
+                    break
+                body['search_after'] = get(hits[-1], 'sort')
+        finally:
+            if owned:
+                self.close_point_in_time(pit_id)
+
+    @staticmethod
+    def check_resume(search_after, pit_id):
+        if search_after is not None and pit_id is None:
+            raise ValueError("Resuming a point in time scan needs the pit_id it ran in, "
+                             "as its _shard_doc sort values only hold within it")
+
+    @staticmethod
+    def pit_body(query, size, track_total_hits=False, search_after=None, slice=None):
+        body = dict(query) if query else Body().query(Query().match_all()).build()
+        body.pop('from', None)
+        body['size'] = size
+        sort = body.get('sort', [])
+        # a single clause, such as a field name, is a sort of its own
+        sort = list(sort) if isinstance(sort, (list, tuple)) else [sort]
+        body['sort'] = sort + [{'_shard_doc': 'asc'}]
+        if not track_total_hits:
+            body['track_total_hits'] = False
+        if slice is not None:
+            body['slice'] = slice.build()
+        if search_after is not None:
+            body['search_after'] = search_after
+        return body
+
+    def stream_scan(self, index, query=None, size=1000, scroll='5m', pit=False, keep_alive='1m',
+                    search_after=None, pit_id=None, on_pit_id=None):
+        """
+        Scans by scroll or point in time like `scan`, each page's hits being
+        decoded as they are iterated, so only one hit of a page is held at once
+        """
+        if pit:
+            self.check_resume(search_after, pit_id)
+            body = self.pit_body(query, size, search_after=search_after)
+            owned = pit_id is None
+            if owned:
+                pit_id = self.open_point_in_time(index, keep_alive)
+            try:
+                while True:
+                    body['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+                    hit_stream = stream_request(self.es, 'POST', '/_search', body=body)
+                    page_size = 0
+                    for hit in self.checked_items(hit_stream, pit_id):
+                        page_size += 1
+                        body['search_after'] = get(hit, 'sort')
+                        yield hit
+                    pit_id = hit_stream.captured.get('pit_id', pit_id)
+                    if on_pit_id is not None:
+                        on_pit_id(pit_id)
+                    if page_size < size:
+                        break
+            finally:
+                if owned:
+                    self.close_point_in_time(pit_id)
+            return
+
+        hit_stream = stream_request(self.es, 'POST', _make_path(index, '_search'), body=query,
+                                    params={'scroll': scroll, 'size': size})
+        scroll_id = None
+        try:
+            while True:
+                page_size = 0
+                for hit in self.checked_items(hit_stream, scroll_id):
+                    page_size += 1
+                    yield hit
+                scroll_id = hit_stream.captured.get('_scroll_id', scroll_id)
+                if page_size == 0 or scroll_id is None:
+                    break
+                hit_stream = stream_request(self.es, 'POST', '/_search/scroll',
+                                            body={'scroll': scroll, 'scroll_id': scroll_id})
+        finally:
+            scroll_id = hit_stream.captured.get('_scroll_id', scroll_id)
+            if scroll_id:
+                self.es.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404,))
+
+    def open_point_in_time(self, index, keep_alive='1m'):
+        return get(self.es.open_point_in_time(index=index, keep_alive=keep_alive), 'id')
+
+    def close_point_in_time(self, pit_id):
+        try:
+            self.es.close_point_in_time(body={'id': pit_id})
+        except NotFoundError:
+            pass
 
     def sliced_scan(self, index, handler, query=None, fields=None,
-                    slices=2, size=1000, scroll='5m', workers=None):
+                    slices=2, size=1000, scroll='5m', workers=None, pit=False, keep_alive='1m',
+                    search_after=None, processes=None, queue_depth=None, pit_id=None, on_pit_id=None):
+        """
+        Scans the slices of a query concurrently, calling `handler` on every
+        hit. With `pit` every slice pages through one shared point in time,
+        the latest id of which is closed when the scan completes or fails, or
+        the given `pit_id`, left open for the caller and needed to resume with
+        `search_after`, mapping slice ids to the sort to resume each slice from.
+        `on_pit_id` is told of each id the searches return.
+        With `processes` the slices only fetch, handing pages of `size` hits
+        to a ProcessPoolHandler, and the ScanStats of its workers are returned
+        """
         if query is None:
             query = Query().match_all()
 
-        def w_handler(slice_id):
+        if pit:
+            self.check_resume(search_after, pit_id)
+        owned = pit and pit_id is None
+        if owned:
+            pit_id = self.open_point_in_time(index, keep_alive)
+        # searches may hand back a new id for the point in time, the last one is closed
+        latest_pit_id = [pit_id]
+
+        def renewed(new_pit_id):
+            latest_pit_id[0] = new_pit_id
+            if on_pit_id is not None:
+                on_pit_id(new_pit_id)
+
+        def slice_pages(slice_id):
+            if pit:
+                sliced_query = Body().query(query).source(fields).build()
+                yield from self.iterate_pages(index,
+                                              query=sliced_query,
+                                              size=size,
+                                              keep_alive=keep_alive,
+                                              search_after=get(search_after, slice_id),
+                                              slice=Slice(slice_id, slices) if slices > 1 else None,
+                                              pit_id=pit_id,
+                                              on_pit_id=renewed)
+                return
+
             sliced_query = Body()\
                 .query(query)\
                 .slice(Slice(slice_id, slices))\
                 .source(fields)\
                 .build()
+            page = []
             for hit in self.scan(index,
                                  query=sliced_query,
                                  size=size,
                                  scroll=scroll):
-                handler(hit)
+                page.append(hit)
+                if len(page) == size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+
+        pool_handler = ProcessPoolHandler(handler, processes=processes, queue_depth=queue_depth) \
+            if processes else None
+
+        def w_handler(slice_id):
+            for page in slice_pages(slice_id):
+                if pool_handler is not None:
+                    pool_handler.submit(page)
+                else:
+                    for hit in page:
+                        handler(hit)
 
-        swarm(w_handler, range(0, slices), workers=workers or slices)
+        try:
+            swarm(w_handler, range(0, slices), workers=workers or slices)
+            if pool_handler is not None:
+                return pool_handler.close()
+        except Exception:
+            if pool_handler is not None:
+                pool_handler.abort()
+            raise
+        finally:
+            if owned:
+                self.close_point_in_time(latest_pit_id[0])
 
     @checkargs
     def get_mappings(self, index: string):
@@ -215,10 +584,14 @@ class MultiWriteStore(Store):
     """
     A store that handles batch writes, each function call registers an
     intent to do a write, with the subsequent `write` function doing
-    the bulk persist
+    the bulk persist. With a `retry_policy`, items rejected by a saturated
+    cluster are retried with backoff rather than failing the write, and with
+    `coalesce` repeated writes to the same document are folded together
     """
-    def __init__(self):
-        self.bulk_builder = BulkBuilder()
+    def __init__(self, retry_policy=None, coalesce=False):
+        self.bulk_builder = BulkBuilder(coalesce=coalesce)
+        self.retry_policy = retry_policy
+        self.coalesce = coalesce
 
     def create(self, id, index, doc):
         doc['created_time'] = now()
@@ -246,12 +619,41 @@ class MultiWriteStore(Store):
     def delete(self, id, index):
         self.bulk_builder.delete(id, index)
 
-    def write(self, es, chunk_size=500):
-        return self.bulk_builder.commit(es, chunk_size=chunk_size)
+    def write(self, es, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        return self.bulk_builder.commit(es, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                        retry_policy=self.retry_policy)
+
+    def stream_write(self, es, actions=None, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                     on_failure=None):
+        return self.bulk_builder.stream_commit(es, actions=actions, chunk_size=chunk_size,
+                                               max_chunk_bytes=max_chunk_bytes, on_failure=on_failure,
+                                               retry_policy=self.retry_policy)
+
+    def auto_flush(self, es, **kwargs):
+        """
+        Swaps in an AutoFlushingBulkBuilder, carrying over any pending actions
+        """
+        self.stop_auto_flush()
+        pending = self.bulk_builder.drain()
+        kwargs.setdefault('retry_policy', self.retry_policy)
+        kwargs.setdefault('coalesce', self.coalesce)
+        self.bulk_builder = AutoFlushingBulkBuilder(es, **kwargs)
+        for action in pending:
+            self.bulk_builder.add(action)
+        return self.bulk_builder.start()
+
+    def stop_auto_flush(self):
+        if isinstance(self.bulk_builder, AutoFlushingBulkBuilder):
+            auto_flushing_builder = self.bulk_builder
+            self.bulk_builder = BulkBuilder(coalesce=self.coalesce)
+            return auto_flushing_builder.stop()
 
     def pending(self):
         return self.bulk_builder.count()
 
+    def eliminated(self):
+        return self.bulk_builder.eliminated_count()
+
 
 class MultiGetStore(Store):
     """
@@ -267,7 +669,10 @@ class MultiGetStore(Store):
         self.multiget.get(id, index, id, **params)
 
     def get_all(self, es):
-        response = self.multiget.multiget(es)
+        return self.sources_by_key(self.multiget.multiget(es))
+
+    @staticmethod
+    def sources_by_key(response):
         return_value = {}
         for id, result in response.items():
             if get(result, 'found') is True and get(result, 'error') is None:
@@ -284,16 +689,18 @@ class MultiQueryStore(Store):
     """
     A store that handles batch queries, each function call registers an
     intent to do a query/suggest, with the subsequent `query_all` function doing
-    the bulk query
+    the bulk query, split into msearch chunks of `chunk_size` queries
     """
-    def __init__(self):
-        self.query_builder = QueryBuilder()
+    def __init__(self, chunk_size=DEFAULT_MSEARCH_CHUNK_SIZE, max_concurrent_searches=None):
+        self.query_builder = QueryBuilder(chunk_size=chunk_size, max_concurrent_searches=max_concurrent_searches)
 
-    def query(self, index, query, key=None, transform=None, hits=True, just_one=False, include_id=False):
+    def query(self, index, query, key=None, transform=None, hits=True, just_one=False, include_id=False,
+              in_place=False):
         if key is None:
             raise ValueError("A query key must be supplied")
 
-        store_transform = build_transform(transform, hits=hits, just_one=just_one, include_id=include_id)
+        store_transform = build_transform(transform, hits=hits, just_one=just_one, include_id=include_id,
+                                          in_place=in_place)
 
         self.query_builder.query(key, index, query, transform=store_transform)
 
@@ -318,10 +725,12 @@ class BatchStore(Store):
     """
     A store that wraps the MultiWriteStore, MultiGetStore and MultiQueryStore
     """
-    def __init__(self, es):
-        self.multi_write_store = MultiWriteStore()
+    def __init__(self, es, retry_policy=None, coalesce=False, msearch_chunk_size=DEFAULT_MSEARCH_CHUNK_SIZE,
+                 max_concurrent_searches=None):
+        self.multi_write_store = MultiWriteStore(retry_policy=retry_policy, coalesce=coalesce)
         self.multi_get_store = MultiGetStore()
-        self.multi_query_store = MultiQueryStore()
+        self.multi_query_store = MultiQueryStore(chunk_size=msearch_chunk_size,
+                                                 max_concurrent_searches=max_concurrent_searches)
         self.es = es
 
     def create(self, id, index, doc):
@@ -345,9 +754,10 @@ class BatchStore(Store):
     def delete(self, id, index):
         self.multi_write_store.delete(id, index)
 
-    def query(self, index, query, key=None, transform=None, hits=True, just_one=False, include_id=False):
+    def query(self, index, query, key=None, transform=None, hits=True, just_one=False, include_id=False,
+              in_place=False):
         self.multi_query_store.query(index, query, key=key, transform=transform, hits=hits, just_one=just_one,
-                                     include_id=include_id)
+                                     include_id=include_id, in_place=in_place)
 
     def count(self, index, query, key=None):
         query['size'] = 0
@@ -357,8 +767,18 @@ class BatchStore(Store):
     def suggest(self, index, field, prefix, key=None, contexts=None):
         self.multi_query_store.suggest(index, field, prefix, key=key, contexts=contexts)
 
-    def write(self, chunk_size=500):
-        self.multi_write_store.write(self.es, chunk_size=chunk_size)
+    def write(self, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        self.multi_write_store.write(self.es, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes)
+
+    def stream_write(self, actions=None, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, on_failure=None):
+        return self.multi_write_store.stream_write(self.es, actions=actions, chunk_size=chunk_size,
+                                                   max_chunk_bytes=max_chunk_bytes, on_failure=on_failure)
+
+    def auto_flush(self, **kwargs):
+        return self.multi_write_store.auto_flush(self.es, **kwargs)
+
+    def stop_auto_flush(self):
+        return self.multi_write_store.stop_auto_flush()
 
     def do_get(self):
         return self.multi_get_store.get_all(self.es)
@@ -369,6 +789,9 @@ class BatchStore(Store):
     def pending_writes(self):
         return self.multi_write_store.pending()
 
+    def eliminated_writes(self):
+        return self.multi_write_store.eliminated()
+
     def pending_gets(self):
         return self.multi_get_store.pending()
 
@@ -376,6 +799,51 @@ class BatchStore(Store):
         return self.multi_query_store.pending()
 
 
+# The stack of open `batch()` scopes, held per thread/asyncio task
+batch_scopes = ContextVar('batch_scopes', default=())
+
+
+def current_batch_store(owner, default):
+    for scope in reversed(batch_scopes.get()):
+        if scope.owner is owner:
+            return scope.batch_store
+    return default
+
+
+class BatchScope:
+    """
+    The write/get/query buffers of a single `batch()` block, only visible to the
+    thread or task that opened it. Results realized in the block, or by the
+    flush on exit, are kept on `gets` and `queries`
+    """
+    def __init__(self, owner, batch_store):
+        self.owner = owner
+        self.batch_store = batch_store
+        self.gets = {}
+        self.queries = {}
+
+    def write(self, size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        self.batch_store.write(chunk_size=size, max_chunk_bytes=max_chunk_bytes)
+
+    def get_all(self):
+        results = self.batch_store.do_get()
+        self.gets.update(results)
+        return results
+
+    def query_all(self):
+        results = self.batch_store.do_query()
+        self.queries.update(results)
+        return results
+
+    def flush(self):
+        if self.batch_store.pending_writes():
+            self.write()
+        if self.batch_store.pending_gets():
+            self.get_all()
+        if self.batch_store.pending_queries():
+            self.query_all()
+
+
 class MegaStore(Store):
     """
     A store that wraps the ElasticsearchStore and the BatchStore,
@@ -383,49 +851,218 @@ class MegaStore(Store):
     to. If batch is set to true, the calls will delegate to the BatchStore,
     with operations being realized with the `batch_write`, `batch_get` and
     `batch_query` functions. If batch is false (which it is by default),
-    the ElasticsearchStore is used, and the result it evaluated immediately
+    the ElasticsearchStore is used, and the result it evaluated immediately.
+    A `serializer` (an instance, or 'json'/'orjson') is installed on the client,
+    for its other users too, and used for every request and response body, a `retry_policy` applies
+    to the batched writes, and `coalesce_writes` folds repeated batched writes
+    to the same document together. Batched queries are sent in msearch chunks of
+    `msearch_chunk_size`, with `max_concurrent_searches` passed to each.
+    Inside a `with store.batch():` block batched calls go to buffers private to
+    the current thread/task, rather than the shared BatchStore.
+    With a `query_cache` (a QueryCache) unbatched queries and counts are served
+    from it, an index's entries being dropped whenever the store writes to,
+    deletes from or refreshes it. Queries through an alias, a pattern or a list
+    of indices aren't cached, as writes go by the concrete index names. With
+    `coalesce_reads` concurrent identical unbatched gets, queries and counts
+    share a single request
     """
-    def __init__(self, es):
+    def __init__(self, es, serializer=None, retry_policy=None, coalesce_writes=False,
+                 msearch_chunk_size=DEFAULT_MSEARCH_CHUNK_SIZE, max_concurrent_searches=None, query_cache=None,
+                 coalesce_reads=False):
+        if serializer is not None:
+            use_serializer(es, serializer)
         self.es = es
+        self.retry_policy = retry_policy
+        self.coalesce_writes = coalesce_writes
+        self.msearch_chunk_size = msearch_chunk_size
+        self.max_concurrent_searches = max_concurrent_searches
+        self.query_cache = query_cache
+        self.single_flight = SingleFlight() if coalesce_reads else None
+        self.concrete_indices = {}
+        self.dirty_indices = set()
+        self.dirty_lock = threading.Lock()
+        self.flush_listeners = []
         self.elasticsearch_store = ElasticsearchStore(es)
-        self.batch_store = BatchStore(es)
+        self.batch_store = self.new_batch_store()
+
+    def new_batch_store(self):
+        return BatchStore(self.es, retry_policy=self.retry_policy, coalesce=self.coalesce_writes,
+                          msearch_chunk_size=self.msearch_chunk_size,
+                          max_concurrent_searches=self.max_concurrent_searches)
+
+    def get_batch_store(self):
+        return current_batch_store(self, self.batch_store)
 
     def get_store(self, batch):
         if batch:
-            return self.batch_store
+            return self.get_batch_store()
         else:
             return self.elasticsearch_store
 
+    @contextmanager
+    def batch(self, flush=True):
+        """
+        Opens a batch scope with its own write, get and query buffers for the
+        current thread/task, so concurrent callers can't realize each other's
+        intents. Scopes nest, and anything still pending is flushed when the
+        block exits cleanly
+        """
+        scope = BatchScope(self, self.new_batch_store())
+        token = batch_scopes.set(batch_scopes.get() + (scope,))
+        try:
+            yield scope
+            if flush:
+                scope.flush()
+                self.flushed()
+        finally:
+            batch_scopes.reset(token)
+
+    def written(self, index, batch=False):
+        """
+        Drops the cached queries of an index the store has written to, and
+        detaches its in flight reads so later ones see the write, batched
+        writes invalidate it again once they are committed
+        """
+        if self.query_cache is not None or self.single_flight is not None:
+            self.invalidate_index(index)
+            if batch:
+                with self.dirty_lock:
+                    self.dirty_indices.add(index)
+
+    def invalidate_index(self, index):
+        if self.query_cache is not None:
+            self.query_cache.invalidate_index(index)
+        if self.single_flight is not None:
+            # reads through an alias may cover the index too
+            self.single_flight.forget(lambda key: key[0] == index or not self.concrete_indices.get(key[0], True))
+
+    def is_concrete(self, index):
+        """
+        Whether `index` names a single index rather than an alias, a pattern or
+        a list, looked up once per name
+        """
+        if not isinstance(index, str):
+            return False
+        concrete = self.concrete_indices.get(index)
+        if concrete is None:
+            concrete = index != '_all' and not any(c in index for c in ',*') and \
+                not self.es.indices.exists_alias(name=index)
+            self.concrete_indices[index] = concrete
+        return concrete
+
+    def on_flushed(self, listener):
+        """
+        Registers a function to be called, with `pending`, whenever batched
+        writes are committed
+        """
+        self.flush_listeners.append(listener)
+
+    def flushed(self, pending=False):
+        """
+        Invalidates what the committed batched writes touched. While writes are
+        still `pending`, as with a background flush, the indices stay dirty to
+        be invalidated again by the flush that commits them
+        """
+        with self.dirty_lock:
+            dirty_indices = self.dirty_indices
+            if not pending:
+                self.dirty_indices = set()
+            else:
+                dirty_indices = set(dirty_indices)
+        for index in dirty_indices:
+            self.invalidate_index(index)
+        for listener in self.flush_listeners:
+            listener(pending=pending)
+
     def create(self, id, index, doc, batch=False):
         self.get_store(batch).create(id, index, doc)
+        self.written(index, batch=batch)
 
     def upsert(self, id, index, doc, batch=False):
         self.get_store(batch).upsert(id, index, doc)
+        self.written(index, batch=batch)
 
     def update(self, id, index, doc, batch=False):
         self.get_store(batch).update(id, index, doc)
+        self.written(index, batch=batch)
 
     def index(self, id, index, doc, batch=False):
         self.get_store(batch).index(id, index, doc)
+        self.written(index, batch=batch)
 
     def script_update(self, id, index, script, params=None, initial=None, batch=False):
         self.get_store(batch).script_update(id, index, script, params=params, initial=initial)
+        self.written(index, batch=batch)
 
     def get(self, id, index, batch=False, **params):
-        return self.get_store(batch).get(id, index, **params)
+        if batch or self.single_flight is None:
+            return self.get_store(batch).get(id, index, **params)
+        return self.read(QueryCache.key(index, params, 'get', id),
+                         lambda: self.elasticsearch_store.get(id, index, **params),
+                         cacheable=False)
+
+    def multi_get(self, index, ids, **params):
+        return self.elasticsearch_store.multi_get(index, ids, **params)
 
     def delete(self, id, index, batch=False):
         self.get_store(batch).delete(id, index)
+        self.written(index, batch=batch)
 
     def delete_by_query(self, index, query):
         self.get_store(False).delete_by_query(index, query)
+        self.written(index)
+
+    def cached(self, cache_key, f):
+        result = self.query_cache.get(cache_key, MISSING)
+        if result is MISSING:
+            # a write landing while the query runs leaves its result unstored
+            generation = self.query_cache.generation(cache_key[0])
+            result = f()
+            self.query_cache.put_if_current(cache_key, result, generation)
+        return result
+
+    def read(self, read_key, f, cacheable=True):
+        """
+        Realizes an unbatched read, through the query cache and the single
+        flight when they are enabled. Only reads of a concrete index are cached
+        """
+        if self.query_cache is None and self.single_flight is None:
+            return f()
+        concrete = self.is_concrete(read_key[0])
+
+        def fetch():
+            if self.single_flight is not None:
+                return self.single_flight.do(read_key, f)
+            return f()
+
+        if cacheable and concrete and self.query_cache is not None:
+            return self.cached(read_key, fetch)
+        return fetch()
 
     def query(self, index, query, key=None, batch=False, transform=None, hits=True,
-              just_one=False, include_id=False):
+              just_one=False, include_id=False, stream=False, in_place=False):
         if isinstance(query, Body):
             query = query.build()
-        return self.get_store(batch).query(index, query, key=key, transform=transform, hits=hits,
-                                           just_one=just_one, include_id=include_id)
+
+        if stream and not batch:
+            return self.elasticsearch_store.query(index, query, transform=transform, hits=hits,
+                                                  just_one=just_one, include_id=include_id, stream=True)
+
+        def do_query():
+            return self.get_store(batch).query(index, query, key=key, transform=transform, hits=hits,
+                                               just_one=just_one, include_id=include_id, in_place=in_place)
+
+        if batch:
+            return do_query()
+
+        # Reads are shared by the query and the flags, the caller's own
+        # transform is applied to its copy of the result
+        def do_read():
+            return self.elasticsearch_store.query(index, query, hits=hits, just_one=just_one, include_id=include_id,
+                                                  in_place=in_place)
+
+        result = self.read(QueryCache.key(index, query, 'query', hits, just_one, include_id), do_read)
+        return transform(result) if transform else result
 
     def count(self, index, query, key=None, batch=False):
         if isinstance(query, Query):
@@ -433,7 +1070,12 @@ class MegaStore(Store):
 
         query = {'query': query}
 
-        return self.get_store(batch).count(index, query, key=key)
+        def do_count():
+            return self.get_store(batch).count(index, query, key=key)
+
+        if batch:
+            return do_count()
+        return self.read(QueryCache.key(index, query, 'count'), do_count)
 
     def profile(self, index, query, no_source=True):
         return self.get_store(False).profile(index, query, no_source=no_source)
@@ -441,33 +1083,122 @@ class MegaStore(Store):
     def suggest(self, index, field, prefix, key=None, batch=False, contexts=None):
         return self.get_store(batch).suggest(index, field, prefix, key=key, contexts=contexts)
 
-    def batch_write(self, size=500):
-        self.batch_store.write(chunk_size=size)
+    def batch_write(self, size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES):
+        try:
+            self.get_batch_store().write(chunk_size=size, max_chunk_bytes=max_chunk_bytes)
+        finally:
+            self.flushed()
+
+    def stream_write(self, actions=None, size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, on_failure=None):
+        """
+        Streams an iterable of bulk actions (as built by the BulkBuilder), or the
+        pending batched writes when none are given, keeping memory flat. Only
+        failures are surfaced, through `on_failure`, and the BulkStats returned
+        """
+        try:
+            return self.get_batch_store().stream_write(actions=actions, chunk_size=size,
+                                                       max_chunk_bytes=max_chunk_bytes, on_failure=on_failure)
+        finally:
+            self.flushed()
+
+    def auto_flush(self, max_actions=500, max_bytes=None, max_age=1.0, max_pending=None,
+                   thread_count=4, chunk_size=500, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                   on_flush=None, on_error=None):
+        """
+        Batched writes are committed on a background thread whenever `max_actions`,
+        `max_bytes` (estimated) or `max_age` (seconds) is reached, until
+        `stop_auto_flush` is called. Each background commit, failed or not,
+        invalidates what the batched writes touched. A failed commit hands the
+        error and the actions that failed to `on_error(error, actions)`
+        """
+        def flushed(results):
+            self.flushed(pending=self.batch_store.pending_writes() > 0)
+            if on_flush:
+                on_flush(results)
+
+        def failed(e, actions):
+            self.flushed(pending=self.batch_store.pending_writes() > 0)
+            if on_error:
+                on_error(e, actions)
+            else:
+                logger.error("Auto flush of %i bulk actions failed: %s", len(actions), e)
+
+        return self.batch_store.auto_flush(max_actions=max_actions,
+                                           max_bytes=max_bytes,
+                                           max_age=max_age,
+                                           max_pending=max_pending,
+                                           thread_count=thread_count,
+                                           chunk_size=chunk_size,
+                                           max_chunk_bytes=max_chunk_bytes,
+                                           on_flush=flushed,
+                                           on_error=failed)
+
+    def stop_auto_flush(self):
+        try:
+            return self.batch_store.stop_auto_flush()
+        finally:
+            self.flushed()
 
     def batch_get(self):
-        return self.batch_store.do_get()
+        return self.get_batch_store().do_get()
 
     def batch_query(self):
-        return self.batch_store.do_query()
+        return self.get_batch_store().do_query()
 
     def refresh_index(self, index):
         self.get_store(False).refresh_index(index)
+        self.written(index)
 
     def reindex(self, reindex_body):
         self.get_store(False).reindex(reindex_body)
+        if self.query_cache is not None:
+            self.query_cache.clear()
+        if self.single_flight is not None:
+            self.single_flight.forget(lambda key: True)
+
+    def scan(self, index, query=None, size=1000, scroll='5m', pit=False, keep_alive='1m', search_after=None,
+             prefetch=0, stream=False, pit_id=None, on_pit_id=None):
+        return self.elasticsearch_store.scan(index, query=query, size=size, scroll=scroll, pit=pit,
+                                             keep_alive=keep_alive, search_after=search_after, prefetch=prefetch,
+                                             stream=stream, pit_id=pit_id, on_pit_id=on_pit_id)
+
+    def scan_pages(self, index, query=None, size=1000, scroll='5m', pit=False, keep_alive='1m',
+                   search_after=None, prefetch=0, pit_id=None, on_pit_id=None):
+        return self.elasticsearch_store.scan_pages(index, query=query, size=size, scroll=scroll, pit=pit,
+                                                   keep_alive=keep_alive, search_after=search_after,
+                                                   prefetch=prefetch, pit_id=pit_id, on_pit_id=on_pit_id)
+
+    def iterate_pages(self, index, query=None, size=1000, keep_alive='1m', track_total_hits=False,
+                      search_after=None, pit_id=None, on_pit_id=None):
+        if isinstance(query, Body):
+            query = query.build()
+        return self.elasticsearch_store.iterate_pages(index, query=query, size=size, keep_alive=keep_alive,
+                                                      track_total_hits=track_total_hits, search_after=search_after,
+                                                      pit_id=pit_id, on_pit_id=on_pit_id)
+
+    def open_point_in_time(self, index, keep_alive='1m'):
+        return self.elasticsearch_store.open_point_in_time(index, keep_alive)
 
-    def scan(self, index, query=None, size=1000, scroll='5m'):
-        return self.elasticsearch_store.scan(index, query=query, size=size, scroll=scroll)
+    def close_point_in_time(self, pit_id):
+        self.elasticsearch_store.close_point_in_time(pit_id)
 
     def sliced_scan(self, index, handler, query=None, fields=None,
-                    slices=2, size=1000, scroll='5m', workers=None):
-        self.elasticsearch_store.sliced_scan(index, handler,
-                                             query=query,
-                                             fields=fields,
-                                             slices=slices,
-                                             size=size,
-                                             scroll=scroll,
-                                             workers=workers)
+                    slices=2, size=1000, scroll='5m', workers=None, pit=False, keep_alive='1m',
+                    search_after=None, processes=None, queue_depth=None, pit_id=None, on_pit_id=None):
+        return self.elasticsearch_store.sliced_scan(index, handler,
+                                                    query=query,
+                                                    fields=fields,
+                                                    slices=slices,
+                                                    size=size,
+                                                    scroll=scroll,
+                                                    workers=workers,
+                                                    pit=pit,
+                                                    keep_alive=keep_alive,
+                                                    search_after=search_after,
+                                                    processes=processes,
+                                                    queue_depth=queue_depth,
+                                                    pit_id=pit_id,
+                                                    on_pit_id=on_pit_id)
 
     def get_mappings(self, index):
         return self.elasticsearch_store.get_mappings(index)
@@ -488,21 +1219,37 @@ class MegaStore(Store):
         return self.elasticsearch_store.explain(index, id, body)
 
     def pending_writes(self):
-        return self.batch_store.pending_writes()
+        return self.get_batch_store().pending_writes()
+
+    def eliminated_writes(self):
+        """
+        The number of batched writes dropped or merged away by coalescing
+        """
+        return self.get_batch_store().eliminated_writes()
+
+    def collapsed_reads(self):
+        """
+        The number of unbatched reads that shared another caller's request
+        """
+        return self.single_flight.collapsed if self.single_flight is not None else 0
 
     def pending_gets(self):
-        return self.batch_store.pending_gets()
+        return self.get_batch_store().pending_gets()
 
     def pending_queries(self):
-        return self.batch_store.pending_queries()
+        return self.get_batch_store().pending_queries()
 
     def clear_cache(self, index):
         return self.elasticsearch_store.clear_cache(index)
 
 
-def new_mega_store(hostname="localhost"):
+def new_mega_store(hostname="localhost", serializer=None, retry_policy=None, coalesce_writes=False,
+                   msearch_chunk_size=DEFAULT_MSEARCH_CHUNK_SIZE, max_concurrent_searches=None, query_cache=None,
+                   coalesce_reads=False):
     es = Elasticsearch(hostname)
-    return MegaStore(es)
+    return MegaStore(es, serializer=serializer, retry_policy=retry_policy, coalesce_writes=coalesce_writes,
+                     msearch_chunk_size=msearch_chunk_size, max_concurrent_searches=max_concurrent_searches,
+                     query_cache=query_cache, coalesce_reads=coalesce_reads)
 
 
 class ConflictException(Exception):
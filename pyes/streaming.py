@@ -0,0 +1,322 @@
+import codecs
+import json
+import re
+from urllib.parse import urlencode
+
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, SSLError, TransportError
+from urllib3.exceptions import HTTPError, ReadTimeoutError, SSLError as UrllibSSLError
+
+from pyes.response import get_hits
+
+STREAM_CHUNK_BYTES = 64 * 1024
+
+decoder = json.JSONDecoder()
+
+CAPTURED = ('_scroll_id', 'pit_id', '_shards')
+
+STRUCTURE_TOKEN = re.compile(r'["{}\[\]]')
+STRING_TOKEN = re.compile(r'["\\]')
+
+
+class StreamEnded(Exception):
+    pass
+
+
+class HitStream(object):
+    """
+    Iterates the `hits.hits` of a search response as they are decoded from
+    the raw body, so only one hit, and one chunk of the body, is held at a
+    time. Top level values named in `capture`, such as `_scroll_id`, `pit_id`
+    or `_shards`, are kept on `captured`. Anything after the hits array, such as
+    aggregations, is not read. Hits are decoded with `loads` when given
+    """
+    def __init__(self, chunks, capture=CAPTURED, on_close=None, loads=None):
+        self.chunks = iter(chunks)
+        self.capture = capture
+        self.on_close = on_close
+        self.loads = loads
+        self.captured = {}
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.finished = False
+        self.hits = self.iterate_hits()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.hits.__next__()
+
+    def close(self):
+        self.hits.close()
+        self.release()
+
+    def release(self):
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close(self.finished)
+
+    def read(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            raise StreamEnded()
+        self.buffer = self.buffer[self.pos:] + self.text.decode(chunk)
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            self.read()
+
+    def decode_value(self, loads=None):
+        """
+        Decodes the complete JSON value at the current position, reading more
+        of the body as long as it is cut short
+        """
+        if self.peek() in '{["':
+            end = self.value_end()
+            if loads is not None:
+                value = loads(self.buffer[self.pos:end])
+            else:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            self.pos = end
+            return value
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                if end == len(self.buffer) or self.buffer[end] not in ',:}] \t\r\n':
+                    # a number may continue in the next chunk
+                    raise ValueError()
+                self.pos = end
+                return value
+            except ValueError:
+                try:
+                    self.read()
+                except StreamEnded:
+                    value, self.pos = decoder.raw_decode(self.buffer, self.pos)
+                    return value
+
+    def value_end(self):
+        """
+        Finds the end of the string, array or object at the current position,
+        reading more of the body until it is complete. The scan carries on
+        from where the last chunk ran out, so a value spread over many chunks
+        is only read through once
+        """
+        scanned = self.pos
+        depth = 0
+        in_string = False
+        while True:
+            match = (STRING_TOKEN if in_string else STRUCTURE_TOKEN).search(self.buffer, scanned)
+            if match is None:
+                scanned -= self.more()
+                continue
+            token = match.group()
+            scanned = match.end()
+            if in_string:
+                if token == '\\':
+                    # the escaped character may be in the next chunk
+                    while scanned >= len(self.buffer):
+                        scanned -= self.more()
+                    scanned += 1
+                    continue
+                in_string = False
+                if depth == 0:
+                    return scanned
+            elif token == '"':
+                in_string = True
+            elif token in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return scanned
+
+    def more(self):
+        """
+        Reads the next chunk, returning how far the buffer positions moved
+        """
+        moved = self.pos
+        self.read()
+        return moved
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise ValueError("Expected '{0}' at '{1}'".format(token, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def members(self):
+        """
+        Yields the keys of the object at the current position, leaving the
+        position on each value
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(':')
+            yield key
+            token = self.peek()
+            self.pos += 1
+            if token == '}':
+                return
+            if token != ',':
+                raise ValueError("Malformed object at '{0}'".format(self.buffer[self.pos - 1:self.pos + 20]))
+
+    def iterate_hits(self):
+        try:
+            for key in self.members():
+                if key == 'hits' and self.peek() == '{':
+                    for hits_key in self.members():
+                        if hits_key == 'hits':
+                            yield from self.iterate_array()
+                            self.finished = True
+                            return
+                        self.decode_value()
+                    return
+                value = self.decode_value()
+                if key in self.capture:
+                    self.captured[key] = value
+        except StreamEnded:
+            raise ValueError("The response ended part way through its hits")
+        finally:
+            self.release()
+
+    def iterate_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            return
+        while True:
+            yield self.decode_value(self.loads)
+            token = self.peek()
+            self.pos += 1
+            if token == ']':
+                return
+            if token != ',':
+                raise ValueError("Malformed hits at '{0}'".format(self.buffer[self.pos - 1:self.pos + 20]))
+
+
+class DecodedHitStream(object):
+    """
+    The HitStream interface over an already decoded response
+    """
+    def __init__(self, response, capture=CAPTURED):
+        self.captured = {key: response[key] for key in capture if key in response}
+        self.hits = iter(get_hits(response))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.hits.__next__()
+
+    def close(self):
+        pass
+
+
+def open_response(connection, serializer, method, path, body=None, params=None):
+    """
+    Sends a request on a urllib3 connection, returning the response unread.
+    The response is asked for uncompressed, so it can be decoded as it
+    arrives, while the request body is compressed as the connection would
+    """
+    url = connection.url_prefix + path
+    if params:
+        url = "{0}?{1}".format(url, urlencode(params))
+    headers = connection.headers.copy()
+    headers['content-type'] = serializer.mimetype
+    headers['accept-encoding'] = 'identity'
+    data = serializer.dumps(body).encode('utf-8', 'surrogatepass') if body is not None else None
+    if data and connection.http_compress:
+        data = connection._gzip_compress(data)
+        headers['content-encoding'] = 'gzip'
+
+    try:
+        response = connection.pool.urlopen(method, url, data, headers=headers, preload_content=False,
+                                           retries=False)
+    except HTTPError as e:
+        raise connection_error(e)
+
+    if not (200 <= response.status < 300):
+        raw_data = response.data.decode('utf-8', 'surrogatepass')
+        response.release_conn()
+        connection._raise_error(response.status, raw_data)
+    return response
+
+
+def connection_error(e):
+    if isinstance(e, UrllibSSLError):
+        return SSLError('N/A', str(e), e)
+    if isinstance(e, ReadTimeoutError):
+        return ConnectionTimeout('TIMEOUT', str(e), e)
+    return ConnectionError('N/A', str(e), e)
+
+
+def stream_chunks(response, chunk_bytes):
+    try:
+        yield from response.stream(chunk_bytes, decode_content=True)
+    except HTTPError as e:
+        raise connection_error(e)
+
+
+def stream_request(es, method, path, body=None, params=None, chunk_bytes=STREAM_CHUNK_BYTES):
+    """
+    Performs a search style request, returning a HitStream over the raw
+    response body. Connections come from the client's transport, which
+    sniffs and marks them dead or live as for any request, and failures are
+    retried as the transport would, until the body starts to stream. Once
+    hits are being handed out a failure is raised as is. Requests are encoded
+    and hits decoded with the client's serializers. Connections without a
+    urllib3 pool fall back on a decoded response
+    """
+    transport = es.transport
+    for attempt in range(transport.max_retries + 1):
+        connection = transport.get_connection()
+        if not hasattr(connection, 'pool'):
+            return DecodedHitStream(transport.perform_request(method, path, params=params, body=body))
+
+        try:
+            response = open_response(connection, transport.serializer, method, path, body=body, params=params)
+        except TransportError as e:
+            if isinstance(e, ConnectionTimeout):
+                retry = transport.retry_on_timeout
+            elif isinstance(e, ConnectionError):
+                retry = True
+            else:
+                retry = e.status_code in transport.retry_on_status
+
+            if not retry:
+                raise
+            try:
+                transport.mark_dead(connection)
+            except TransportError:
+                pass
+            if attempt == transport.max_retries:
+                raise
+        else:
+            transport.connection_pool.mark_live(connection)
+            return hit_stream(transport, response, chunk_bytes)
+
+
+def hit_stream(transport, response, chunk_bytes):
+    content_type = response.headers.get('content-type')
+
+    def loads(text):
+        return transport.deserializer.loads(text, content_type)
+
+    def release(finished):
+        # an abandoned body is not worth reading to the end to reuse the connection
+        if finished:
+            response.drain_conn()
+        else:
+            response.close()
+        response.release_conn()
+
+    return HitStream(stream_chunks(response, chunk_bytes), on_close=release, loads=loads)
@@ -1,10 +1,11 @@
 from uuid import uuid4
-import collections
+import collections.abc
 import logging
+from itertools import islice
 from elasticsearch.helpers import scan
 
 from pyes.query_builder import Query, Body
-from pyfunk.pyfunk import merge
+from pyfunk.pyfunk import merge, get_in
 
 logger = logging.getLogger(__name__)
 
@@ -21,11 +22,24 @@ def uuid():
 
 
 class ChildByParentScroller:
-    def __init__(self, es, index, parent_ids, batch, opts=None):
+    """
+    Iterates the children of a stream of parent ids, with one scan per parent.
+    Given a `chunk_size` it iterates `(parent_id, child hit)` pairs instead,
+    with one scan per `chunk_size` parents, matching children with a terms
+    query on `join_field`, or a `has_parent` ids query with
+    `lookup='has_parent'`. Each chunk's children are sorted by their parent,
+    so pairs follow the chunks in order, and within a chunk the parent ids
+    sorted, each child being yielded as it arrives rather than held until
+    the chunk completes. Chunks are scanned through `store` when given, a
+    point in time with `pit`, and the join field is always part of the child
+    sources, as it names the parent
+    """
+    def __init__(self, es, index, parent_ids, batch, opts=None, join_field=None, parent_type=None, chunk_size=None,
+                 lookup='terms', store=None, pit=False):
         self.es = es
         self.index = index
 
-        if isinstance(parent_ids, collections.Iterable):
+        if isinstance(parent_ids, collections.abc.Iterable):
             self.parent_ids = iter(parent_ids)
         else:
             self.parent_ids = parent_ids
@@ -35,7 +49,21 @@ class ChildByParentScroller:
         self.parent_id = None
         self.es_scroller = None
 
-        self.next_parent()
+        self.join_field = join_field
+        self.parent_type = parent_type
+        self.chunk_size = chunk_size
+        self.lookup = lookup
+        self.store = store
+        self.pit = pit
+
+        if chunk_size:
+            if join_field is None or parent_type is None:
+                raise ValueError("Batched scrolling needs a join_field and parent_type")
+            if pit and store is None:
+                raise ValueError("Point in time scrolling needs a store")
+            self.pairs = self.iterate_pairs()
+        else:
+            self.next_parent()
 
     def __iter__(self):
         return self
@@ -56,6 +84,9 @@ class ChildByParentScroller:
                     size=self.batch)
 
     def __next__(self):
+        if self.chunk_size:
+            return self.pairs.__next__()
+
         result = None
         while result is None:
             try:
@@ -67,3 +98,53 @@ class ChildByParentScroller:
                 self.next_parent()
 
         return result
+
+    def next_chunk(self):
+        return list(islice(self.parent_ids, self.chunk_size))
+
+    def with_join_field(self, body):
+        source = body.get('_source')
+        if source is None or source is True:
+            return body
+        if source is False:
+            source = {'includes': [self.join_field]}
+        elif isinstance(source, (str, list)):
+            source = {'includes': ([source] if isinstance(source, str) else list(source)) + [self.join_field]}
+        else:
+            source = dict(source)
+            for key in ['includes', 'excludes']:
+                if isinstance(source.get(key), str):
+                    source[key] = [source[key]]
+            if source.get('includes'):
+                source['includes'] = source['includes'] + [self.join_field]
+            if source.get('excludes'):
+                source['excludes'] = [field for field in source['excludes'] if field != self.join_field]
+        return dict(body, _source=source)
+
+    def children_query(self, parent_ids):
+        parent_field = "{0}#{1}".format(self.join_field, self.parent_type)
+        if self.lookup == 'has_parent':
+            query = Query().has_parent(self.parent_type, Query().ids(parent_ids).build())
+        else:
+            query = Query().terms(parent_field, parent_ids)
+        body = self.with_join_field(merge(Body().query(query).build(), self.opts or {}))
+        # sorted by parent, so each parent's children arrive together
+        sort = body.get('sort', [])
+        return dict(body, sort=[{parent_field: 'asc'}] + (list(sort) if isinstance(sort, (list, tuple)) else [sort]))
+
+    def children_hits(self, parent_ids):
+        body = self.children_query(parent_ids)
+        if self.store is not None:
+            # pages keep the query's sort, where a plain scan sorts by _doc
+            for page in self.store.scan_pages(self.index, query=body, size=self.batch, pit=self.pit):
+                yield from page
+        else:
+            yield from scan(self.es, query=body, index=self.index, size=self.batch, preserve_order=True)
+
+    def iterate_pairs(self):
+        chunk = self.next_chunk()
+        while chunk:
+            for hit in self.children_hits(chunk):
+                self.parent_id = get_in(hit, ['_source', self.join_field, 'parent'])
+                yield self.parent_id, hit
+            chunk = self.next_chunk()
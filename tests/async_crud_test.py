@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from elasticsearch import AsyncElasticsearch
+
+from pyes.async_crud import AsyncESCrudService
+from pyes.async_store import AsyncMegaStore
+from pyes.validators import NotExistsException
+from pyfunk.pyfunk import select_keys
+
+from pyes.test.indices import create_test_index
+
+
+class ThingType:
+    COMMON = "common"
+    UNIQUE = "unique"
+
+
+@create_test_index(indices=["thing"])
+def test_async_lifecycle():
+    async def lifecycle():
+        store = AsyncMegaStore(AsyncElasticsearch("localhost"))
+        thing_service = AsyncESCrudService(store, "thing")
+
+        try:
+            # Create a thing
+            thing_id = await thing_service.create({'thing_type': ThingType.COMMON})
+
+            # Get that thing back
+            created_thing = await thing_service.get_entity(thing_id)
+            assert select_keys(created_thing, ['uid', 'thing_type']) == {'uid': thing_id,
+                                                                         'thing_type': ThingType.COMMON}
+
+            # Update it in a batch
+            await thing_service.update(thing_id, {'thing_type': ThingType.UNIQUE}, batch=True)
+            assert thing_service.pending_writes() == 1
+            await thing_service.batch_write()
+
+            # Get it back through a batch get
+            all_things = await thing_service.get_all([thing_id])
+            assert select_keys(all_things[thing_id], ['uid', 'thing_type']) == {'uid': thing_id,
+                                                                                'thing_type': ThingType.UNIQUE}
+
+            # Delete that thing
+            await thing_service.delete(thing_id)
+
+            # Check the thing no longer exists
+            with pytest.raises(NotExistsException):
+                await thing_service.exists(thing_id)
+        finally:
+            await store.shutdown()
+
+    asyncio.run(lifecycle())
@@ -0,0 +1,54 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pyes.crud import ESCrudService
+from pyfunk.pyfunk import get
+
+from pyes.test.indices import create_test_index
+from pyes.test.fixtures import test_services
+
+
+@create_test_index(indices=["thing"])
+def test_batch_scopes(test_services):
+    store = test_services.store
+    thing_service = ESCrudService(store, "thing")
+
+    for i in range(0, 100):
+        thing_service.create({'thing_number': i}, entity_id=str(i), batch=True)
+
+    # Writes registered outside of a scope stay on the shared batch store
+    with store.batch() as scope:
+        thing_service.create({'thing_number': 100}, entity_id="100", batch=True)
+        assert store.pending_writes() == 1
+    assert scope.batch_store.pending_writes() == 0
+    assert store.pending_writes() == 100
+
+    store.batch_write()
+    thing_service.refresh()
+
+    # Nested scopes keep their own buffers, and are realized on exit
+    with store.batch() as outer:
+        store.get("1", "thing", batch=True)
+        with store.batch() as inner:
+            store.get("2", "thing", batch=True)
+        assert store.pending_gets() == 1
+    assert get(inner.gets["2"], 'thing_number') == 2
+    assert get(outer.gets["1"], 'thing_number') == 1
+
+    # Concurrent batched reads never see each other's intents or results, every
+    # thread registers its gets before any of them realizes its batch
+    registered = threading.Barrier(10, timeout=10)
+
+    def fetch(i):
+        ids = [str(j) for j in range(i, i + 10)]
+        with store.batch():
+            for thing_id in ids:
+                store.get(thing_id, "thing", batch=True)
+            registered.wait()
+            return i, store.batch_get()
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        for i, results in pool.map(fetch, range(0, 90)):
+            assert sorted(results.keys()) == sorted(str(j) for j in range(i, i + 10))
+            assert all(get(results[str(j)], 'thing_number') == j for j in range(i, i + 10))
+    assert store.pending_gets() == 0
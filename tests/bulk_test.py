@@ -0,0 +1,321 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from elasticsearch import ConnectionError
+from elasticsearch.helpers import BulkIndexError
+from elasticsearch.serializer import JSONSerializer
+from pyfunk.pyfunk import first
+
+from pyes.bulk import chunk_actions, BulkBuilder, AutoFlushingBulkBuilder, BulkStats, RetryPolicy, async_stream_bulk
+from pyes.query_builder import Body, Query
+from pyes.store import MegaStore
+
+from pyes.test.indices import create_test_index
+from pyes.test.fixtures import test_services
+
+
+def thing_actions(n):
+    for i in range(0, n):
+        yield {
+            '_op_type': 'index',
+            '_index': 'thing',
+            '_id': str(i),
+            '_source': {'thing_number': i}
+        }
+
+
+@create_test_index(indices=["thing"])
+def test_stream_write(test_services):
+    failures = []
+
+    stats = test_services.store.stream_write(thing_actions(2500), size=500, on_failure=failures.append)
+
+    assert stats.ok == 2500
+    assert stats.failed == 0
+    assert stats.requests == 5
+    assert stats.bytes > 0
+    assert failures == []
+
+    test_services.store.refresh_index('thing')
+    assert test_services.store.count('thing', Query().match_all()) == 2500
+
+    # Pending batched writes stream the same way, with failures surfaced
+    test_services.store.update('missing', 'thing', {'thing_number': -1}, batch=True)
+    test_services.store.index('2500', 'thing', {'thing_number': 2500}, batch=True)
+
+    stats = test_services.store.stream_write(on_failure=failures.append)
+
+    assert stats.ok == 1
+    assert stats.failed == 1
+    assert test_services.store.pending_writes() == 0
+    assert [get_failed_id(failure) for failure in failures] == ['missing']
+
+
+def get_failed_id(failure):
+    for _, item in failure.items():
+        return item['_id']
+
+
+def test_chunk_actions_by_bytes():
+    actions = [{
+        '_op_type': 'index',
+        '_index': 'thing',
+        '_id': str(i),
+        '_source': {'blob': 'x' * 1000}
+    } for i in range(0, 100)]
+
+    chunks = list(chunk_actions(actions, JSONSerializer(), chunk_size=500, max_chunk_bytes=10 * 1024))
+
+    # Every action is kept, in order, with each chunk under the byte cap
+    assert [action for chunk, _, _ in chunks for action in chunk] == actions
+    assert all(size <= 10 * 1024 for _, _, size in chunks)
+    assert len(chunks) == 12
+
+    # The action cap still applies to small documents
+    chunks = list(chunk_actions(thing_actions(1200), JSONSerializer(), chunk_size=500))
+    assert [len(chunk) for chunk, _, _ in chunks] == [500, 500, 200]
+
+
+def test_coalescing():
+    bulk_builder = BulkBuilder(coalesce=True)
+
+    # Consecutive partial updates merge, nested objects merge recursively
+    bulk_builder.update("1", "thing", {'thing_type': 'common', 'meta': {'a': 1}})
+    bulk_builder.update("1", "thing", {'meta': {'b': 2}})
+    bulk_builder.upsert("2", "thing", {'thing_type': 'common'})
+    bulk_builder.update("2", "thing", {'thing_number': 2})
+
+    # An update can't be folded into a later upsert
+    bulk_builder.update("3", "thing", {'thing_type': 'common'})
+    bulk_builder.upsert("3", "thing", {'thing_number': 3})
+
+    # A delete or an index supersedes everything before it
+    bulk_builder.update("4", "thing", {'thing_type': 'common'})
+    bulk_builder.script_update("4", "thing", {'source': 'ctx._source.n += 1'})
+    bulk_builder.delete("4", "thing")
+    bulk_builder.update("5", "thing", {'thing_type': 'common'})
+    bulk_builder.index("5", "thing", {'thing_type': 'unique'})
+    bulk_builder.update("5", "thing", {'thing_number': 5})
+
+    assert bulk_builder.count() == 6
+    assert bulk_builder.eliminated_count() == 6
+
+    assert bulk_builder.drain() == [
+        {'_op_type': 'update', '_index': 'thing', '_id': '1',
+         'doc': {'thing_type': 'common', 'meta': {'a': 1, 'b': 2}}},
+        {'_op_type': 'update', '_index': 'thing', '_id': '2',
+         'doc': {'thing_type': 'common', 'thing_number': 2}, 'doc_as_upsert': True},
+        {'_op_type': 'update', '_index': 'thing', '_id': '3', 'doc': {'thing_type': 'common'}},
+        {'_op_type': 'update', '_index': 'thing', '_id': '3', 'doc': {'thing_number': 3}, 'doc_as_upsert': True},
+        {'_op_type': 'delete', '_index': 'thing', '_id': '4'},
+        {'_op_type': 'index', '_index': 'thing', '_id': '5',
+         '_source': {'thing_type': 'unique', 'thing_number': 5}},
+    ]
+    assert bulk_builder.count() == 0
+
+    # A delete of a document created in the same batch keeps the create, so
+    # the delete doesn't fail on a document that was never committed
+    bulk_builder.create("6", "thing", {'thing_type': 'common'})
+    bulk_builder.update("6", "thing", {'thing_number': 6})
+    bulk_builder.delete("6", "thing")
+
+    assert [action['_op_type'] for action in bulk_builder.drain()] == ['create', 'delete']
+
+
+@create_test_index(indices=["thing"])
+def test_chunked_msearch(test_services):
+    store = MegaStore(test_services.es, msearch_chunk_size=7, max_concurrent_searches=2)
+
+    for i in range(0, 50):
+        store.index(str(i), 'thing', {'thing_number': i}, batch=True)
+    store.batch_write()
+    store.refresh_index('thing')
+
+    for i in range(0, 50):
+        query = Body().query(Query().term('thing_number', i))
+        store.query('thing', query, key=str(i), just_one=True, batch=True)
+
+    # Queries go out as 8 msearch requests, but come back keyed as one batch
+    results = store.batch_query()
+    assert {k: result['thing_number'] for k, result in results.items()} == {str(i): i for i in range(0, 50)}
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+class FakeBulkClient(object):
+    """
+    Answers bulk requests in memory, rejecting each document with the statuses
+    queued for its id, before it succeeds. `delay` slows every request down
+    """
+    def __init__(self, statuses=None, delay=0, error=None):
+        self.transport = FakeTransport()
+        self.statuses = {id: list(statuses) for id, statuses in (statuses or {}).items()}
+        self.delay = delay
+        self.error = error
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def bulk(self, body, *args, **kwargs):
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        ids = []
+        i = 0
+        while i < len(lines):
+            op_type, meta = first(lines[i].items())
+            i += 1 if op_type == 'delete' else 2
+            with self.lock:
+                queued = self.statuses.get(meta['_id'])
+                status = queued.pop(0) if queued else 200
+            ids.append(meta['_id'])
+            items.append({op_type: {'_index': meta['_index'], '_id': meta['_id'], 'status': status}})
+        with self.lock:
+            self.requests.append(ids)
+        return {'took': 1, 'errors': any(first(item.values())['status'] >= 300 for item in items), 'items': items}
+
+    def committed(self):
+        with self.lock:
+            return [id for ids in self.requests for id in ids]
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_auto_flushing_triggers():
+    es = FakeBulkClient()
+
+    # Reaching max_actions flushes straight away
+    with AutoFlushingBulkBuilder(es, max_actions=3, max_age=None) as bulk_builder:
+        for i in range(0, 3):
+            bulk_builder.index(str(i), "thing", {'thing_number': i})
+        assert wait_for(lambda: es.committed() == ['0', '1', '2'])
+
+        # Fewer actions wait until the oldest is max_age old
+        bulk_builder.max_age = 0.1
+        bulk_builder.index("3", "thing", {'thing_number': 3})
+        assert wait_for(lambda: es.committed()[-1:] == ['3'])
+
+    # Stopping commits whatever is still pending
+    bulk_builder = AutoFlushingBulkBuilder(es, max_actions=100, max_age=None).start()
+    bulk_builder.index("4", "thing", {'thing_number': 4})
+    bulk_builder.stop()
+    assert es.committed()[-1:] == ['4']
+    assert bulk_builder.count() == 0
+
+
+def test_auto_flushing_backpressure():
+    es = FakeBulkClient(delay=0.05)
+
+    # With no count or age trigger, being at capacity still makes room
+    with AutoFlushingBulkBuilder(es, max_actions=None, max_age=None, max_pending=2) as bulk_builder:
+        for i in range(0, 10):
+            bulk_builder.index(str(i), "thing", {'thing_number': i})
+            assert bulk_builder.count() <= 2
+
+    assert sorted(es.committed(), key=int) == [str(i) for i in range(0, 10)]
+
+    with pytest.raises(ValueError):
+        AutoFlushingBulkBuilder(es, max_pending=0)
+
+
+def test_auto_flushing_errors():
+    es = FakeBulkClient(error=ConnectionError("N/A", "down", None))
+    failed = []
+
+    # A failed flush hands its actions over rather than dropping them
+    with AutoFlushingBulkBuilder(es, max_actions=2, max_age=None,
+                                 on_error=lambda e, actions: failed.append((e, actions))) as bulk_builder:
+        bulk_builder.index("1", "thing", {'thing_number': 1})
+        bulk_builder.index("2", "thing", {'thing_number': 2})
+        assert wait_for(lambda: len(failed) == 1)
+
+    error, actions = failed[0]
+    assert isinstance(error, ConnectionError)
+    assert [action['_id'] for action in actions] == ['1', '2']
+
+    # When only some items fail, only those are handed over, the others being committed
+    es = FakeBulkClient(statuses={'2': [400]})
+    failed = []
+    with AutoFlushingBulkBuilder(es, max_actions=3, max_age=None,
+                                 on_error=lambda e, actions: failed.append((e, actions))) as bulk_builder:
+        for i in range(1, 4):
+            bulk_builder.index(str(i), "thing", {'thing_number': i})
+        assert wait_for(lambda: len(failed) == 1)
+
+    error, actions = failed[0]
+    assert isinstance(error, BulkIndexError)
+    assert [first(item.values())['_id'] for item in error.errors] == ['2']
+    assert [action['_id'] for action in actions] == ['2']
+
+
+class FakeAsyncBulkClient(FakeBulkClient):
+    async def bulk(self, body, *args, **kwargs):
+        return super().bulk(body, *args, **kwargs)
+
+
+def retryable_builder():
+    bulk_builder = BulkBuilder()
+    for i in range(1, 6):
+        bulk_builder.index(str(i), "thing", {'thing_number': i})
+    return bulk_builder
+
+
+RETRYABLE_STATUSES = {'1': [429, 429], '2': [503], '3': [400], '4': [429, 429, 429, 429]}
+
+
+def test_retry_policy():
+    # Backoff doubles up to its cap, with full jitter below it
+    policy = RetryPolicy(initial_backoff=0.5, max_backoff=3, jitter=False)
+    assert [policy.backoff(attempt) for attempt in range(0, 5)] == [0.5, 1, 2, 3, 3]
+    policy = RetryPolicy(initial_backoff=0.5, max_backoff=3)
+    assert all(0 <= policy.backoff(attempt) <= min(3, 0.5 * 2 ** attempt) for attempt in range(0, 50))
+
+    # Only retryable statuses are resubmitted, until the retries run out
+    es = FakeBulkClient(statuses=RETRYABLE_STATUSES)
+    stats = retryable_builder().commit(es, retry_policy=RetryPolicy(max_retries=3, initial_backoff=0),
+                                       raise_on_error=False)
+    assert (stats.ok, stats.failed, stats.retried) == (3, 2, 6)
+    assert sorted(get_failed_id(failure) for failure in stats.failures) == ['3', '4']
+    assert es.requests[1:] == [['1', '2', '4'], ['1', '4'], ['4']]
+
+    # Without a policy every rejection is permanent, and raised
+    with pytest.raises(BulkIndexError) as e:
+        retryable_builder().commit(FakeBulkClient(statuses=RETRYABLE_STATUSES))
+    assert sorted(get_failed_id(failure) for failure in e.value.errors) == ['1', '2', '3', '4']
+
+    assert isinstance(BulkBuilder().commit(FakeBulkClient()), BulkStats)
+
+
+def test_async_retry_policy():
+    es = FakeAsyncBulkClient(statuses=RETRYABLE_STATUSES)
+    stats = BulkStats()
+
+    failures = asyncio.run(async_stream_bulk(es, retryable_builder().drain(), stats=stats,
+                                             retry_policy=RetryPolicy(max_retries=3, initial_backoff=0)))
+
+    assert (stats.ok, stats.failed, stats.retried) == (3, 2, 6)
+    assert sorted(get_failed_id(failure) for failure in failures) == ['3', '4']
+
+
+@create_test_index(indices=["thing"])
+def test_coalesced_create_and_delete(test_services):
+    store = MegaStore(test_services.es, coalesce_writes=True)
+
+    # The pair commits cleanly, as it would uncoalesced
+    store.create("1", "thing", {'thing_type': 'common'}, batch=True)
+    store.update("1", "thing", {'thing_number': 1}, batch=True)
+    store.delete("1", "thing", batch=True)
+    store.batch_write()
+
+    assert store.get("1", "thing") is None
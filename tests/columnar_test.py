@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from pyes.columnar import extract_columns, columns_from_response, concat_columns
+
+
+def test_extract_columns():
+    hits = [
+        {'_id': '1', '_source': {'thing_number': 1, 'meta': {'score': 0.5}, 'thing_type': 'common'}},
+        {'_id': '2', '_source': {'thing_number': 2, 'meta': {}}, 'fields': {'rank': [7]}},
+        {'_id': '3', '_source': {'thing_number': None, 'meta': {'score': 2}}, 'fields': {'rank': [8]}},
+    ]
+
+    columns = columns_from_response({'hits': {'hits': hits}}, ['thing_number', 'meta.score', 'thing_type', 'rank'])
+
+    # Dotted paths reach into _source, falling back on fields, missing values are masked
+    assert columns['thing_number'].dtype == np.int64
+    assert columns['thing_number'].mask.tolist() == [False, False, True]
+    assert columns['meta.score'].dtype == np.float64
+    assert columns['meta.score'].sum() == 2.5
+    assert columns['thing_type'].dtype == object
+    assert columns['rank'].compressed().tolist() == [7, 8]
+
+    columns = extract_columns(hits, ['thing_number'], dtypes={'thing_number': np.float32})
+    assert columns['thing_number'].dtype == np.float32
+
+    joined = concat_columns([columns, columns])
+    assert joined['thing_number'].count() == 4
+
+
+def test_multi_valued_and_datetime_columns():
+    hits = [
+        {'_id': '1', 'fields': {'tags': ['a', 'b'], 'scores': [1, 2], 'created': ['2021-05-04']}},
+        {'_id': '2', 'fields': {'tags': ['c', 'd'], 'scores': [3, 4]}},
+    ]
+
+    # Multi valued fields are kept whole in object columns, and refused by typed ones
+    columns = extract_columns(hits, ['tags', 'scores'])
+    assert columns['tags'].dtype == object
+    assert columns['tags'].tolist() == [['a', 'b'], ['c', 'd']]
+    assert columns['scores'].tolist() == [[1, 2], [3, 4]]
+    with pytest.raises(ValueError):
+        extract_columns(hits, ['scores'], dtypes={'scores': np.int64})
+
+    # Missing datetimes are masked like any other value
+    columns = extract_columns(hits, ['created'], dtypes={'created': 'datetime64[D]'})
+    assert columns['created'].dtype == np.dtype('datetime64[D]')
+    assert columns['created'].mask.tolist() == [False, True]
+    assert columns['created'][0] == np.datetime64('2021-05-04')
@@ -1,6 +1,12 @@
+import time
+
 import pytest
+from elasticsearch.helpers import ScanError
 
-from pyes.crud import ESCrudService
+from pyes.cache import EntityCache
+from pyes.crud import ESCrudService, ESSoftCrudService
+from pyes.query_builder import Body, Query
+from pyes.store import ElasticsearchStore
 from pyes.validators import NotExistsException
 from pyfunk.pyfunk import select_keys
 from pyes.schema import SchemaError, boolean, string_or_nil, Keys, OptionalKeys, string, RequiredKeys
@@ -73,3 +79,341 @@ def test_lifecycle(test_services):
     # Check the thing no longer exists
     with pytest.raises(NotExistsException):
         thing_service.exists(thing_id)
+
+
+@create_test_index(indices=["thing"])
+def test_get_all_in_chunks(test_services):
+    thing_service = ThingService(test_services.store)
+
+    thing_ids = ["thing-{0}".format(i) for i in range(0, 25)]
+    for thing_id in thing_ids:
+        thing_service.create({'thing_type': ThingType.COMMON}, entity_id=thing_id, batch=True)
+    thing_service.batch_write()
+
+    # Missing things are left out, as before
+    things = dict(thing_service.iter_all(thing_ids + ["missing"], chunk_size=4))
+    assert sorted(things.keys()) == sorted(thing_ids)
+
+    things = thing_service.get_all(thing_ids, fields=['uid'])
+    assert things["thing-3"] == {'uid': "thing-3"}
+
+
+@create_test_index(indices=["thing"])
+def test_soft_get_all(test_services):
+    thing_service = ESSoftCrudService(test_services.store, "thing")
+
+    thing_ids = [thing_service.create({'thing_type': ThingType.COMMON}) for _ in range(0, 3)]
+    thing_service.delete(thing_ids[0])
+    time.sleep(0.01)
+
+    # Soft deleted things are left out, whatever fields are asked for
+    assert sorted(thing_service.get_all(thing_ids).keys()) == sorted(thing_ids[1:])
+    assert thing_service.get_all(thing_ids, fields=['uid']) == {thing_id: {'uid': thing_id} for thing_id in thing_ids[1:]}
+
+
+class RacingStore(object):
+    """
+    A store whose writes let a read in before they land
+    """
+    def __init__(self):
+        self.docs = {}
+        self.during_write = None
+
+    def on_flushed(self, listener):
+        pass
+
+    def get(self, id, index, batch=False, **params):
+        return dict(self.docs[id])
+
+    def update(self, id, index, doc, batch=False):
+        self.during_write()
+        self.docs[id] = dict(self.docs[id], **doc)
+
+
+def test_entity_cache_racing_read():
+    store = RacingStore()
+    store.docs['a'] = {'uid': 'a', 'thing_type': ThingType.COMMON}
+    thing_service = ESCrudService(store, "thing", cache=EntityCache(max_entries=2, ttl=60))
+
+    # The entity read while the write is under way is not left cached after it
+    store.during_write = lambda: thing_service.get_entity('a')
+    thing_service.update('a', {'thing_type': ThingType.UNIQUE}, check_existence=False)
+    assert thing_service.get_entity('a')['thing_type'] == ThingType.UNIQUE
+
+
+@create_test_index(indices=["thing"])
+def test_entity_cache(test_services):
+    cache = EntityCache(max_entries=2, ttl=60)
+    thing_service = ESCrudService(test_services.store, "thing", cache=cache)
+
+    thing_ids = [thing_service.create({'thing_type': ThingType.COMMON}) for _ in range(0, 3)]
+
+    # Reads go through the cache
+    thing_service.get_entity(thing_ids[0])
+    assert thing_service.get_entity(thing_ids[0])['thing_type'] == ThingType.COMMON
+    assert select_keys(cache.as_dict(), ['hits', 'misses']) == {'hits': 1, 'misses': 1}
+
+    # Writes drop the cached entity, batched or not
+    thing_service.update(thing_ids[0], {'thing_type': ThingType.UNIQUE})
+    assert thing_service.get_entity(thing_ids[0])['thing_type'] == ThingType.UNIQUE
+
+    thing_service.update(thing_ids[0], {'thing_type': ThingType.COMMON}, batch=True)
+    thing_service.batch_write()
+    assert thing_service.get_entity(thing_ids[0])['thing_type'] == ThingType.COMMON
+
+    # A read between a batched write and its commit doesn't leave the old entity cached
+    thing_service.update(thing_ids[0], {'thing_type': ThingType.UNIQUE}, batch=True)
+    assert thing_service.get_entity(thing_ids[0])['thing_type'] == ThingType.COMMON
+    thing_service.batch_write()
+    assert thing_service.get_entity(thing_ids[0])['thing_type'] == ThingType.UNIQUE
+
+    # get_all only fetches what it's missing, and the LRU stays bounded
+    assert sorted(thing_service.get_all(thing_ids).keys()) == sorted(thing_ids)
+    assert cache.count() == 2
+    assert cache.evictions == 1
+
+
+@create_test_index(indices=["thing"])
+def test_iterate_query(test_services):
+    thing_service = ThingService(test_services.store)
+
+    for i in range(0, 25):
+        thing_service.create({'thing_type': ThingType.COMMON, 'thing_number': i}, batch=True)
+    thing_service.batch_write()
+    thing_service.refresh()
+
+    # Pages run past the query limit, in sort order, without a trailing empty page
+    pages = list(thing_service.iterate_query(size=10, sort='thing_number', pages=True))
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [thing['thing_number'] for page in pages for thing in page] == list(range(0, 25))
+
+    things = thing_service.iterate_query({'thing_type': ThingType.COMMON}, size=10, hits=False)
+    assert len({hit['_id'] for hit in things}) == 25
+
+
+@create_test_index(indices=["thing"])
+def test_point_in_time_scans(test_services):
+    thing_service = ThingService(test_services.store)
+
+    for i in range(0, 30):
+        thing_service.create({'thing_type': ThingType.COMMON, 'thing_number': i}, batch=True)
+    thing_service.batch_write()
+    thing_service.refresh()
+
+    pit_ids = []
+    pit_id = thing_service.open_point_in_time()
+    try:
+        hits = list(thing_service.scan(size=7, pit=True, pit_id=pit_id, on_pit_id=pit_ids.append))
+        assert len({hit['_id'] for hit in hits}) == 30
+
+        # A scan can resume after the sort of the last hit it saw, in the same point in time
+        resumed = list(thing_service.scan(size=7, pit=True, search_after=hits[9]['sort'], pit_id=pit_ids[-1]))
+        assert [hit['_id'] for hit in resumed] == [hit['_id'] for hit in hits[10:]]
+    finally:
+        thing_service.close_point_in_time(pit_ids[-1] if pit_ids else pit_id)
+
+    seen = []
+    thing_service.sliced_scan(lambda hit: seen.append(hit['_id']), slices=3, size=4, pit=True)
+    assert sorted(seen) == sorted(hit['_id'] for hit in hits)
+
+
+class FakePitClient(object):
+    """
+    Serves pages of two hits, handing back a new point in time id with each
+    """
+    def __init__(self, hits):
+        self.hits = hits
+        self.searches = []
+        self.closed = []
+
+    def open_point_in_time(self, index, keep_alive):
+        return {'id': 'pit-0'}
+
+    def search(self, body):
+        self.searches.append(dict(body))
+        start = body['search_after'][0] + 1 if 'search_after' in body else 0
+        hits = [{'_id': str(i), 'sort': [i]} for i in range(start, min(start + 2, self.hits))]
+        return {'pit_id': 'pit-{0}'.format(len(self.searches)), 'hits': {'hits': hits}}
+
+    def close_point_in_time(self, body):
+        self.closed.append(body['id'])
+
+
+def test_sliced_scan_pit_ids():
+    es = FakePitClient(5)
+    seen = []
+    ElasticsearchStore(es).sliced_scan('thing', lambda hit: seen.append(hit['_id']), slices=1, size=2, pit=True)
+    assert seen == ['0', '1', '2', '3', '4']
+
+    # The id returned by the last search is the one closed
+    assert es.closed == ['pit-3']
+
+    # Resuming stays in the point in time the sort values came from, left open for the caller
+    with pytest.raises(ValueError):
+        list(ElasticsearchStore(es).scan('thing', size=2, pit=True, search_after=[1]))
+    resumed = list(ElasticsearchStore(es).scan('thing', size=2, pit=True, search_after=[1], pit_id='pit-3'))
+    assert [hit['_id'] for hit in resumed] == ['2', '3', '4']
+    assert [search['pit']['id'] for search in es.searches[-2:]] == ['pit-3', 'pit-4']
+    assert es.closed == ['pit-3']
+
+    # A sort on a single field keeps the field, with the _shard_doc tiebreaker after it
+    body = ElasticsearchStore.pit_body({'query': {'match_all': {}}, 'sort': 'thing_number'}, 10)
+    assert body['sort'] == ['thing_number', {'_shard_doc': 'asc'}]
+
+
+class FakeScrollClient(object):
+    """
+    Scrolls through pages of two hits, the second page missing a failed shard
+    """
+    def __init__(self):
+        self.cleared = []
+
+    def page(self, number):
+        shards = {'total': 2, 'successful': 2 if number == 0 else 1, 'skipped': 0, 'failed': 0 if number == 0 else 1}
+        return {'_scroll_id': 'scroll', '_shards': shards,
+                'hits': {'hits': [{'_id': str(number * 2 + i)} for i in range(2)]}}
+
+    def search(self, index, body, scroll, size):
+        return self.page(0)
+
+    def scroll(self, body, scroll):
+        return self.page(1)
+
+    def clear_scroll(self, body, ignore=()):
+        self.cleared.extend(body['scroll_id'])
+
+
+def test_scroll_shard_failures():
+    es = FakeScrollClient()
+    pages = ElasticsearchStore(es).scroll_pages('thing', query={'query': {'match_all': {}}}, size=2)
+
+    # Pages answered by every shard come through, a partial one raises rather than passing as complete
+    assert [hit['_id'] for hit in next(pages)] == ['0', '1']
+    with pytest.raises(ScanError):
+        next(pages)
+    assert es.cleared == ['scroll']
+
+
+class PartialPitClient(FakePitClient):
+    def search(self, body):
+        response = super().search(body)
+        response['_shards'] = {'total': 3, 'successful': 2, 'skipped': 0, 'failed': 1}
+        return response
+
+
+class PagesStore(object):
+    def __init__(self):
+        self.queries = []
+
+    def iterate_pages(self, index, query, **kwargs):
+        self.queries.append(query.build())
+        return iter([])
+
+
+def test_point_in_time_shard_failures():
+    # A page missing a failed shard raises rather than passing as complete, and the point in time is closed
+    es = PartialPitClient(5)
+    with pytest.raises(ScanError):
+        list(ElasticsearchStore(es).iterate_pages('thing', size=2))
+    assert es.closed == ['pit-1']
+
+
+def test_soft_iterate_query_leaves_body():
+    store = PagesStore()
+    thing_service = ESSoftCrudService(store, "thing")
+    body = Body().query(Query().match_all())
+    before = body.build()
+
+    # The caller's Body is copied before the not deleted clause and sort are added
+    list(thing_service.iterate_query(body, sort='thing_number'))
+    assert body.build() == before
+    assert store.queries[0] != before
+
+
+def test_soft_get_all_checks_args():
+    thing_service = ESSoftCrudService(PagesStore(), "thing")
+
+    # Bad ids are rejected up front, as by every other service method
+    for bad in [lambda: thing_service.get_all([1]), lambda: thing_service.iter_all(['a', None]),
+                lambda: thing_service.get_all(['a'], fields='uid')]:
+        with pytest.raises(SchemaError):
+            bad()
+
+
+def check_thing(hit):
+    assert hit['_source']['thing_type'] == ThingType.COMMON
+
+
+@create_test_index(indices=["thing"])
+def test_process_pool_sliced_scan(test_services):
+    thing_service = ThingService(test_services.store)
+
+    for i in range(0, 30):
+        thing_service.create({'thing_type': ThingType.COMMON, 'thing_number': i}, batch=True)
+    thing_service.batch_write()
+    thing_service.refresh()
+
+    stats = thing_service.sliced_scan(check_thing, slices=2, size=4, processes=2, queue_depth=2).as_dict()
+    assert stats['hits'] == 30
+    assert sum(worker['hits'] for worker in stats['workers'].values()) == 30
+
+
+@create_test_index(indices=["thing"])
+def test_prefetching_scan(test_services):
+    thing_service = ThingService(test_services.store)
+
+    for i in range(0, 30):
+        thing_service.create({'thing_type': ThingType.COMMON, 'thing_number': i}, batch=True)
+    thing_service.batch_write()
+    thing_service.refresh()
+
+    for pit in [False, True]:
+        hits = list(thing_service.scan(size=4, pit=pit, prefetch=2))
+        assert sorted(hit['_source']['thing_number'] for hit in hits) == list(range(0, 30))
+
+    # Abandoning a prefetching scan part way through is fine
+    hits = thing_service.scan(size=4, prefetch=2)
+    assert next(hits)['_source']['thing_type'] == ThingType.COMMON
+    hits.close()
+
+
+@create_test_index(indices=["thing"])
+def test_batch_scan(test_services):
+    thing_service = ThingService(test_services.store)
+
+    for i in range(0, 12):
+        thing_service.create({'thing_type': ThingType.COMMON, 'thing_number': i}, batch=True)
+    thing_service.batch_write()
+    thing_service.refresh()
+
+    # Pages come straight from the server, with no trailing empty batch
+    assert [len(page) for page in thing_service.batch_scan(size=4)] == [4, 4, 4]
+
+    pages = list(thing_service.batch_scan(size=5, pit=True, sources=True, fields=['thing_number']))
+    assert [len(page) for page in pages] == [5, 5, 2]
+    assert sorted(thing['thing_number'] for page in pages for thing in page) == list(range(0, 12))
+    assert all(thing.keys() == {'thing_number'} for page in pages for thing in page)
+
+
+@create_test_index(indices=["thing"])
+def test_default_projection(test_services):
+    thing_service = ESCrudService(test_services.store, "thing", source_excludes=['blob'])
+
+    thing_id = thing_service.create({'thing_type': ThingType.COMMON, 'thing_number': 1, 'blob': 'x' * 1000})
+    thing_service.refresh()
+
+    # The service's projection applies unless a call asks for its own fields
+    assert 'blob' not in thing_service.get_entity(thing_id)
+    assert 'blob' not in thing_service.query({'thing_type': ThingType.COMMON}, just_one=True)
+    assert thing_service.query({'thing_type': ThingType.COMMON}, fields=['blob'], just_one=True) == {'blob': 'x' * 1000}
+    assert 'blob' not in thing_service.get_all([thing_id])[thing_id]
+
+    # Filtered responses still carry ids, and empty ones still transform
+    things = thing_service.query({'thing_type': ThingType.COMMON}, include_id=True)
+    assert [select_keys(thing, ['thing_type', 'thing_number', 'uid']) for thing in things] == \
+        [{'thing_type': ThingType.COMMON, 'thing_number': 1, 'uid': thing_id}]
+
+    # Hits without a source aren't dropped by the response filter
+    assert thing_service.query({'query': {'match_all': {}}, '_source': False}, raw_query=True) == [None]
+    assert thing_service.query({'thing_type': ThingType.UNIQUE}, include_id=True) == []
+    assert thing_service.query({'thing_type': ThingType.UNIQUE}, just_one=True) is None
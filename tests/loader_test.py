@@ -0,0 +1,52 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from pyes.crud import ESCrudService
+from pyes.loader import EntityLoader, AsyncEntityLoader
+
+from pyes.test.indices import create_test_index
+from pyes.test.fixtures import test_services
+
+
+@create_test_index(indices=["thing"])
+def test_entity_loader(test_services):
+    loader = EntityLoader(test_services.store, window=0.01)
+    thing_service = ESCrudService(test_services.store, "thing", loader=loader)
+
+    thing_ids = [thing_service.create({'thing_type': 'common'}) for _ in range(0, 20)]
+
+    def get_uid(thing_id):
+        thing = thing_service.get_entity(thing_id)
+        return thing['uid'] if thing else None
+
+    # Concurrent gets come back to their own callers, from far fewer mgets
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        assert list(pool.map(get_uid, thing_ids + ["missing"])) == thing_ids + [None]
+
+    assert loader.loads == 21
+    assert loader.batches < 21
+
+
+class FakeStore(object):
+    async def multi_get(self, index, ids):
+        await asyncio.sleep(0.01)
+        return {id: {'uid': id} for id in ids}
+
+
+def test_async_loader_cancelled_load():
+    async def run():
+        loader = AsyncEntityLoader(FakeStore())
+        loads = [asyncio.ensure_future(loader.load("thing", id)) for id in ["1", "1", "2"]]
+        await asyncio.sleep(0)
+        loads[0].cancel()
+
+        # Cancelling one caller leaves the rest of its batch to resolve
+        results = await asyncio.wait_for(asyncio.gather(*loads[1:]), timeout=1)
+        assert results == [{'uid': '1'}, {'uid': '2'}]
+        assert loader.batches == 1
+
+        # The loader holds its batch tasks only until they complete
+        await asyncio.sleep(0)
+        assert loader.tasks == set()
+
+    asyncio.run(run())
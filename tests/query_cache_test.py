@@ -0,0 +1,110 @@
+import time
+
+from pyes.cache import QueryCache
+from pyes.crud import ESCrudService
+from pyes.store import MegaStore
+
+from pyes.test.indices import create_test_index
+from pyes.test.fixtures import test_services
+
+
+@create_test_index(indices=["thing"])
+def test_query_cache(test_services):
+    cache = QueryCache(max_entries=100, ttl=60)
+    store = MegaStore(test_services.es, query_cache=cache)
+    thing_service = ESCrudService(store, "thing")
+
+    thing_service.create({'thing_type': 'common'})
+    thing_service.refresh()
+
+    # Repeating a query is served from the cache
+    assert len(thing_service.query({'thing_type': 'common'})) == 1
+    assert len(thing_service.query({'thing_type': 'common'})) == 1
+    assert cache.hits == 1
+
+    # Writes and refreshes through the store drop the index's entries
+    thing_service.create({'thing_type': 'common'}, batch=True)
+    thing_service.batch_write()
+    thing_service.refresh()
+    assert len(thing_service.query({'thing_type': 'common'})) == 2
+
+    assert thing_service.count() == 2
+    hits = cache.hits
+    assert thing_service.count() == 2
+    assert cache.hits == hits + 1
+
+
+@create_test_index(indices=["thing"])
+def test_query_cache_keys(test_services):
+    cache = QueryCache(max_entries=100, ttl=60)
+    store = MegaStore(test_services.es, query_cache=cache)
+    thing_service = ESCrudService(store, "thing")
+
+    thing_service.create({'thing_type': 'common'})
+    thing_service.refresh()
+
+    # Per call transforms share the cached result, and misses are cached too
+    for _ in range(0, 3):
+        assert thing_service.query({'thing_type': 'common'}, transform=lambda things: len(things)) == 1
+        assert thing_service.query({'thing_type': 'unique'}, just_one=True) is None
+    assert cache.hits == 4
+
+    # Background flushes invalidate the index they commit to
+    store.auto_flush(max_actions=1, max_age=0.01)
+    try:
+        thing_service.create({'thing_type': 'common'}, batch=True)
+        assert len(thing_service.query({'thing_type': 'common'})) == 1
+        time.sleep(0.5)
+        # Refreshed behind the store's back, so only the flush invalidates
+        test_services.es.indices.refresh(index="thing")
+        assert len(thing_service.query({'thing_type': 'common'})) == 2
+    finally:
+        store.stop_auto_flush()
+
+
+class FakeSearchClient(object):
+    """
+    Searches in memory, answering with the documents as they were when the
+    search started. `during_search` runs once, part way through the next search
+    """
+    def __init__(self, aliases=()):
+        self.docs = []
+        self.aliases = set(aliases)
+        self.during_search = None
+        self.searches = 0
+        self.indices = self
+
+    def exists_alias(self, name, index=None):
+        return name in self.aliases
+
+    def search(self, index, body, **params):
+        hits = [{'_id': str(i), '_source': dict(doc)} for i, doc in enumerate(self.docs)]
+        self.searches += 1
+        if self.during_search is not None:
+            during_search, self.during_search = self.during_search, None
+            during_search()
+        return {'hits': {'hits': hits}}
+
+    def index(self, id, index, body):
+        self.docs.append(body)
+
+
+def test_query_cache_generations():
+    es = FakeSearchClient(aliases=['things'])
+    cache = QueryCache(max_entries=100, ttl=60)
+    store = MegaStore(es, query_cache=cache)
+    query = {'query': {'match_all': {}}}
+
+    # A result fetched across a write isn't stored, so the next query sees the write
+    es.during_search = lambda: store.index('1', 'thing', {'thing_type': 'common'})
+    assert store.query('thing', query) == []
+    assert store.query('thing', query) == [{'thing_type': 'common'}]
+    assert store.query('thing', query) == [{'thing_type': 'common'}]
+    assert es.searches == 2
+
+    # Queries through an alias or several indices aren't cached, writes never name them
+    for index in ['things', 'thing,other']:
+        store.query(index, query)
+        store.query(index, query)
+    assert es.searches == 6
+    assert cache.hits == 1
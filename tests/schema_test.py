@@ -0,0 +1,42 @@
+import pytest
+
+from pyes.schema import SchemaError, Validation, ValidationSettings, checkargs, set_validation, string, nillable, \
+    number
+
+
+class ThingValidator(object):
+    def __init__(self, validation=None):
+        self.validation = validation
+
+    @checkargs
+    def check(self,
+              thing: {},
+              tags: [string] = [],
+              limit: number = 10,
+              fields: nillable([string]) = None):
+        return thing
+
+
+def test_checkargs():
+    validator = ThingValidator()
+
+    assert validator.check({'thing_type': 'common'}, ['a'], fields=['thing_type']) == {'thing_type': 'common'}
+    for bad in [lambda: validator.check([]), lambda: validator.check({}, [1]), lambda: validator.check({}, limit='1'),
+                lambda: validator.check({}, fields=[1])]:
+        with pytest.raises(SchemaError):
+            bad()
+
+    # Validation can be switched off globally, or per object
+    try:
+        set_validation(Validation.OFF)
+        assert validator.check([]) == []
+        with pytest.raises(SchemaError):
+            ThingValidator(ValidationSettings(Validation.ON)).check([])
+    finally:
+        set_validation(Validation.ON)
+
+    assert ThingValidator(ValidationSettings(Validation.SAMPLED, sample_rate=0)).check([]) == []
+
+    # Anything else named validation leaves the global setting in charge
+    with pytest.raises(SchemaError):
+        ThingValidator(validation=Validation.OFF).check([])
@@ -0,0 +1,31 @@
+import datetime
+import uuid
+from decimal import Decimal
+
+import numpy as np
+import pytest
+from elasticsearch.serializer import JSONSerializer
+
+from pyes.serializer import OrjsonSerializer, orjson
+
+
+@pytest.mark.skipif(orjson is None, reason="orjson is not installed")
+def test_orjson_parity():
+    values = {
+        'datetime': datetime.datetime(2021, 5, 4, 3, 2, 1, 123456),
+        'aware': datetime.datetime(2021, 5, 4, tzinfo=datetime.timezone.utc),
+        'date': datetime.date(2021, 5, 4),
+        'decimal': Decimal('1.25'),
+        'uuid': uuid.UUID(int=5),
+        'int64': np.int64(7),
+        'float32': np.float32(0.1),
+        'float64': np.float64(0.1),
+        'bool': np.bool_(True),
+        'datetime64': np.datetime64('2021-01-01'),
+        'array': np.array([0.5, 1.5]),
+        'float32_array': np.array([0.1], dtype=np.float32),
+        'nested': {'things': [np.int32(1), 'é']}
+    }
+
+    for key, value in values.items():
+        assert OrjsonSerializer().dumps({key: value}) == JSONSerializer().dumps({key: value}), key
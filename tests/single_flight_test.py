@@ -0,0 +1,109 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pyes.crud import ESCrudService
+from pyes.single_flight import SingleFlight
+from pyes.store import MegaStore
+
+from pyes.test.indices import create_test_index
+from pyes.test.fixtures import test_services
+
+
+@create_test_index(indices=["thing"])
+def test_coalesced_reads(test_services):
+    store = MegaStore(test_services.es, coalesce_reads=True)
+    thing_service = ESCrudService(store, "thing")
+
+    thing_id = thing_service.create({'thing_type': 'common'})
+    thing_service.refresh()
+
+    def read(i):
+        if i % 2:
+            return thing_service.get_entity(thing_id)['uid']
+        return thing_service.query({'thing_type': 'common'}, just_one=True)['uid']
+
+    # Every caller gets the result, whether or not it shared a request
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        assert list(pool.map(read, range(0, 200))) == [thing_id] * 200
+
+    stats = store.single_flight.as_dict()
+    assert stats['requests'] == 200
+    assert store.collapsed_reads() == stats['collapsed']
+    assert store.single_flight.in_flight() == 0
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    callers = 8
+    release = threading.Event()
+    executions = []
+
+    def fetch():
+        executions.append(True)
+        # hold the call open until every other caller is waiting on it
+        release.wait(5)
+        return {'uid': 'a'}
+
+    def waiting():
+        with single_flight.lock:
+            return sum(call.waiters for call in single_flight.calls.values())
+
+    with ThreadPoolExecutor(max_workers=callers) as pool:
+        results = [pool.submit(single_flight.do, 'thing', fetch) for _ in range(0, callers)]
+        while waiting() < callers - 1:
+            threading.Event().wait(0.001)
+        release.set()
+        results = [result.result() for result in results]
+
+    # Concurrent identical calls share one execution, each caller getting its own copy
+    assert len(executions) == 1
+    assert single_flight.as_dict() == {'requests': callers, 'executed': 1, 'collapsed': callers - 1}
+    assert results == [{'uid': 'a'}] * callers
+    assert len({id(result) for result in results}) == callers
+    assert single_flight.in_flight() == 0
+
+
+class SlowGetClient(object):
+    """
+    Holds the first get open until released, answering with the document as
+    it was when the get started
+    """
+    def __init__(self):
+        self.doc = {'version': 1}
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.gets = 0
+        self.indices = self
+
+    def exists_alias(self, name, index=None):
+        return False
+
+    def get(self, id, index, **params):
+        doc = dict(self.doc)
+        self.gets += 1
+        if self.gets == 1:
+            self.started.set()
+            self.release.wait(5)
+        return {'found': True, '_source': doc}
+
+    def index(self, id, index, body):
+        self.doc = dict(body)
+
+
+def test_single_flight_after_write():
+    es = SlowGetClient()
+    store = MegaStore(es, coalesce_reads=True)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        before = pool.submit(store.get, '1', 'thing')
+        assert es.started.wait(5)
+        store.index('1', 'thing', {'version': 2})
+
+        # A read starting after the write doesn't join the call that started before it
+        after = pool.submit(store.get, '1', 'thing')
+        assert after.result(5) == {'version': 2}
+        es.release.set()
+        assert before.result(5) == {'version': 1}
+
+    assert store.single_flight.as_dict()['executed'] == 2
+    assert store.single_flight.in_flight() == 0
@@ -0,0 +1,139 @@
+import json
+
+import pytest
+from elasticsearch.exceptions import ConnectionError
+from elasticsearch.serializer import Deserializer, JSONSerializer
+from urllib3.exceptions import ProtocolError
+
+from pyes.streaming import HitStream, stream_request
+
+
+def test_hit_stream():
+    response = {
+        '_scroll_id': 'abc',
+        'took': 12,
+        'hits': {
+            'total': {'value': 3},
+            'max_score': 1.5,
+            'hits': [{'_id': str(i), '_score': 1.5, '_source': {'thing_number': i * 1.25, 'name': 'thing é {0}'.format(i)}}
+                     for i in range(3)]
+        },
+        'aggregations': {'things': {'value': 3}}
+    }
+    body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+
+    # Hits decode the same however the body is cut up
+    for size in [1, 2, 7, 64, len(body)]:
+        closed = []
+        stream = HitStream([body[i:i + size] for i in range(0, len(body), size)], on_close=closed.append)
+        assert list(stream) == response['hits']['hits']
+        assert stream.captured == {'_scroll_id': 'abc'}
+        assert closed == [True]
+
+    # Abandoning the stream releases it unfinished
+    closed = []
+    stream = HitStream([body], on_close=closed.append)
+    next(stream)
+    stream.close()
+    assert closed == [False]
+
+
+def test_hit_stream_large_hits():
+    hits = [{'_id': str(i), '_source': {'text': 'a "quoted" \\ {{thing}} [{0}] é'.format(i) * 50,
+                                        'nested': [{'n': i}, [], {}], 'flag': True, 'missing': None}}
+            for i in range(3)]
+    body = json.dumps({'hits': {'hits': hits}}, ensure_ascii=False).encode('utf-8')
+
+    # Escapes and brackets inside strings survive any cut of the body
+    for size in [1, 3, 1000]:
+        decoded = []
+        stream = HitStream([body[i:i + size] for i in range(0, len(body), size)],
+                           loads=lambda text: decoded.append(text) or json.loads(text))
+        assert list(stream) == hits
+        assert len(decoded) == len(hits)
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.status = 200
+        self.headers = {'content-type': 'application/json'}
+        self.body = body
+
+    def stream(self, chunk_bytes, decode_content=True):
+        return iter([self.body])
+
+    def drain_conn(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class FakeConnection(object):
+    url_prefix = ''
+    http_compress = False
+
+    def __init__(self, body=None):
+        self.headers = {'accept-encoding': 'gzip,deflate'}
+        self.body = body
+        self.pool = self
+        self.requests = []
+
+    def urlopen(self, method, url, data, headers=None, **kwargs):
+        self.requests.append(headers)
+        if self.body is None:
+            raise ProtocolError("Connection refused")
+        return FakeResponse(self.body)
+
+
+class FakePool(object):
+    def __init__(self):
+        self.dead = []
+        self.live = []
+
+    def mark_live(self, connection):
+        self.live.append(connection)
+
+
+class FakeTransport(object):
+    max_retries = 3
+    retry_on_timeout = False
+    retry_on_status = (502, 503, 504)
+    serializer = JSONSerializer()
+    deserializer = Deserializer({'application/json': JSONSerializer()})
+
+    def __init__(self, connections):
+        self.connections = iter(connections)
+        self.connection_pool = FakePool()
+
+    def get_connection(self):
+        return next(self.connections)
+
+    def mark_dead(self, connection):
+        self.connection_pool.dead.append(connection)
+
+
+class FakeClient(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+
+def test_stream_request():
+    body = json.dumps({'hits': {'hits': [{'_id': '1'}]}}).encode('utf-8')
+    down, up = FakeConnection(), FakeConnection(body)
+    transport = FakeTransport([down, up])
+
+    # A failed connection is marked dead and the request tried on the next
+    stream = stream_request(FakeClient(transport), 'POST', '/thing/_search', body={'query': {'match_all': {}}})
+    assert list(stream) == [{'_id': '1'}]
+    assert transport.connection_pool.dead == [down]
+    assert transport.connection_pool.live == [up]
+
+    # The response is asked for uncompressed, so it can be decoded as it arrives
+    assert up.requests[0]['accept-encoding'] == 'identity'
+
+    # Failures are raised once the retries run out
+    transport = FakeTransport([FakeConnection() for _ in range(4)])
+    with pytest.raises(ConnectionError):
+        stream_request(FakeClient(transport), 'POST', '/thing/_search')
+    assert len(transport.connection_pool.dead) == 4
@@ -0,0 +1,26 @@
+from pyes.store import build_transform
+
+
+def build_response():
+    return {'hits': {'hits': [{'_id': str(i), '_source': {'thing_number': i}} for i in range(0, 3)]}}
+
+
+def test_build_transform():
+    response = build_response()
+
+    assert build_transform()(response) == [{'thing_number': i} for i in range(0, 3)]
+    assert build_transform(just_one=True, include_id=True, transform=lambda thing: thing['uid'])(response) == '0'
+    assert build_transform(just_one=True)({}) is None
+
+    # Ids go into copies of the sources, unless in place
+    things = build_transform(include_id=True)(response)
+    assert things[1] == {'thing_number': 1, 'uid': '1'}
+    assert 'uid' not in response['hits']['hits'][1]['_source']
+
+    things = build_transform(include_id=True, in_place=True)(response)
+    assert things[1] is response['hits']['hits'][1]['_source']
+    assert response['hits']['hits'][1]['_source']['uid'] == '1'
+
+    # Whole responses keep their shape
+    assert build_transform(hits=False, include_id=True, in_place=True)(build_response())['hits']['hits'][2] == \
+        {'_id': '2', '_source': {'thing_number': 2, 'uid': '2'}}
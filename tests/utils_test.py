@@ -0,0 +1,54 @@
+from pyfunk.pyfunk import get_in
+
+from pyes.utils import ChildByParentScroller
+
+
+class FakeStore(object):
+    """
+    Pages through the children of the parents a query names, in the order of
+    the query's sort on the parent
+    """
+    def __init__(self, children):
+        self.children = children
+        self.scans = []
+        self.served = 0
+
+    def scan_pages(self, index, query=None, size=1000, pit=False):
+        self.scans.append(query)
+        parent_ids = get_in(query, ['query', 'terms', 'join#thing'])
+        children = [child for child in self.children if child['_source']['join']['parent'] in parent_ids]
+        if query.get('sort', [None])[0] == {'join#thing': 'asc'}:
+            children = sorted(children, key=lambda child: child['_source']['join']['parent'])
+        includes = get_in(query, ['_source', 'includes'])
+        for i in range(0, len(children), size):
+            page = []
+            for child in children[i:i + size]:
+                source = child['_source']
+                if includes is not None:
+                    source = {k: v for k, v in source.items() if k in includes}
+                page.append({'_id': child['_id'], '_source': source})
+            self.served += len(page)
+            yield page
+
+
+def test_batched_child_by_parent_scroller():
+    children = [{'_id': 'c{0}'.format(i), '_source': {'join': {'name': 'part', 'parent': 'p{0}'.format(i % 3)},
+                                                        'part_number': i}}
+                for i in range(6)]
+    store = FakeStore(list(reversed(children)))
+
+    scroller = ChildByParentScroller(None, 'thing', ['p0', 'p1', 'p2', 'p3'], 1, opts={'_source': ['part_number']},
+                                     join_field='join', parent_type='thing', chunk_size=2, store=store)
+
+    # Children are handed out as they arrive, not once their chunk's scan completes
+    assert next(scroller) == ('p0', {'_id': 'c3', '_source': {'part_number': 3, 'join': {'name': 'part',
+                                                                                         'parent': 'p0'}}})
+    assert store.served == 1
+
+    # Pairs follow the parent order, with one scan per chunk of parents
+    pairs = [('p0', 'c3')] + [(parent_id, hit['_id']) for parent_id, hit in scroller]
+    assert pairs == [('p0', 'c3'), ('p0', 'c0'), ('p1', 'c4'), ('p1', 'c1'), ('p2', 'c5'), ('p2', 'c2')]
+    assert len(store.scans) == 2
+
+    # The join field names the parent, so is kept when the sources are restricted
+    assert [get_in(query, ['_source', 'includes']) for query in store.scans] == [['part_number', 'join']] * 2